@@ -1,9 +1,52 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, Response, abort
-from datetime import datetime
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, Response, abort, session, g
+from datetime import datetime, timedelta
 from dotenv import load_dotenv
 from pathlib import Path
+from collections import Counter, deque
+import base64
+import bisect
+import contextlib
+import ctypes
+import difflib
+import errno
+import fcntl
+import fnmatch
+import glob
+import gzip
+import hashlib
+import heapq
+import json
+import mmap
 import os
+import queue
+import re
+import shlex
+import shutil
+import resource
+import signal
+import socket
+import sqlite3
+import stat
+import struct
 import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+import zlib
+
+try:
+    from re import _parser as regex_parser
+except ImportError:
+    # Python before 3.11
+    import sre_parse as regex_parser
+
+try:
+    import brotli
+except ImportError:
+    # Optional, responses are gzipped without it
+    brotli = None
 
 # Load environment variables from .env file
 load_dotenv()
@@ -14,195 +57,4626 @@ app.secret_key = os.getenv('SECRET_KEY', 'script_manager_secret_key')
 SCRIPT_DIR = os.getenv('SCRIPT_DIR', '/data/scripts')
 GIT_ENABLED = os.getenv('GIT_ENABLED', 'false').lower() == 'true'
 
+# Dashboard event settings
+EVENT_POLL_INTERVAL = float(os.getenv('EVENT_POLL_INTERVAL', '1'))
+EVENT_SUBSCRIBER_QUEUE = int(os.getenv('EVENT_SUBSCRIBER_QUEUE', '100'))
+
+# Job engine settings
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', '4'))
+JOB_QUEUE_SIZE = int(os.getenv('JOB_QUEUE_SIZE', '100'))
+JOB_TIMEOUT = int(os.getenv('JOB_TIMEOUT', '3600'))
+JOB_HISTORY_LIMIT = int(os.getenv('JOB_HISTORY_LIMIT', '500'))
+JOB_OUTPUT_LINES = int(os.getenv('JOB_OUTPUT_LINES', '1000'))
+JOB_LINE_LIMIT = int(os.getenv('JOB_LINE_LIMIT', '8192'))
+
+# Fan-out settings, NODES_FILE lists the hosts a script can be run on
+NODES_FILE = os.getenv('NODES_FILE', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'nodes.json'))
+FANOUT_TRANSPORT = os.getenv('FANOUT_TRANSPORT', 'ssh')
+FANOUT_CONCURRENCY = int(os.getenv('FANOUT_CONCURRENCY', '20'))
+FANOUT_TIMEOUT = int(os.getenv('FANOUT_TIMEOUT', str(JOB_TIMEOUT)))
+FANOUT_OUTPUT_LINES = int(os.getenv('FANOUT_OUTPUT_LINES', '200'))
+FANOUT_SSH_OPTIONS = os.getenv('FANOUT_SSH_OPTIONS', '-o BatchMode=yes -o ConnectTimeout=10')
+
+# Pipeline settings, steps of a run share a workspace directory under PIPELINE_WORKSPACE_DIR
+PIPELINE_CONCURRENCY = int(os.getenv('PIPELINE_CONCURRENCY', '4'))
+PIPELINE_RETRY_DELAY = float(os.getenv('PIPELINE_RETRY_DELAY', '5'))
+PIPELINE_WORKSPACE_DIR = os.getenv('PIPELINE_WORKSPACE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'workspaces'))
+
+# Tmux streaming settings
+TMUX_STREAM_INTERVAL = float(os.getenv('TMUX_STREAM_INTERVAL', '0.25'))
+TMUX_SUBSCRIBER_QUEUE = int(os.getenv('TMUX_SUBSCRIBER_QUEUE', '100'))
+TMUX_RECONNECT_INTERVAL = float(os.getenv('TMUX_RECONNECT_INTERVAL', '5'))
+TMUX_CONTROL_SESSION = os.getenv('TMUX_CONTROL_SESSION', '_script_manager')
+# TERM reported by our own control clients so they can be told apart from users
+TMUX_CLIENT_TERM = 'script-manager'
+
+# Git network settings
+GIT_FETCH_INTERVAL = int(os.getenv('GIT_FETCH_INTERVAL', '0'))
+GIT_NETWORK_TIMEOUT = int(os.getenv('GIT_NETWORK_TIMEOUT', '600'))
+
+# File index settings
+FILE_INDEX_POLL_INTERVAL = float(os.getenv('FILE_INDEX_POLL_INTERVAL', '5'))
+FILE_INDEX_DEBOUNCE = float(os.getenv('FILE_INDEX_DEBOUNCE', '0.2'))
+
+# Server settings, STATE_DB shares job state between worker processes
+DEBUG = os.getenv('DEBUG', 'false').lower() == 'true'
+STATE_DB = os.getenv('STATE_DB', '')
+STATE_POLL_INTERVAL = float(os.getenv('STATE_POLL_INTERVAL', '0.5'))
+
+# Run history settings, an empty HISTORY_DB turns it off
+HISTORY_DB = os.getenv('HISTORY_DB', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'history.db'))
+HISTORY_RETENTION_DAYS = float(os.getenv('HISTORY_RETENTION_DAYS', '90'))
+HISTORY_MAX_RUNS = int(os.getenv('HISTORY_MAX_RUNS', '1000000'))
+HISTORY_COMPACT_INTERVAL = int(os.getenv('HISTORY_COMPACT_INTERVAL', '3600'))
+
+# Version store settings, an empty VERSIONS_DB turns it off
+VERSIONS_DB = os.getenv('VERSIONS_DB', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'versions.db'))
+VERSIONS_PER_FILE = int(os.getenv('VERSIONS_PER_FILE', '100'))
+VERSIONS_MAX_BYTES = int(os.getenv('VERSIONS_MAX_BYTES', str(512 * 1024 * 1024)))
+VERSIONS_MAX_FILE_SIZE = int(os.getenv('VERSIONS_MAX_FILE_SIZE', str(10 * 1024 * 1024)))
+VERSIONS_GC_INTERVAL = int(os.getenv('VERSIONS_GC_INTERVAL', '3600'))
+
+# Result cache settings, CACHE_RULES lists the scripts whose results are cached, an empty RESULT_CACHE_DB turns it off
+CACHE_RULES = os.getenv('CACHE_RULES', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache_rules.json'))
+RESULT_CACHE_DB = os.getenv('RESULT_CACHE_DB', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'result_cache.db'))
+RESULT_CACHE_MAX_ENTRIES = int(os.getenv('RESULT_CACHE_MAX_ENTRIES', '1000'))
+RESULT_CACHE_MAX_BYTES = int(os.getenv('RESULT_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+
+# Scheduler settings, an empty SCHEDULE_DB turns it off
+SCHEDULE_DB = os.getenv('SCHEDULE_DB', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'schedules.db'))
+SCHEDULER_MAX_RUNNING = int(os.getenv('SCHEDULER_MAX_RUNNING', '4'))
+
+# Script resource limits, empty means unlimited, RESOURCE_PROFILES overrides them per script
+DEFAULT_RESOURCE_PROFILE = {
+    'cpu_time': os.getenv('SCRIPT_CPU_TIME', ''),
+    'memory': os.getenv('SCRIPT_MEMORY_LIMIT', ''),
+    'nproc': os.getenv('SCRIPT_NPROC_LIMIT', ''),
+    'nofile': os.getenv('SCRIPT_NOFILE_LIMIT', ''),
+    'nice': os.getenv('SCRIPT_NICE', ''),
+    'ionice': os.getenv('SCRIPT_IONICE', ''),
+    'cgroup_memory_max': os.getenv('SCRIPT_CGROUP_MEMORY_MAX', ''),
+    'cgroup_cpu_max': os.getenv('SCRIPT_CGROUP_CPU_MAX', '')
+}
+SCRIPT_CGROUP = os.getenv('SCRIPT_CGROUP', '')
+# Scripts are forked by a small helper process instead of the server worker
+SCRIPT_SPAWNER = os.getenv('SCRIPT_SPAWNER', 'true').lower() == 'true'
+RESOURCE_PROFILES = os.getenv('RESOURCE_PROFILES', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'resource_profiles.json'))
+
+# Editor settings, bigger files open in a read only viewer that loads them in windows
+EDITOR_INLINE_LIMIT = int(os.getenv('EDITOR_INLINE_LIMIT', str(1024 * 1024)))
+FILE_CHUNK_SIZE = 1024 * 1024
+LINE_INDEX_STEP = 64 * 1024
+FILE_LINE_LIMIT = 65536
+
+# Content search settings, an empty SEARCH_DB turns it off
+SEARCH_DB = os.getenv('SEARCH_DB', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'search.db'))
+SEARCH_MAX_FILE_SIZE = int(os.getenv('SEARCH_MAX_FILE_SIZE', str(1024 * 1024)))
+SEARCH_SYNC_INTERVAL = float(os.getenv('SEARCH_SYNC_INTERVAL', '60'))
+
+# HTTP settings, smaller bodies are sent uncompressed
+COMPRESS_MIN_SIZE = int(os.getenv('COMPRESS_MIN_SIZE', '1024'))
+COMPRESS_LEVEL = 6
+COMPRESS_MIMETYPES = ('application/json', 'text/html', 'text/plain', 'text/css', 'application/javascript')
+
+# Metrics settings, an empty PROFILE_DIR turns request profiling off
+METRICS_FLUSH_INTERVAL = float(os.getenv('METRICS_FLUSH_INTERVAL', '5'))
+PROFILE_DIR = os.getenv('PROFILE_DIR', '')
+PROFILE_INTERVAL = float(os.getenv('PROFILE_INTERVAL', '0.005'))
+
+CONFIG_EXTENSIONS = ('.conf', '.cfg', '.ini', '.env', '.yaml', '.yml', '.json')
+
 # Custom Jinja2 filter for datetime formatting
 @app.template_filter('datetime')
 def datetime_filter(timestamp, format='%Y-%m-%d %H:%M'):
     """Convert timestamp to formatted datetime string"""
     return datetime.fromtimestamp(timestamp).strftime(format)
 
-def get_all_files():
-    """Get all files from the script directory"""
+class Metrics:
+    """Counters, histograms and gauges served at /metrics in the Prometheus text format.
+    
+    Every worker process counts its own requests and commands. With a
+    STATE_DB each one writes its values there every METRICS_FLUSH_INTERVAL
+    and a scrape of any worker adds up those of all of them. The counts of
+    workers that exited are kept under pid 0 so totals never go down.
+    """
+    
+    # Seconds, from a cached poll to a slow git push
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.kinds = {}
+        self.values = {}
+        self.collectors = {}
+        self.flusher = None
+    
+    def define(self, kind, name, help, collect=None):
+        """Declare a metric, `collect` reads a gauge at scrape time as a number or [(labels, value)]"""
+        self.kinds[name] = (kind, help)
+        if collect:
+            self.collectors[name] = collect
+    
+    @staticmethod
+    def label_text(labels):
+        """Labels as they appear between the braces, also the key of a series"""
+        escape = lambda value: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        return ','.join(f'{key}="{escape(value)}"' for key, value in sorted(labels.items()))
+    
+    def inc(self, name, amount=1, **labels):
+        """Add to a counter, or to a gauge that is not collected"""
+        key = self.label_text(labels)
+        with self.lock:
+            series = self.values.setdefault(name, {})
+            series[key] = series.get(key, 0) + amount
+    
+    def observe(self, name, value, **labels):
+        """Record one value in a histogram"""
+        key = self.label_text(labels)
+        bucket = bisect.bisect_left(self.BUCKETS, value)
+        with self.lock:
+            series = self.values.setdefault(name, {})
+            # A count per bucket, +Inf last, then the sum
+            counts = series.get(key)
+            if counts is None:
+                counts = series[key] = [0] * (len(self.BUCKETS) + 2)
+            counts[bucket] += 1
+            counts[-1] += value
+    
+    def collect(self):
+        """This worker's values, {name: {labels: value}} with the gauges read now"""
+        with self.lock:
+            values = {name: {key: list(value) if isinstance(value, list) else value
+                             for key, value in series.items()}
+                      for name, series in self.values.items()}
+        for name, collect in self.collectors.items():
+            try:
+                result = collect()
+            except Exception as e:
+                print(f"Error collecting metric {name}: {e}")
+                continue
+            if not isinstance(result, list):
+                result = [({}, result)]
+            values[name] = {self.label_text(labels): value for labels, value in result}
+        return values
+    
+    def merge(self, snapshots, kinds=None):
+        """Add up the values of several workers, only those of `kinds` if given"""
+        total = {}
+        for values in snapshots:
+            for name, series in values.items():
+                kind = self.kinds.get(name, ('gauge',))[0]
+                if kinds and kind not in kinds:
+                    continue
+                target = total.setdefault(name, {})
+                for key, value in series.items():
+                    current = target.get(key)
+                    if current is None:
+                        target[key] = list(value) if isinstance(value, list) else value
+                    elif isinstance(value, list):
+                        target[key] = [a + b for a, b in zip(current, value)]
+                    else:
+                        target[key] = current + value
+        return total
+    
+    def retire(self, snapshots):
+        """Fold the values of exited workers into one, gauges went with them"""
+        return self.merge(snapshots, kinds=('counter', 'histogram'))
+    
+    def scrape(self):
+        """The text exposition of every worker's metrics"""
+        values = self.collect()
+        if state_store:
+            others = [data for pid, data in state_store.load_metrics(self.retire) if pid != os.getpid()]
+            values = self.merge([values] + others)
+        return self.render(values)
+    
+    def render(self, values):
+        lines = []
+        for name, (kind, help) in self.kinds.items():
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} {kind}')
+            for key, value in sorted(values.get(name, {}).items()):
+                if kind != 'histogram':
+                    lines.append(f'{name}{{{key}}} {value}' if key else f'{name} {value}')
+                    continue
+                prefix = key + ',' if key else ''
+                cumulative = 0
+                for bound, count in zip(self.BUCKETS + ('+Inf',), value):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+                labels = f'{{{key}}}' if key else ''
+                lines.append(f'{name}_sum{labels} {value[-1]}')
+                lines.append(f'{name}_count{labels} {cumulative}')
+        return '\n'.join(lines) + '\n'
+    
+    def start(self):
+        """Start writing this worker's values to the state store"""
+        if state_store and self.flusher is None:
+            self.flusher = threading.Thread(target=self.flush_loop, name='metrics-flusher', daemon=True)
+            self.flusher.start()
+    
+    def flush_loop(self):
+        while True:
+            time.sleep(METRICS_FLUSH_INTERVAL)
+            try:
+                state_store.save_metrics(self.collect())
+            except Exception as e:
+                print(f"Error saving metrics: {e}")
+
+metrics = Metrics()
+metrics.define('histogram', 'script_manager_http_request_duration_seconds',
+               'Time to handle a request, up to the headers for streamed responses')
+metrics.define('gauge', 'script_manager_http_requests_in_flight', 'Requests being handled')
+metrics.define('histogram', 'script_manager_command_duration_seconds',
+               'Run time of git commands, tmux commands and user scripts')
+metrics.define('counter', 'script_manager_commands_total', 'Finished git commands, tmux commands and user scripts')
+metrics.define('counter', 'script_manager_cache_requests_total', 'Cache lookups by cache and hit or miss')
+metrics.define('histogram', 'script_manager_spawn_duration_seconds',
+               'Time to start a script process by launch method: spawner, fork or vfork')
+
+def record_command(command, started, success):
+    """Count a command that ran since time.monotonic() was `started`"""
+    metrics.observe('script_manager_command_duration_seconds', time.monotonic() - started, command=command)
+    metrics.inc('script_manager_commands_total', command=command, result='success' if success else 'failure')
+
+def run_command(args, label, **kwargs):
+    """subprocess.run() recorded in the command metrics under `label`"""
+    started = time.monotonic()
+    result = None
     try:
-        if not os.path.exists(SCRIPT_DIR):
-            os.makedirs(SCRIPT_DIR, exist_ok=True)
+        result = subprocess.run(args, **kwargs)
+        return result
+    finally:
+        record_command(label, started, result is not None and result.returncode == 0)
+
+def record_cache(cache, hit):
+    metrics.inc('script_manager_cache_requests_total', cache=cache, result='hit' if hit else 'miss')
+
+class RequestProfiler:
+    """Samples the stack of one request's thread every PROFILE_INTERVAL.
+    
+    The samples are written in the folded format of flamegraph.pl, which
+    speedscope and most other flame graph viewers also read.
+    """
+    
+    def __init__(self, thread_id):
+        self.thread_id = thread_id
+        self.samples = Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='request-profiler', daemon=True)
+        self.thread.start()
+    
+    def run(self):
+        while not self.stopped.wait(PROFILE_INTERVAL):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                frame = frame.f_back
+            if stack:
+                self.samples[';'.join(reversed(stack))] += 1
+    
+    def finish(self, endpoint):
+        """Stop sampling and write the profile, returns its file name"""
+        self.stopped.set()
+        self.thread.join()
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        name = f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{endpoint}-{uuid.uuid4().hex[:8]}.folded"
+        with open(os.path.join(PROFILE_DIR, name), 'w') as file:
+            for stack, count in self.samples.most_common():
+                file.write(f'{stack} {count}\n')
+        return name
+
+@app.before_request
+def start_request_metrics():
+    g.request_started = time.monotonic()
+    metrics.inc('script_manager_http_requests_in_flight')
+    if PROFILE_DIR and (request.headers.get('X-Profile') or request.args.get('profile')):
+        g.profiler = RequestProfiler(threading.get_ident())
+
+@app.after_request
+def record_request_metrics(response):
+    """Registered first so it runs last, the time includes the other hooks"""
+    endpoint = request.endpoint or 'none'
+    metrics.observe('script_manager_http_request_duration_seconds', time.monotonic() - g.request_started,
+                    endpoint=endpoint, method=request.method, code=response.status_code)
+    profiler = g.pop('profiler', None)
+    if profiler:
+        try:
+            response.headers['X-Profile'] = profiler.finish(endpoint)
+        except OSError as e:
+            print(f"Error writing profile: {e}")
+    return response
+
+@app.teardown_request
+def finish_request_metrics(error):
+    metrics.inc('script_manager_http_requests_in_flight', -1)
+    # Left over when the request failed before a response was made
+    profiler = g.pop('profiler', None)
+    if profiler:
+        profiler.stopped.set()
+
+class Inotify:
+    """Minimal ctypes binding to Linux inotify.
+    
+    Raises OSError when inotify is not available, callers fall back to polling.
+    `callback` is called from a reader thread as (directory, mask, name).
+    """
+    
+    IN_MODIFY = 0x2
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_DELETE_SELF = 0x400
+    IN_MOVE_SELF = 0x800
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ISDIR = 0x40000000
+    WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+                  IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+    EVENT_HEADER = struct.Struct('iIII')
+    
+    def __init__(self, callback):
+        try:
+            self.libc = ctypes.CDLL(None, use_errno=True)
+            init = self.libc.inotify_init1
+        except (OSError, AttributeError):
+            raise OSError("inotify is not available")
+        self.fd = init(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.callback = callback
+        self.watches = {}
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.read_loop, name='inotify', daemon=True)
+        self.thread.start()
+    
+    def add_watch(self, path):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), self.WATCH_MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {path}")
+        with self.lock:
+            self.watches[wd] = path
+        return wd
+    
+    def read_loop(self):
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except OSError as e:
+                print(f"Error reading inotify events: {e}")
+                return
+            offset = 0
+            while offset + self.EVENT_HEADER.size <= len(data):
+                wd, mask, cookie, length = self.EVENT_HEADER.unpack_from(data, offset)
+                offset += self.EVENT_HEADER.size
+                name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+                offset += length
+                with self.lock:
+                    path = self.watches.get(wd)
+                    if mask & self.IN_IGNORED:
+                        self.watches.pop(wd, None)
+                try:
+                    self.callback(path, mask, name)
+                except Exception as e:
+                    print(f"Error handling inotify event: {e}")
+
+class FileIndex:
+    """In-memory, pre-sorted listing of SCRIPT_DIR and its subdirectories.
+    
+    Each directory is read with one os.scandir pass and kept until inotify
+    reports a change in it, then only that directory is scanned again.
+    Without inotify the whole tree is rebuilt when the root mtime changes or
+    the snapshot is older than FILE_INDEX_POLL_INTERVAL.
+    """
+    
+    # Directories that are never listed or watched
+    SKIP_DIRS = ('.git',)
+    
+    def __init__(self, root):
+        self.root = root
+        self.lock = threading.Lock()
+        self.dirs = {}
+        self.files = []
+        self.stats = {}
+        self.sorted_cache = {}
+        self.generation = 0
+        self.dirty = True
+        self.dirty_dirs = set()
+        self.dirty_lock = threading.Lock()
+        self.built_at = 0
+        self.root_mtime = None
+        self.watcher = None
+        self.watching = False
+        self.changed = threading.Event()
+        # Called with the lock held and the changed directories after a
+        # rebuild that found changes, must not block
+        self.listeners = []
+    
+    def start_watching(self):
+        """Set up inotify, returns False when polling is needed"""
+        try:
+            if self.watcher is None:
+                self.watcher = Inotify(self.handle_event)
+                threading.Thread(target=self.rebuild_loop, name='file-index', daemon=True).start()
+            self.watching = True
+        except OSError as e:
+            print(f"File index falling back to polling: {e}")
+            self.watching = False
+        return self.watching
+    
+    def watch(self, path):
+        if not self.watching:
+            return
+        try:
+            self.watcher.add_watch(path)
+        except OSError as e:
+            # Usually fs.inotify.max_user_watches, poll instead of missing changes
+            print(f"File index falling back to polling: {e}")
+            self.watching = False
+    
+    def relpath(self, path):
+        relpath = os.path.relpath(path, self.root)
+        return '' if relpath == '.' else relpath
+    
+    def handle_event(self, path, mask, name):
+        if path is None:
+            return
+        if mask & Inotify.IN_Q_OVERFLOW:
+            self.dirty = True
+        elif mask & (Inotify.IN_IGNORED | Inotify.IN_DELETE_SELF | Inotify.IN_MOVE_SELF):
+            if path == self.root:
+                # The directory itself went away, rebuild and watch it again
+                self.dirty = True
+        else:
+            with self.dirty_lock:
+                self.dirty_dirs.add(self.relpath(path))
+        self.changed.set()
+    
+    def rebuild_loop(self):
+        while True:
+            self.changed.wait()
+            # Let a burst of writes settle into one rebuild
+            time.sleep(FILE_INDEX_DEBOUNCE)
+            self.changed.clear()
+            try:
+                self.snapshot()
+            except Exception as e:
+                print(f"Error rebuilding file index: {e}")
+    
+    def invalidate(self, path=None):
+        """Rescan the directory holding `path` on the next read, or everything"""
+        if path is None:
+            self.dirty = True
+        else:
+            with self.dirty_lock:
+                self.dirty_dirs.add(self.relpath(os.path.dirname(path)))
+    
+    def is_stale(self):
+        if self.dirty or self.dirty_dirs:
+            return True
+        if self.watching:
+            return False
+        # Polling: rebuild on root changes or once the snapshot is old
+        try:
+            root_mtime = os.stat(self.root).st_mtime_ns
+        except OSError:
+            return True
+        return root_mtime != self.root_mtime or time.time() - self.built_at > FILE_INDEX_POLL_INTERVAL
+    
+    def refresh(self):
+        """Bring the index up to date, must hold self.lock"""
+        stale = self.is_stale()
+        record_cache('file_index', not stale)
+        if not stale:
+            return
+        with self.dirty_lock:
+            dirty_dirs, self.dirty_dirs = self.dirty_dirs, set()
+        previous = dict(self.dirs)
+        if self.dirty or not self.watching:
+            self.dirty = False
+            if not os.path.exists(self.root):
+                os.makedirs(self.root, exist_ok=True)
+            self.start_watching()
+            self.dirs = {}
+            self.scan_tree('')
+        else:
+            # Parents first, so a removed directory is dropped before its children
+            for relpath in sorted(dirty_dirs, key=len):
+                parent = os.path.dirname(relpath)
+                if relpath == '' or relpath in self.dirs or parent in self.dirs:
+                    self.scan_tree(relpath)
+        self.update_totals()
+        
+        changed = sorted(relpath for relpath in previous.keys() | self.dirs.keys()
+                         if previous.get(relpath) != self.dirs.get(relpath))
+        # The first build is not a change
+        if changed and previous:
+            for listener in self.listeners:
+                listener(changed)
+    
+    def scan_tree(self, relpath):
+        """Scan a directory, then any subdirectory the index does not know yet"""
+        pending = [relpath]
+        while pending:
+            relpath = pending.pop()
+            for subdir in self.scan_dir(relpath):
+                if subdir not in self.dirs:
+                    pending.append(subdir)
+    
+    def scan_dir(self, relpath):
+        """Read one directory into the index, returns its subdirectories"""
+        abspath = os.path.join(self.root, relpath) if relpath else self.root
+        entries = []
+        subdirs = []
+        try:
+            with os.scandir(abspath) as it:
+                for entry in it:
+                    child = os.path.join(relpath, entry.name)
+                    if entry.is_dir(follow_symlinks=False):
+                        if entry.name in self.SKIP_DIRS:
+                            continue
+                        subdirs.append(child)
+                        entries.append({
+                            'type': 'dir',
+                            'name': entry.name,
+                            'relpath': child,
+                            'path': entry.path,
+                            'size': 0,
+                            'modified': entry.stat(follow_symlinks=False).st_mtime
+                        })
+                    elif entry.is_file():
+                        # DirEntry caches the stat result, one call covers size, mtime and mode
+                        info = entry.stat()
+                        entries.append({
+                            'type': 'file',
+                            'name': entry.name,
+                            'relpath': child,
+                            'path': entry.path,
+                            'size': info.st_size,
+                            'modified': info.st_mtime,
+                            'mode': info.st_mode,
+                            'is_executable': entry.name.endswith('.sh'),
+                            'extension': os.path.splitext(entry.name)[1].lower()
+                        })
+        except (FileNotFoundError, NotADirectoryError):
+            self.drop_tree(relpath)
             return []
         
-        files = []
-        for item in os.listdir(SCRIPT_DIR):
-            item_path = os.path.join(SCRIPT_DIR, item)
-            if os.path.isfile(item_path):
-                file_info = {
-                    'name': item,
-                    'path': item_path,
-                    'size': os.path.getsize(item_path),
-                    'modified': os.path.getmtime(item_path),
-                    'is_executable': item.endswith('.sh'),
-                    'extension': os.path.splitext(item)[1].lower()
-                }
-                files.append(file_info)
-        
-        # Sort files by name
-        files.sort(key=lambda x: x['name'].lower())
-        return files
+        # Forget subdirectories that disappeared since the last scan
+        for entry in self.dirs.get(relpath, []):
+            if entry['type'] == 'dir' and entry['relpath'] not in subdirs:
+                self.drop_tree(entry['relpath'])
+        self.dirs[relpath] = entries
+        self.watch(abspath)
+        return subdirs
+    
+    def drop_tree(self, relpath):
+        prefix = relpath + os.sep
+        for key in [key for key in self.dirs if key == relpath or key.startswith(prefix)]:
+            del self.dirs[key]
+    
+    def update_totals(self):
+        files = [entry for entries in self.dirs.values() for entry in entries if entry['type'] == 'file']
+        
+        # Sort files by path
+        files.sort(key=lambda x: x['relpath'].lower())
+        
+        recent_file = None
+        if files:
+            most_recent = max(files, key=lambda x: x['modified'])
+            recent_file = {'name': most_recent['relpath'], 'modified': most_recent['modified']}
+        
+        self.files = files
+        self.stats = {
+            'total_scripts': len(files),
+            'executable_scripts': sum(1 for f in files if f['mode'] & (stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)),
+            'shell_scripts': sum(1 for f in files if f['name'].endswith('.sh')),
+            'python_scripts': sum(1 for f in files if f['name'].endswith('.py')),
+            'config_files': sum(1 for f in files if f['name'].endswith(CONFIG_EXTENSIONS)),
+            'total_size_bytes': sum(f['size'] for f in files),
+            'recent_file': recent_file
+        }
+        self.sorted_cache = {}
+        self.generation += 1
+        self.built_at = time.time()
+        try:
+            self.root_mtime = os.stat(self.root).st_mtime_ns
+        except OSError:
+            self.root_mtime = None
+    
+    def snapshot(self):
+        """Get (files, stats) for the whole tree"""
+        with self.lock:
+            self.refresh()
+            return self.files, self.stats
+    
+    def sort_key(self, entry, sort, order):
+        # Folders stay on top whichever way the list is read
+        folder_first = (entry['type'] == 'file') if order == 'asc' else (entry['type'] == 'dir')
+        if sort == 'modified':
+            return (folder_first, entry['modified'], entry['name'])
+        if sort == 'size':
+            return (folder_first, entry['size'], entry['name'])
+        return (folder_first, entry['name'].lower(), entry['name'])
+    
+    def list_dir(self, relpath, sort='name', order='asc', filter_text='', cursor=None, limit=100):
+        """Get one page of a directory listing.
+        
+        Returns (entries, next_cursor, total) or None if the directory is not
+        indexed. The cursor is the sort key of the last entry returned, so
+        pages stay consistent while files are added or removed.
+        """
+        with self.lock:
+            self.refresh()
+            if relpath not in self.dirs:
+                return None
+            cache_key = (relpath, sort, order)
+            if cache_key not in self.sorted_cache:
+                entries = sorted(self.dirs[relpath], key=lambda e: self.sort_key(e, sort, order))
+                keys = [self.sort_key(e, sort, order) for e in entries]
+                self.sorted_cache[cache_key] = (entries, keys)
+            entries, keys = self.sorted_cache[cache_key]
+            
+            if order == 'asc':
+                start = bisect.bisect_right(keys, cursor) if cursor is not None else 0
+                candidates = entries[start:]
+            else:
+                end = bisect.bisect_left(keys, cursor) if cursor is not None else len(entries)
+                candidates = reversed(entries[:end])
+            
+            filter_text = filter_text.lower()
+            page = []
+            for entry in candidates:
+                if filter_text and filter_text not in entry['name'].lower():
+                    continue
+                if len(page) == limit:
+                    break
+                page.append(entry)
+            else:
+                # Ran out of entries, there is no next page
+                return self.tree_entries(page), None, self.count(relpath, filter_text)
+            
+            next_cursor = self.sort_key(page[-1], sort, order) if page else None
+            return self.tree_entries(page), next_cursor, self.count(relpath, filter_text)
+    
+    def count(self, relpath, filter_text):
+        if not filter_text:
+            return len(self.dirs[relpath])
+        return sum(1 for entry in self.dirs[relpath] if filter_text in entry['name'].lower())
+    
+    def tree_entries(self, entries):
+        """Public fields of index entries, paths relative to SCRIPT_DIR"""
+        result = []
+        for entry in entries:
+            item = {
+                'type': entry['type'],
+                'name': entry['name'],
+                'path': entry['relpath'],
+                'size': entry['size'],
+                'modified': entry['modified']
+            }
+            if entry['type'] == 'dir':
+                item['children'] = len(self.dirs.get(entry['relpath'], []))
+            else:
+                item['is_executable'] = entry['is_executable']
+                item['extension'] = entry['extension']
+            result.append(item)
+        return result
+
+file_index = FileIndex(SCRIPT_DIR)
+
+def get_all_files():
+    """Get all files from the script directory and its subdirectories"""
+    try:
+        files, _ = file_index.snapshot()
+        return list(files)
     except Exception as e:
         print(f"Error getting files: {e}")
         return []
 
+def resolve_script_path(filename):
+    """Get the absolute path of a file in SCRIPT_DIR, None if it points outside"""
+    root = os.path.normpath(SCRIPT_DIR)
+    path = os.path.normpath(os.path.join(root, filename))
+    if not path.startswith(root + os.sep):
+        return None
+    return path
+
 def read_file_content(file_path):
     """Read content of a file"""
     try:
-        with open(file_path, 'r', encoding='utf-8') as file:
-            return file.read()
-    except UnicodeDecodeError:
-        # If UTF-8 fails, try with latin-1
-        try:
-            with open(file_path, 'r', encoding='latin-1') as file:
-                return file.read()
-        except Exception as e:
-            return f"Error reading file: {str(e)}"
+        with open(file_path, 'rb') as file:
+            data = file.read()
     except Exception as e:
         return f"Error reading file: {str(e)}"
+    try:
+        return data.decode('utf-8')
+    except UnicodeDecodeError:
+        # If UTF-8 fails, fall back to latin-1 which decodes any bytes
+        return data.decode('latin-1')
+
+file_etags = {}
+file_etags_lock = threading.Lock()
+
+def remember_etag(file_path, st, etag):
+    with file_etags_lock:
+        if len(file_etags) >= 256:
+            file_etags.pop(next(iter(file_etags)))
+        file_etags[(file_path, st.st_ino, st.st_size, st.st_mtime_ns)] = etag
 
-def write_file_content(file_path, content):
-    """Write content to a file"""
+def file_etag(file_path):
+    """Content hash of a file, cached while its inode, size and mtime stay the same"""
+    return stat_etag(file_path, os.stat(file_path))
+
+def stat_etag(file_path, st, file=None):
+    """Content hash of the version of a file `st` describes, read from `file` when it is open already"""
+    with file_etags_lock:
+        etag = file_etags.get((file_path, st.st_ino, st.st_size, st.st_mtime_ns))
+    record_cache('file_etag', etag is not None)
+    if etag is None:
+        digest = hashlib.sha256()
+        with open(file_path, 'rb') if file is None else contextlib.nullcontext(file) as source:
+            source.seek(0)
+            for chunk in iter(lambda: source.read(FILE_CHUNK_SIZE), b''):
+                digest.update(chunk)
+        etag = digest.hexdigest()[:32]
+        remember_etag(file_path, st, etag)
+    return etag
+
+def acquire_save_lock():
+    """Lock held while a save checks its precondition and replaces the file"""
+    lock_file = open(os.path.join(tempfile.gettempdir(), 'script-manager-save.lock'), 'a')
+    fcntl.flock(lock_file, fcntl.LOCK_EX)
+    return lock_file
+
+def replace_file(file_path, chunks, expected_etags=None, source='save'):
+    """Atomically replace a file with the given chunks of bytes.
+    
+    The chunks go to a temporary file next to the target which is synced to
+    disk and renamed over it, so a crash leaves either the old or the new
+    file. With `expected_etags` the file is only replaced while its etag is
+    one of them. The new content is recorded in the version store under
+    `source`.
+    
+    Returns ('saved', etag), ('conflict', current_etag) or ('error', message).
+    """
+    temp_path = os.path.join(os.path.dirname(file_path), f'.{os.path.basename(file_path)}.{uuid.uuid4().hex}.tmp')
+    previous = None
     try:
-        with open(file_path, 'w', encoding='utf-8') as file:
-            file.write(content)
-        return True
+        digest = hashlib.sha256()
+        with open(temp_path, 'wb') as file:
+            for chunk in chunks:
+                digest.update(chunk)
+                file.write(chunk)
+            file.flush()
+            os.fsync(file.fileno())
+        
+        lock_file = acquire_save_lock()
+        try:
+            exists = os.path.exists(file_path)
+            if expected_etags is not None:
+                current = file_etag(file_path) if exists else None
+                if current not in expected_etags:
+                    os.remove(temp_path)
+                    return 'conflict', current
+            if exists:
+                shutil.copymode(file_path, temp_path)
+                if version_store is not None:
+                    # Still reads the old content after the rename, it is
+                    # recorded once the lock is released
+                    previous = open(file_path, 'rb')
+            os.replace(temp_path, file_path)
+        finally:
+            lock_file.close()
+        if previous is not None:
+            version_file(file_path, 'external', previous)
+        
+        # Make the rename itself durable
+        dir_fd = os.open(os.path.dirname(file_path), os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+        etag = digest.hexdigest()[:32]
+        remember_etag(file_path, os.stat(file_path), etag)
+        file_index.invalidate(file_path)
+        index_file(file_path)
+        version_file(file_path, source)
+        return 'saved', etag
     except Exception as e:
         print(f"Error writing file: {e}")
-        return False
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        return 'error', str(e)
+    finally:
+        if previous is not None:
+            previous.close()
+
+def write_file_content(file_path, content, expected_etags=None):
+    """Write content to a file, see replace_file()"""
+    return replace_file(file_path, [content.encode('utf-8')], expected_etags)
+
+def write_file_stream(file_path, stream, expected_etags=None):
+    """Write a file from a stream a chunk at a time, see replace_file()"""
+    return replace_file(file_path, iter(lambda: stream.read(FILE_CHUNK_SIZE), b''), expected_etags)
+
+def patch_file(file_path, edits, expected_etag):
+    """Apply byte range edits to the version of a file with `expected_etag`.
+    
+    Each edit replaces the bytes from `start` to `end` of that version with
+    `text`. Unchanged parts are copied on disk, so only the edits need to be
+    sent. Returns the same as replace_file() and raises ValueError for edits
+    that overlap or fall outside the file.
+    """
+    source = open(file_path, 'rb')
+    try:
+        # The open handle keeps reading this version even if the file is replaced,
+        # replace_file() checks again that it is still the current one
+        st = os.fstat(source.fileno())
+        etag = stat_etag(file_path, st, source)
+        if etag != expected_etag:
+            return 'conflict', etag
+        size = st.st_size
+        position = 0
+        ranges = []
+        for edit in sorted(edits, key=lambda edit: edit['start']):
+            start, end = int(edit['start']), int(edit['end'])
+            if not position <= start <= end <= size:
+                raise ValueError("Edits must not overlap and must stay inside the file")
+            ranges.append((start, end, str(edit.get('text', '')).encode('utf-8')))
+            position = end
+        
+        def chunks():
+            position = 0
+            for start, end, text in ranges + [(size, size, b'')]:
+                source.seek(position)
+                remaining = start - position
+                while remaining:
+                    chunk = source.read(min(remaining, FILE_CHUNK_SIZE))
+                    if not chunk:
+                        break
+                    remaining -= len(chunk)
+                    yield chunk
+                yield text
+                position = end
+        
+        return replace_file(file_path, chunks(), {expected_etag})
+    finally:
+        source.close()
 
 def delete_file(file_path):
     """Delete a file"""
     try:
         if os.path.exists(file_path) and os.path.isfile(file_path):
             os.remove(file_path)
+            file_index.invalidate(file_path)
+            index_file(file_path)
+            version_file(file_path, 'delete')
             return True
         return False
     except Exception as e:
         print(f"Error deleting file: {e}")
         return False
 
-def execute_script(script_path):
-    """Execute a shell script and return the result"""
+class LineIndex:
+    """Line numbers at fixed byte offsets of a file.
+    
+    Records how many lines start before every LINE_INDEX_STEP bytes so that
+    a window of lines is found by scanning at most one step, whatever the
+    size of the file.
+    """
+    
+    def __init__(self, mm):
+        self.offsets = []
+        self.line_numbers = []
+        lines = 0
+        for offset in range(0, len(mm), LINE_INDEX_STEP):
+            self.offsets.append(offset)
+            self.line_numbers.append(lines)
+            lines += mm[offset:offset + LINE_INDEX_STEP].count(b'\n')
+        # A last line without a newline still counts
+        self.total_lines = lines + (1 if len(mm) and mm[-1:] != b'\n' else 0)
+    
+    def find_line(self, mm, line):
+        """Get the byte offset where `line` starts"""
+        chunk = max(bisect.bisect_right(self.line_numbers, line) - 1, 0)
+        current = self.line_numbers[chunk]
+        # A chunk may begin in the middle of the line it is numbered with
+        position = mm.rfind(b'\n', 0, self.offsets[chunk]) + 1
+        while current < line:
+            end = mm.find(b'\n', position)
+            if end == -1:
+                return len(mm)
+            position = end + 1
+            current += 1
+        return position
+
+line_indexes = {}
+line_indexes_lock = threading.Lock()
+
+def open_file_window(file_path):
+    """Memory-map a file and get its cached line index.
+    
+    Returns (mm, index, size), mm is None for an empty file. The caller
+    closes the map.
+    """
+    st = os.stat(file_path)
+    if st.st_size == 0:
+        return None, None, 0
+    with open(file_path, 'rb') as file:
+        mm = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    key = (file_path, st.st_ino, st.st_size, st.st_mtime_ns)
+    with line_indexes_lock:
+        index = line_indexes.get(key)
+    record_cache('line_index', index is not None)
+    if index is None:
+        index = LineIndex(mm)
+        with line_indexes_lock:
+            # Only a few big files are viewed at a time
+            if len(line_indexes) >= 16:
+                line_indexes.pop(next(iter(line_indexes)))
+            line_indexes[key] = index
+    return mm, index, st.st_size
+
+def read_file_lines(file_path, start, count):
+    """Read a window of lines from a file of any size"""
+    mm, index, size = open_file_window(file_path)
+    if mm is None:
+        return {'start': start, 'lines': [], 'total_lines': 0, 'size': 0, 'truncated': []}
     try:
-        # Check if the script exists and is executable
-        if not os.path.isfile(script_path):
-            return False, "Script file not found"
+        position = index.find_line(mm, start)
+        lines, truncated = [], []
+        while len(lines) < count and position < size:
+            end = mm.find(b'\n', position)
+            if end == -1:
+                end = size
+            if end - position > FILE_LINE_LIMIT:
+                truncated.append(start + len(lines))
+            lines.append(mm[position:min(end, position + FILE_LINE_LIMIT)].decode('utf-8', errors='replace'))
+            position = end + 1
+        return {'start': start, 'lines': lines, 'total_lines': index.total_lines, 'size': size, 'truncated': truncated}
+    finally:
+        mm.close()
+
+def read_file_preview(file_path, length):
+    """Read the first and last `length` bytes of a file, cut at line breaks"""
+    mm, index, size = open_file_window(file_path)
+    if mm is None:
+        return {'size': 0, 'total_lines': 0, 'head': '', 'tail': '', 'complete': True}
+    try:
+        if size <= length * 2:
+            return {'size': size, 'total_lines': index.total_lines, 'complete': True,
+                    'head': mm[:].decode('utf-8', errors='replace'), 'tail': ''}
+        head_end = mm.rfind(b'\n', 0, length) + 1 or length
+        tail_start = mm.find(b'\n', size - length) + 1 or size - length
+        return {
+            'size': size,
+            'total_lines': index.total_lines,
+            'complete': False,
+            'head': mm[:head_end].decode('utf-8', errors='replace'),
+            'tail': mm[tail_start:].decode('utf-8', errors='replace')
+        }
+    finally:
+        mm.close()
+
+class SQLiteStore:
+    """Base of the app's SQLite databases, with one connection per thread.
+    
+    Subclasses give their SCHEMA and can change the PRAGMAS run on each new
+    connection or extend setup() to migrate an existing database.
+    """
+    
+    SCHEMA = ''
+    PRAGMAS = ('journal_mode=WAL', 'synchronous=NORMAL')
+    
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+    
+    def connection(self):
+        """Get this thread's connection, sqlite3 connections are not shared"""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            for pragma in self.PRAGMAS:
+                conn.execute(f'PRAGMA {pragma}')
+            conn.executescript(self.SCHEMA)
+            self.setup(conn)
+            self.local.conn = conn
+        return conn
+    
+    def setup(self, conn):
+        """Called once for each new connection after the schema is created"""
+
+def flock_leader(path):
+    """Wait to become the one worker holding the lock on `path`.
+    
+    Returns the open lock file, the lock is held until it is closed or the
+    worker exits, at which point a waiting worker takes over.
+    """
+    lock_file = open(path, 'a')
+    fcntl.flock(lock_file, fcntl.LOCK_EX)
+    return lock_file
+
+class SearchIndex(SQLiteStore):
+    """Full-text index of the files in SCRIPT_DIR.
+    
+    Contents are kept in an SQLite FTS5 table with the trigram tokenizer, so
+    any substring of three or more characters is found through the index.
+    Regular expressions are narrowed down to the files holding the literals
+    every match needs and only those are matched. Saves and deletes update
+    the index straight away, one worker, the holder of a file lock, syncs it
+    with the file index for changes made outside the app.
+    """
+    
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS documents (
+            id INTEGER PRIMARY KEY,
+            path TEXT NOT NULL UNIQUE,
+            size INTEGER NOT NULL,
+            modified REAL NOT NULL
+        );
+        CREATE VIRTUAL TABLE IF NOT EXISTS contents USING fts5(path, body, tokenize='trigram');
+    '''
+    # Matches in the path rank above matches in the contents
+    RANK = 'bm25(contents, 10.0, 1.0)'
+    # Ranking reads every match, queries matching more files keep index order
+    RANK_LIMIT = 1000
+    SYNC_BATCH = 500
+    REGEX_BATCH = 200
+    # Most candidate files one regular expression search will match
+    REGEX_CANDIDATES = 2000
+    SNIPPETS = 3
+    SNIPPET_WIDTH = 160
+    
+    def __init__(self, path, root):
+        super().__init__(path)
+        self.root = root
+        self.lock_file = None
+        self.changed = threading.Event()
+    
+    def read_body(self, file_path, size):
+        """Text to index for a file, nothing for big or binary files"""
+        if size > SEARCH_MAX_FILE_SIZE:
+            return ''
+        with open(file_path, 'rb') as file:
+            data = file.read(SEARCH_MAX_FILE_SIZE)
+        if b'\0' in data[:8192]:
+            return ''
+        return data.decode('utf-8', errors='replace')
+    
+    def store(self, conn, relpath, size, modified, body):
+        row = conn.execute('SELECT id FROM documents WHERE path = ?', (relpath,)).fetchone()
+        if row:
+            doc_id = row[0]
+            conn.execute('UPDATE documents SET size = ?, modified = ? WHERE id = ?', (size, modified, doc_id))
+            conn.execute('DELETE FROM contents WHERE rowid = ?', (doc_id,))
+        else:
+            doc_id = conn.execute('INSERT INTO documents (path, size, modified) VALUES (?, ?, ?)',
+                                  (relpath, size, modified)).lastrowid
+        conn.execute('INSERT INTO contents (rowid, path, body) VALUES (?, ?, ?)', (doc_id, relpath, body))
+    
+    def discard(self, conn, relpath):
+        row = conn.execute('SELECT id FROM documents WHERE path = ?', (relpath,)).fetchone()
+        if row:
+            conn.execute('DELETE FROM documents WHERE id = ?', (row[0],))
+            conn.execute('DELETE FROM contents WHERE rowid = ?', (row[0],))
+    
+    def apply(self, relpaths):
+        """Index the current state of files given relative to the root"""
+        updates = []
+        for relpath in relpaths:
+            file_path = os.path.join(self.root, relpath)
+            try:
+                info = os.stat(file_path)
+                updates.append((relpath, info, self.read_body(file_path, info.st_size)))
+            except (FileNotFoundError, NotADirectoryError):
+                updates.append((relpath, None, None))
+            except OSError as e:
+                print(f"Error indexing {relpath}: {e}")
         
-        if not os.access(script_path, os.X_OK):
-            # Try to make it executable
-            os.chmod(script_path, 0o755)
+        conn = self.connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            for relpath, info, body in updates:
+                if info is None:
+                    self.discard(conn, relpath)
+                else:
+                    self.store(conn, relpath, info.st_size, info.st_mtime, body)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+    
+    def sync(self, files):
+        """Bring the index in line with a file index listing, returns the paths changed"""
+        current = {entry['relpath']: (entry['size'], entry['modified']) for entry in files}
+        known = {row[0]: (row[1], row[2]) for row in self.connection().execute(
+            'SELECT path, size, modified FROM documents')}
+        changed = [relpath for relpath, state in current.items() if known.get(relpath) != state]
+        changed += [relpath for relpath in known if relpath not in current]
+        # Small transactions so saves are not held up by a big reindex
+        for start in range(0, len(changed), self.SYNC_BATCH):
+            self.apply(changed[start:start + self.SYNC_BATCH])
+        return changed
+    
+    def start(self):
+        file_index.listeners.append(lambda dirs: self.changed.set())
+        threading.Thread(target=self.run, name='search-index', daemon=True).start()
+    
+    def run(self):
+        # Only one worker syncs the index
+        self.lock_file = flock_leader(self.path + '.lock')
+        generation = None
+        while True:
+            self.changed.clear()
+            try:
+                # Also brings a polling file index up to date
+                files, _ = file_index.snapshot()
+                if file_index.generation != generation:
+                    generation = file_index.generation
+                    self.sync(files)
+            except Exception as e:
+                print(f"Error syncing search index: {e}")
+            self.changed.wait(SEARCH_SYNC_INTERVAL)
+            # Let a burst of changes settle into one sync
+            time.sleep(FILE_INDEX_DEBOUNCE)
+    
+    def phrase(self, text):
+        return '"' + text.replace('"', '""') + '"'
+    
+    def required_literals(self, pattern):
+        """Literal strings that every match of a regular expression contains"""
+        literals = []
         
-        # Execute the script
-        process = subprocess.Popen([script_path], 
-                                   stdout=subprocess.PIPE, 
-                                   stderr=subprocess.PIPE)
-        stdout, stderr = process.communicate()
+        def walk(items):
+            run = []
+            for op, value in items:
+                if op is regex_parser.LITERAL:
+                    run.append(chr(value))
+                    continue
+                if op is regex_parser.AT:
+                    # Anchors match no characters
+                    continue
+                literals.append(''.join(run))
+                run = []
+                if op is regex_parser.SUBPATTERN:
+                    walk(value[-1])
+                elif op in (regex_parser.MAX_REPEAT, regex_parser.MIN_REPEAT) and value[0] >= 1:
+                    walk(value[2])
+            literals.append(''.join(run))
         
-        if process.returncode == 0:
-            return True, "Script executed successfully"
-        else:
-            return False, f"Script execution failed: {stderr.decode('utf-8')}"
-    except Exception as e:
-        return False, f"Error executing script: {str(e)}"
-
-def get_tmux_sessions():
-    """Get all running tmux sessions"""
-    try:
-        result = subprocess.run(['tmux', 'list-sessions'], 
-                               stdout=subprocess.PIPE, 
-                               stderr=subprocess.PIPE, 
-                               text=True)
+        walk(regex_parser.parse(pattern))
+        # Binary files are not indexed, a NUL can never be found
+        pieces = [piece for literal in literals for piece in literal.split('\0')]
+        return [piece for piece in pieces if len(piece) >= 3]
+    
+    def snippets(self, body, pattern):
+        """Up to SNIPPETS matching lines with the ranges that matched"""
+        lines = []
+        for match in pattern.finditer(body):
+            start, end = match.span()
+            if start == end:
+                continue
+            line_start = body.rfind('\n', 0, start) + 1
+            line_end = body.find('\n', start)
+            if line_end == -1:
+                line_end = len(body)
+            match_range = (start - line_start, min(end, line_end) - line_start)
+            if lines and lines[-1][0] == line_start:
+                lines[-1][2].append(match_range)
+                continue
+            if len(lines) == self.SNIPPETS:
+                break
+            lines.append((line_start, line_end, [match_range]))
         
-        if result.returncode != 0:
-            return []
+        snippets = []
+        line_number, position = 1, 0
+        for line_start, line_end, ranges in lines:
+            line_number += body.count('\n', position, line_start)
+            position = line_start
+            text = body[line_start:line_end]
+            # Long lines are cut down to a window around the first match
+            offset = max(0, min(ranges[0][0] - self.SNIPPET_WIDTH // 4, len(text) - self.SNIPPET_WIDTH))
+            text = text[offset:offset + self.SNIPPET_WIDTH]
+            snippets.append({
+                'line': line_number,
+                'text': text,
+                'matches': [[start - offset, min(end - offset, len(text))]
+                            for start, end in ranges if start - offset < len(text)]
+            })
+        return snippets
+    
+    def matching_ids(self, match, count):
+        """Ids of up to `count` files matching an FTS5 query, best first when ranked"""
+        conn = self.connection()
+        ids = [row[0] for row in conn.execute('SELECT rowid FROM contents WHERE contents MATCH ? LIMIT ?',
+                                              (match, max(count, self.RANK_LIMIT + 1)))]
+        if len(ids) <= self.RANK_LIMIT:
+            # bm25() counts every match on its first call, so it is left out above
+            ids = [row[0] for row in conn.execute(
+                f'SELECT rowid FROM contents WHERE contents MATCH ? ORDER BY {self.RANK} LIMIT ?', (match, count))]
+        return ids[:count]
+    
+    def documents(self, ids):
+        """Get (path, size, modified, body) of files by id, in the order given"""
+        rows = self.connection().execute(f'''
+            SELECT documents.id, documents.path, documents.size, documents.modified, contents.body
+            FROM documents JOIN contents ON contents.rowid = documents.id
+            WHERE documents.id IN ({', '.join('?' * len(ids))})''', ids).fetchall()
+        by_id = {row[0]: row[1:] for row in rows}
+        return [by_id[doc_id] for doc_id in ids if doc_id in by_id]
+    
+    def result(self, row, pattern):
+        path, size, modified, body = row
+        return {'path': path, 'size': size, 'modified': modified, 'snippets': self.snippets(body, pattern)}
+    
+    def search(self, query, regex=False, offset=0, limit=20):
+        """Find files by contents or path, best matches first when they are few enough to rank.
         
-        sessions = []
-        for line in result.stdout.strip().split('\n'):
-            if line:
-                # Parse session name (everything before the first colon)
-                name = line.split(':')[0]
-                sessions.append({
-                    'name': name,
-                    'full_info': line
-                })
-        return sessions
-    except Exception as e:
-        print(f"Error getting tmux sessions: {e}")
-        return []
+        Returns (results, more). Raises ValueError for queries the index
+        cannot answer.
+        """
+        if not regex:
+            if len(query) < 3:
+                raise ValueError("Search for at least 3 characters")
+            if '\0' in query:
+                return [], False
+            pattern = re.compile(re.escape(query), re.IGNORECASE)
+            ids = self.matching_ids(self.phrase(query), offset + limit + 1)
+            rows = self.documents(ids[offset:offset + limit])
+            return [self.result(row, pattern) for row in rows], len(ids) > offset + limit
+        
+        try:
+            pattern = re.compile(query, re.MULTILINE)
+            literals = self.required_literals(query)
+        except (re.error, RecursionError) as e:
+            raise ValueError(f"Invalid regular expression: {e}")
+        if not literals:
+            raise ValueError("The regular expression needs a literal part of at least 3 characters")
+        # The index only narrows the files down, each candidate is matched for real
+        ids = self.matching_ids(' AND '.join(self.phrase(literal) for literal in literals), self.REGEX_CANDIDATES + 1)
+        results = []
+        for start in range(0, min(len(ids), self.REGEX_CANDIDATES), self.REGEX_BATCH):
+            for row in self.documents(ids[start:start + self.REGEX_BATCH]):
+                if pattern.search(row[3]) or pattern.search(row[0]):
+                    results.append(row)
+            if len(results) > offset + limit:
+                break
+        page = [self.result(row, pattern) for row in results[offset:offset + limit]]
+        return page, len(results) > offset + limit or len(ids) > self.REGEX_CANDIDATES
 
-def kill_tmux_session(session_name):
-    """Kill a specific tmux session"""
-    try:
-        result = subprocess.run(['tmux', 'kill-session', '-t', session_name], 
-                                stdout=subprocess.PIPE, 
-                                stderr=subprocess.PIPE)
-        return result.returncode == 0
-    except Exception as e:
-        print(f"Error killing tmux session: {e}")
-        return False
+search_index = SearchIndex(SEARCH_DB, SCRIPT_DIR) if SEARCH_DB else None
 
-def get_tmux_session_output(session_name, window=0, pane=0):
-    """Get the current output from a tmux session"""
+def index_file(file_path):
+    """Update the search index for a saved or deleted file, errors are logged and otherwise ignored"""
+    if search_index is None:
+        return
     try:
-        result = subprocess.run(
-            ['tmux', 'capture-pane', '-p', '-t', f'{session_name}:{window}.{pane}'],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True
-        )
-        if result.returncode == 0:
-            return result.stdout
-        return "Error capturing output"
+        search_index.apply([os.path.relpath(file_path, SCRIPT_DIR)])
     except Exception as e:
-        return f"Error: {str(e)}"
+        print(f"Error indexing {file_path}: {e}")
 
-# Git helper functions
-def is_git_repo():
-    """Check if the script directory is a git repository"""
-    try:
-        if not os.path.exists(SCRIPT_DIR):
+class StateStore(SQLiteStore):
+    """Job and git task records shared between server worker processes.
+    
+    Every worker runs its own jobs but writes their state and output here,
+    a SQLite database in WAL mode, so that any worker can answer a status,
+    stream or cancel request for them.
+    """
+    
+    ACTIVE_STATES = ('queued', 'running')
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS tasks (
+            id TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            state TEXT NOT NULL,
+            owner INTEGER NOT NULL,
+            cancel_requested INTEGER NOT NULL DEFAULT 0,
+            output_total INTEGER NOT NULL DEFAULT 0,
+            finished REAL,
+            record TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS tasks_kind_state ON tasks (kind, state);
+        CREATE TABLE IF NOT EXISTS task_output (
+            task_id TEXT NOT NULL,
+            seq INTEGER NOT NULL,
+            line TEXT NOT NULL,
+            PRIMARY KEY (task_id, seq)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS metrics (
+            pid INTEGER PRIMARY KEY,
+            updated REAL NOT NULL,
+            data TEXT NOT NULL
+        );
+    '''
+    
+    def __init__(self, path):
+        super().__init__(path)
+        self.reap_orphans()
+    
+    def save(self, kind, record):
+        """Insert or update a task record, the output buffer is not stored"""
+        data = json.dumps({key: value for key, value in record.items() if key != 'output'})
+        self.connection().execute(
+            '''INSERT INTO tasks (id, kind, state, owner, finished, record)
+               VALUES (?, ?, ?, ?, ?, ?)
+               ON CONFLICT (id) DO UPDATE SET
+                   state = excluded.state, finished = excluded.finished, record = excluded.record''',
+            (record['id'], kind, record['state'], os.getpid(), record.get('finished'), data))
+    
+    def load(self, kind, task_id):
+        row = self.connection().execute(
+            'SELECT record FROM tasks WHERE id = ? AND kind = ?', (task_id, kind)).fetchone()
+        return json.loads(row[0]) if row else None
+    
+    def active(self, kind):
+        """Get the queued and running records of every worker"""
+        rows = self.connection().execute(
+            'SELECT record FROM tasks WHERE kind = ? AND state IN (?, ?)', (kind, *self.ACTIVE_STATES))
+        return [json.loads(row[0]) for row in rows]
+    
+    def records(self, kind):
+        """Get every record of a kind, finished or not"""
+        rows = self.connection().execute('SELECT record FROM tasks WHERE kind = ?', (kind,))
+        return [json.loads(row[0]) for row in rows]
+    
+    def progress(self, kind):
+        """Get (record, output_total) of the queued and running tasks of every worker"""
+        rows = self.connection().execute(
+            'SELECT record, output_total FROM tasks WHERE kind = ? AND state IN (?, ?)', (kind, *self.ACTIVE_STATES))
+        return [(json.loads(row[0]), row[1]) for row in rows]
+    
+    def last_finished(self, kind):
+        """Get the most recently finished record"""
+        row = self.connection().execute(
+            'SELECT record FROM tasks WHERE kind = ? AND finished IS NOT NULL ORDER BY finished DESC LIMIT 1',
+            (kind,)).fetchone()
+        return json.loads(row[0]) if row else None
+    
+    def delete(self, task_id):
+        conn = self.connection()
+        conn.execute('DELETE FROM tasks WHERE id = ?', (task_id,))
+        conn.execute('DELETE FROM task_output WHERE task_id = ?', (task_id,))
+    
+    def append_output(self, task_id, first, lines, keep):
+        """Store output lines numbered from `first`, keeping the last `keep`"""
+        total = first + len(lines)
+        conn = self.connection()
+        conn.execute('BEGIN')
+        try:
+            conn.executemany('INSERT OR REPLACE INTO task_output (task_id, seq, line) VALUES (?, ?, ?)',
+                             [(task_id, seq, line) for seq, line in enumerate(lines, start=first)])
+            conn.execute('DELETE FROM task_output WHERE task_id = ? AND seq < ?', (task_id, total - keep))
+            conn.execute('UPDATE tasks SET output_total = ? WHERE id = ?', (total, task_id))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+    
+    def read_output(self, task_id, cursor, limit=500):
+        """Get output lines from `cursor` on.
+        
+        Returns (lines, next_cursor, skipped, total, finished) where `skipped`
+        counts lines that were trimmed before they were read.
+        """
+        conn = self.connection()
+        # Read the state first, output flushed before it finished is then complete
+        row = conn.execute('SELECT state, output_total FROM tasks WHERE id = ?', (task_id,)).fetchone()
+        if row is None:
+            return [], cursor, 0, cursor, True
+        rows = conn.execute(
+            'SELECT seq, line FROM task_output WHERE task_id = ? AND seq >= ? ORDER BY seq LIMIT ?',
+            (task_id, cursor, limit)).fetchall()
+        total = max(row[1], rows[-1][0] + 1) if rows else row[1]
+        skipped = rows[0][0] - cursor if rows else 0
+        end = rows[-1][0] + 1 if rows else cursor
+        return [line for _, line in rows], end, skipped, total, row[0] not in self.ACTIVE_STATES
+    
+    def request_cancel(self, task_id):
+        """Ask the worker that owns a task to cancel it"""
+        cursor = self.connection().execute(
+            'UPDATE tasks SET cancel_requested = 1 WHERE id = ? AND state IN (?, ?)',
+            (task_id, *self.ACTIVE_STATES))
+        return cursor.rowcount > 0
+    
+    def cancel_requests(self, kind):
+        """Get the ids of this worker's tasks that another worker asked to cancel"""
+        rows = self.connection().execute(
+            'SELECT id FROM tasks WHERE kind = ? AND owner = ? AND cancel_requested = 1 AND state IN (?, ?)',
+            (kind, os.getpid(), *self.ACTIVE_STATES))
+        return [row[0] for row in rows]
+    
+    def prune(self, kind, keep):
+        """Drop the oldest finished records beyond `keep`, returns their ids"""
+        conn = self.connection()
+        stale = [row[0] for row in conn.execute(
+            'SELECT id FROM tasks WHERE kind = ? AND finished IS NOT NULL ORDER BY finished DESC LIMIT -1 OFFSET ?',
+            (kind, keep))]
+        for task_id in stale:
+            self.delete(task_id)
+        return stale
+    
+    def delete_children(self, parent_id):
+        """Delete the tasks with ids of the form `parent_id:<anything>`"""
+        # ';' sorts right after ':'
+        bounds = (parent_id + ':', parent_id + ';')
+        conn = self.connection()
+        conn.execute('DELETE FROM tasks WHERE id > ? AND id < ?', bounds)
+        conn.execute('DELETE FROM task_output WHERE task_id > ? AND task_id < ?', bounds)
+    
+    def reap_orphans(self):
+        """Fail the unfinished tasks of workers that no longer exist"""
+        conn = self.connection()
+        rows = conn.execute('SELECT owner, record FROM tasks WHERE state IN (?, ?)', self.ACTIVE_STATES).fetchall()
+        for owner, data in rows:
+            if self.worker_alive(owner):
+                continue
+            record = json.loads(data)
+            record['state'] = 'failed'
+            record['message'] = 'Server worker exited'
+            record['finished'] = time.time()
+            conn.execute('UPDATE tasks SET state = ?, finished = ?, record = ? WHERE id = ?',
+                         (record['state'], record['finished'], json.dumps(record), record['id']))
+    
+    @staticmethod
+    def worker_alive(pid):
+        try:
+            os.kill(pid, 0)
+        except PermissionError:
+            return True
+        except ProcessLookupError:
             return False
-        result = subprocess.run(['git', 'rev-parse', '--git-dir'], 
-                               cwd=SCRIPT_DIR, 
-                               stdout=subprocess.PIPE, 
-                               stderr=subprocess.PIPE)
-        return result.returncode == 0
+        return True
+    
+    def save_metrics(self, data):
+        self.connection().execute(
+            '''INSERT INTO metrics (pid, updated, data) VALUES (?, ?, ?)
+               ON CONFLICT (pid) DO UPDATE SET updated = excluded.updated, data = excluded.data''',
+            (os.getpid(), time.time(), json.dumps(data)))
+    
+    def load_metrics(self, retire):
+        """Get [(pid, data)] of the metrics every worker saved.
+        
+        The rows of workers that exited are replaced by one under pid 0,
+        retire() folds their data and that of the previous pid 0 row.
+        """
+        conn = self.connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            rows = [(pid, json.loads(data)) for pid, data in conn.execute('SELECT pid, data FROM metrics')]
+            exited = {pid for pid, _ in rows if pid and not self.worker_alive(pid)}
+            if exited:
+                retired = retire([data for pid, data in rows if pid == 0 or pid in exited])
+                conn.executemany('DELETE FROM metrics WHERE pid = ?', [(pid,) for pid in exited])
+                conn.execute('INSERT OR REPLACE INTO metrics (pid, updated, data) VALUES (0, ?, ?)',
+                             (time.time(), json.dumps(retired)))
+                rows = [(pid, data) for pid, data in rows if pid and pid not in exited] + [(0, retired)]
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return rows
+    
+    def ping(self):
+        self.connection().execute('SELECT 1').fetchone()
+
+state_store = StateStore(STATE_DB) if STATE_DB else None
+
+class StoredOutput:
+    """Output of a task that runs in another worker, read from the state store.
+    
+    Has the same read() as OutputBuffer so it can be streamed the same way.
+    """
+    
+    def __init__(self, task_id):
+        self.task_id = task_id
+    
+    def read(self, cursor, timeout=None):
+        deadline = time.monotonic() + (timeout or 0)
+        while True:
+            lines, end, skipped, total, finished = state_store.read_output(self.task_id, cursor)
+            done = finished and end >= total
+            if lines or skipped or done or time.monotonic() >= deadline:
+                return lines, end, skipped, done
+            time.sleep(STATE_POLL_INTERVAL)
+
+class OutputFlusher:
+    """Writes new output lines of local tasks to the state store.
+    
+    Lines are collected and written in batches every STATE_POLL_INTERVAL
+    instead of one write per printed line.
+    """
+    
+    def __init__(self):
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.thread = None
+    
+    def mark(self, output):
+        with self.lock:
+            self.pending.add(output)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.flush_loop, name='output-flusher', daemon=True)
+                self.thread.start()
+    
+    def flush_loop(self):
+        while True:
+            time.sleep(STATE_POLL_INTERVAL)
+            with self.lock:
+                outputs, self.pending = self.pending, set()
+            for output in outputs:
+                try:
+                    output.flush()
+                except Exception as e:
+                    print(f"Error storing output: {e}")
+
+output_flusher = OutputFlusher()
+
+class OutputBuffer:
+    """Ring buffer holding the last lines a script printed.
+    
+    Lines are numbered from 0 so that readers can follow along with a cursor.
+    Only the newest `maxlen` lines are kept, readers that fall behind skip
+    ahead instead of making the buffer grow. With a `store_id` the lines are
+    also written to the state store for readers in other workers.
+    """
+    
+    def __init__(self, maxlen=None, store_id=None):
+        self.lines = deque(maxlen=maxlen or JOB_OUTPUT_LINES)
+        self.total = 0
+        self.closed = False
+        self.condition = threading.Condition()
+        self.store_id = store_id if state_store else None
+        self.stored = 0
+        self.store_lock = threading.Lock()
+    
+    def append(self, line):
+        with self.condition:
+            self.lines.append(line)
+            self.total += 1
+            self.condition.notify_all()
+        if self.store_id:
+            output_flusher.mark(self)
+    
+    def flush(self):
+        """Write the lines added since the last flush to the state store"""
+        if not self.store_id:
+            return
+        with self.store_lock:
+            with self.condition:
+                first = self.total - len(self.lines)
+                start = max(self.stored, first)
+                lines = list(self.lines)[start - first:]
+            if lines:
+                state_store.append_output(self.store_id, start, lines, self.lines.maxlen)
+            self.stored = start + len(lines)
+    
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.flush()
+    
+    def tail(self, count):
+        """Get the last `count` lines"""
+        with self.condition:
+            return list(self.lines)[-count:]
+    
+    def read(self, cursor, timeout=None):
+        """Wait for lines after `cursor`.
+        
+        Returns (lines, next_cursor, skipped, closed) where `skipped` is the
+        number of lines that dropped out of the buffer before they were read.
+        """
+        with self.condition:
+            if cursor >= self.total and not self.closed:
+                self.condition.wait(timeout)
+            first = self.total - len(self.lines)
+            skipped = max(first - cursor, 0)
+            cursor = max(cursor, first)
+            lines = list(self.lines)[cursor - first:]
+            return lines, self.total, skipped, self.closed and cursor + len(lines) >= self.total
+
+def iter_process_lines(process):
+    """Yield decoded output lines from a process as they are printed"""
+    for raw in iter(lambda: process.stdout.readline(JOB_LINE_LIMIT), b''):
+        # A bare carriage return would end the line early in an SSE frame
+        yield raw.decode('utf-8', errors='replace').rstrip('\r\n').replace('\r', '')
+
+class RunHistory(SQLiteStore):
+    """Append-only record of every script execution.
+    
+    Runs are kept in SQLite in WAL mode, indexed for the per-script,
+    per-status and time range queries of /api/runs. The output is stored
+    zlib compressed in its own table so that listing runs never reads it.
+    """
+    
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS runs (
+            id INTEGER PRIMARY KEY,
+            job_id TEXT,
+            script TEXT NOT NULL,
+            status TEXT NOT NULL,
+            started REAL NOT NULL,
+            finished REAL NOT NULL,
+            duration REAL NOT NULL,
+            exit_code INTEGER,
+            peak_rss INTEGER,
+            output_lines INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS runs_script_started ON runs (script, started);
+        CREATE INDEX IF NOT EXISTS runs_status_started ON runs (status, started);
+        CREATE INDEX IF NOT EXISTS runs_started ON runs (started);
+        CREATE TABLE IF NOT EXISTS run_output (
+            run_id INTEGER PRIMARY KEY,
+            data BLOB NOT NULL
+        );
+    '''
+    # Columns added after the first release, created on databases that lack them
+    USAGE_COLUMNS = (('user_cpu', 'REAL'), ('system_cpu', 'REAL'), ('read_blocks', 'INTEGER'),
+                     ('write_blocks', 'INTEGER'), ('cgroup_memory_peak', 'INTEGER'),
+                     ('cgroup_cpu', 'REAL'), ('oom_kills', 'INTEGER'), ('limits', 'TEXT'),
+                     ('peak_rss_source', 'TEXT'))
+    COLUMNS = ('id', 'job_id', 'script', 'status', 'started', 'finished',
+               'duration', 'exit_code', 'peak_rss', 'output_lines') + tuple(name for name, _ in USAGE_COLUMNS)
+    # auto_vacuum only takes effect on a new database, lets compact() give space back
+    PRAGMAS = ('auto_vacuum=INCREMENTAL',) + SQLiteStore.PRAGMAS
+    DELETE_BATCH = 10000
+    
+    def __init__(self, path):
+        super().__init__(path)
+        self.compactor = None
+        self.compactor_lock = threading.Lock()
+    
+    def setup(self, conn):
+        existing = {row[1] for row in conn.execute('PRAGMA table_info(runs)')}
+        for name, kind in self.USAGE_COLUMNS:
+            if name not in existing:
+                try:
+                    conn.execute(f'ALTER TABLE runs ADD COLUMN {name} {kind}')
+                except sqlite3.OperationalError:
+                    # Another worker added it first
+                    pass
+    
+    def row_to_run(self, row):
+        run = dict(zip(self.COLUMNS, row))
+        run['limits'] = json.loads(run['limits']) if run['limits'] else None
+        return run
+    
+    def record(self, run, output_lines):
+        """Add a finished run with the output lines still buffered for it"""
+        data = zlib.compress('\n'.join(output_lines).encode('utf-8'))
+        run = dict(run, limits=json.dumps(run['limits']) if run.get('limits') else None)
+        conn = self.connection()
+        conn.execute('BEGIN')
+        try:
+            cursor = conn.execute(
+                f"INSERT INTO runs ({', '.join(self.COLUMNS[1:])}) VALUES ({', '.join('?' * (len(self.COLUMNS) - 1))})",
+                [run.get(column) for column in self.COLUMNS[1:]])
+            conn.execute('INSERT INTO run_output (run_id, data) VALUES (?, ?)', (cursor.lastrowid, data))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        self.start_compactor()
+        return cursor.lastrowid
+    
+    def query(self, script=None, status=None, since=None, until=None, cursor=None, limit=50):
+        """Get runs newest first, returns (runs, next_cursor)"""
+        clauses, params = [], []
+        if script is not None:
+            clauses.append('script = ?')
+            params.append(script)
+        if status is not None:
+            clauses.append('status = ?')
+            params.append(status)
+        if since is not None:
+            clauses.append('started >= ?')
+            params.append(since)
+        if until is not None:
+            clauses.append('started < ?')
+            params.append(until)
+        if cursor is not None:
+            clauses.append('(started, id) < (?, ?)')
+            params.extend(cursor)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ''
+        rows = self.connection().execute(
+            f"SELECT {', '.join(self.COLUMNS)} FROM runs {where} ORDER BY started DESC, id DESC LIMIT ?",
+            params + [limit + 1]).fetchall()
+        runs = [self.row_to_run(row) for row in rows[:limit]]
+        next_cursor = [runs[-1]['started'], runs[-1]['id']] if len(rows) > limit else None
+        return runs, next_cursor
+    
+    def get(self, run_id):
+        """Get one run including its output"""
+        conn = self.connection()
+        row = conn.execute(f"SELECT {', '.join(self.COLUMNS)} FROM runs WHERE id = ?", (run_id,)).fetchone()
+        if row is None:
+            return None
+        run = self.row_to_run(row)
+        data = conn.execute('SELECT data FROM run_output WHERE run_id = ?', (run_id,)).fetchone()
+        run['output'] = zlib.decompress(data[0]).decode('utf-8').split('\n') if data else []
+        return run
+    
+    def usage(self, since, limit=50):
+        """Get resource usage per script since `since`, most CPU time first.
+        
+        Peak RSS only counts runs where it was measured for the script itself,
+        older rows and scripts forked from a worker carry the worker's size.
+        """
+        rows = self.connection().execute('''
+            SELECT script, COUNT(*), SUM(status != 'finished'),
+                   SUM(COALESCE(user_cpu, 0) + COALESCE(system_cpu, 0)), AVG(duration),
+                   MAX(CASE WHEN peak_rss_source IS NOT NULL THEN peak_rss END),
+                   COUNT(peak_rss_source), MAX(cgroup_memory_peak), SUM(COALESCE(oom_kills, 0))
+            FROM runs WHERE started >= ? AND status != 'cached'
+            GROUP BY script ORDER BY 4 DESC LIMIT ?''', (since, limit))
+        keys = ('script', 'runs', 'failures', 'cpu_time', 'average_duration',
+                'max_peak_rss', 'peak_rss_runs', 'max_cgroup_memory_peak', 'oom_kills')
+        return [dict(zip(keys, row)) for row in rows]
+    
+    def delete_where(self, condition, params):
+        """Delete matching runs in batches so writers are never blocked for long"""
+        conn = self.connection()
+        deleted = 0
+        while True:
+            ids = [(row[0],) for row in conn.execute(
+                f'SELECT id FROM runs WHERE {condition} LIMIT ?', (*params, self.DELETE_BATCH))]
+            if not ids:
+                return deleted
+            conn.execute('BEGIN')
+            try:
+                conn.executemany('DELETE FROM runs WHERE id = ?', ids)
+                conn.executemany('DELETE FROM run_output WHERE run_id = ?', ids)
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+            deleted += len(ids)
+    
+    def compact(self):
+        """Apply the retention limits and give the freed space back"""
+        conn = self.connection()
+        deleted = self.delete_where('started < ?', (time.time() - HISTORY_RETENTION_DAYS * 86400,))
+        row = conn.execute('SELECT id FROM runs ORDER BY id DESC LIMIT 1 OFFSET ?', (HISTORY_MAX_RUNS,)).fetchone()
+        if row:
+            deleted += self.delete_where('id <= ?', (row[0],))
+        if deleted:
+            # executescript() steps the pragma to completion, execute() frees one page
+            conn.executescript('PRAGMA incremental_vacuum')
+            conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        return deleted
+    
+    def start_compactor(self):
+        with self.compactor_lock:
+            if self.compactor is None:
+                self.compactor = threading.Thread(target=self.compact_loop, name='history-compactor', daemon=True)
+                self.compactor.start()
+    
+    def compact_loop(self):
+        while True:
+            try:
+                self.compact()
+            except Exception as e:
+                print(f"Error compacting run history: {e}")
+            time.sleep(HISTORY_COMPACT_INTERVAL)
+
+run_history = RunHistory(HISTORY_DB) if HISTORY_DB else None
+
+class VersionStore(SQLiteStore):
+    """Every revision of the files saved through the app, without git.
+    
+    File contents are zlib compressed blobs keyed by their SHA-256, so a
+    revision that matches an earlier one costs a row in the revision index
+    and no space. Deletes are recorded as revisions without a blob, so a
+    deleted file can be restored. gc() keeps the store within
+    VERSIONS_PER_FILE revisions per file and VERSIONS_MAX_BYTES overall.
+    """
+    
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS blobs (
+            hash TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            stored INTEGER NOT NULL,
+            data BLOB NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS revisions (
+            id INTEGER PRIMARY KEY,
+            path TEXT NOT NULL,
+            hash TEXT,
+            size INTEGER,
+            saved REAL NOT NULL,
+            source TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS revisions_path ON revisions (path, id);
+        CREATE INDEX IF NOT EXISTS revisions_hash ON revisions (hash);
+    '''
+    COLUMNS = ('id', 'hash', 'size', 'saved', 'source')
+    # auto_vacuum only takes effect on a new database, lets gc() give space back
+    PRAGMAS = ('auto_vacuum=INCREMENTAL',) + SQLiteStore.PRAGMAS
+    GC_BATCH = 1000
+    
+    def __init__(self, path):
+        super().__init__(path)
+        self.collector = None
+        self.collector_lock = threading.Lock()
+    
+    def latest(self, relpath):
+        """Get the content hash of a file's latest revision, '' for a delete and None without revisions"""
+        row = self.connection().execute(
+            'SELECT hash FROM revisions WHERE path = ? ORDER BY id DESC LIMIT 1', (relpath,)).fetchone()
+        return None if row is None else row[0] or ''
+    
+    def record(self, relpath, data, source):
+        """Add a revision of a file, returns its id or None when it matches the latest one"""
+        digest = hashlib.sha256(data).hexdigest()
+        conn = self.connection()
+        # Compressed before the write lock is taken, it is the slow part
+        compressed = None
+        if conn.execute('SELECT 1 FROM blobs WHERE hash = ?', (digest,)).fetchone() is None:
+            compressed = zlib.compress(data, 6)
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            latest = conn.execute('SELECT hash FROM revisions WHERE path = ? ORDER BY id DESC LIMIT 1',
+                                  (relpath,)).fetchone()
+            if latest and latest[0] == digest:
+                conn.execute('COMMIT')
+                return None
+            if compressed is not None:
+                conn.execute('INSERT OR IGNORE INTO blobs (hash, size, stored, data) VALUES (?, ?, ?, ?)',
+                             (digest, len(data), len(compressed), compressed))
+            cursor = conn.execute('INSERT INTO revisions (path, hash, size, saved, source) VALUES (?, ?, ?, ?, ?)',
+                                  (relpath, digest, len(data), time.time(), source))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        self.start_collector()
+        return cursor.lastrowid
+    
+    def record_delete(self, relpath):
+        """Mark a file as deleted, only if it has revisions to restore"""
+        conn = self.connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            latest = conn.execute('SELECT hash FROM revisions WHERE path = ? ORDER BY id DESC LIMIT 1',
+                                  (relpath,)).fetchone()
+            if latest and latest[0] is not None:
+                conn.execute("INSERT INTO revisions (path, saved, source) VALUES (?, ?, 'delete')",
+                             (relpath, time.time()))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+    
+    def revisions(self, relpath, before=None, limit=50):
+        """Get the revisions of a file newest first, returns (revisions, next_cursor)"""
+        rows = self.connection().execute(
+            f"SELECT {', '.join(self.COLUMNS)} FROM revisions WHERE path = ? AND id < ? ORDER BY id DESC LIMIT ?",
+            (relpath, before if before is not None else sys.maxsize, limit + 1)).fetchall()
+        revisions = [dict(zip(self.COLUMNS, row)) for row in rows[:limit]]
+        return revisions, revisions[-1]['id'] if len(rows) > limit else None
+    
+    def read(self, relpath, revision_id):
+        """Get (revision, content) of one revision, content is None for a delete"""
+        conn = self.connection()
+        row = conn.execute(f"SELECT {', '.join(self.COLUMNS)} FROM revisions WHERE id = ? AND path = ?",
+                           (revision_id, relpath)).fetchone()
+        if row is None:
+            return None, None
+        revision = dict(zip(self.COLUMNS, row))
+        if revision['hash'] is None:
+            return revision, None
+        blob = conn.execute('SELECT data FROM blobs WHERE hash = ?', (revision['hash'],)).fetchone()
+        return revision, zlib.decompress(blob[0])
+    
+    def deleted(self, limit=100):
+        """Get the files whose latest revision is a delete, most recently deleted first"""
+        rows = self.connection().execute(
+            '''SELECT r.path, r.id, r.saved FROM revisions r
+               JOIN (SELECT path, MAX(id) AS id FROM revisions GROUP BY path) latest ON latest.id = r.id
+               WHERE r.hash IS NULL ORDER BY r.id DESC LIMIT ?''', (limit,)).fetchall()
+        return [{'path': path, 'id': revision_id, 'deleted': saved} for path, revision_id, saved in rows]
+    
+    def usage(self):
+        conn = self.connection()
+        blobs, size, stored = conn.execute('SELECT count(*), sum(size), sum(stored) FROM blobs').fetchone()
+        files, revisions = conn.execute('SELECT count(DISTINCT path), count(*) FROM revisions').fetchone()
+        return {'files': files, 'revisions': revisions, 'blobs': blobs,
+                'size': size or 0, 'stored': stored or 0}
+    
+    def delete_revisions(self, ids):
+        """Drop revisions and the blobs nothing refers to anymore, returns the bytes freed"""
+        conn = self.connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            hashes = {row[0] for row in conn.execute(
+                f"SELECT DISTINCT hash FROM revisions WHERE id IN ({', '.join('?' * len(ids))}) AND hash IS NOT NULL",
+                ids)}
+            conn.executemany('DELETE FROM revisions WHERE id = ?', [(revision_id,) for revision_id in ids])
+            freed = 0
+            for digest in hashes:
+                if conn.execute('SELECT 1 FROM revisions WHERE hash = ? LIMIT 1', (digest,)).fetchone() is None:
+                    freed += conn.execute('SELECT stored FROM blobs WHERE hash = ?', (digest,)).fetchone()[0]
+                    conn.execute('DELETE FROM blobs WHERE hash = ?', (digest,))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return freed
+    
+    def gc(self):
+        """Apply the revision and size limits and give the freed space back.
+        
+        The latest revision of every file is always kept, beyond that the
+        oldest revisions go first. Returns the number of revisions deleted.
+        """
+        conn = self.connection()
+        deleted = 0
+        while True:
+            ids = [row[0] for row in conn.execute(
+                '''SELECT id FROM (SELECT id, row_number() OVER (PARTITION BY path ORDER BY id DESC) AS n
+                   FROM revisions) WHERE n > ? LIMIT ?''', (VERSIONS_PER_FILE, self.GC_BATCH))]
+            if not ids:
+                break
+            self.delete_revisions(ids)
+            deleted += len(ids)
+        
+        stored = conn.execute('SELECT coalesce(sum(stored), 0) FROM blobs').fetchone()[0]
+        while stored > VERSIONS_MAX_BYTES:
+            ids = [row[0] for row in conn.execute(
+                '''SELECT id FROM revisions WHERE id NOT IN (SELECT MAX(id) FROM revisions GROUP BY path)
+                   ORDER BY id LIMIT ?''', (self.GC_BATCH,))]
+            if not ids:
+                break
+            stored -= self.delete_revisions(ids)
+            deleted += len(ids)
+        if deleted:
+            # executescript() steps the pragma to completion, execute() frees one page
+            conn.executescript('PRAGMA incremental_vacuum')
+            conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        return deleted
+    
+    def start_collector(self):
+        with self.collector_lock:
+            if self.collector is None:
+                self.collector = threading.Thread(target=self.gc_loop, name='version-gc', daemon=True)
+                self.collector.start()
+    
+    def gc_loop(self):
+        while True:
+            try:
+                self.gc()
+            except Exception as e:
+                print(f"Error collecting old versions: {e}")
+            time.sleep(VERSIONS_GC_INTERVAL)
+
+version_store = VersionStore(VERSIONS_DB) if VERSIONS_DB else None
+
+def version_file(file_path, source, handle=None):
+    """Record the current content of a file in the version store.
+    
+    `source` is 'save', 'restore' or 'delete' after a change made through
+    the app. Before a save it is 'external', the content is then recorded
+    only if it is not the latest revision, which keeps what a file held
+    before its first save and edits made outside the app. `handle` is an
+    open file to record instead of what is at `file_path` now. Errors are
+    logged and otherwise ignored.
+    """
+    if version_store is None:
+        return
+    relpath = os.path.relpath(file_path, SCRIPT_DIR)
+    try:
+        if source == 'delete':
+            version_store.record_delete(relpath)
+            return
+        with open(file_path, 'rb') if handle is None else contextlib.nullcontext(handle) as file:
+            st = os.fstat(file.fileno())
+            if source == 'external':
+                latest = version_store.latest(relpath)
+                # Etags are the start of the content hash
+                if latest and latest[:32] == stat_etag(file_path, st, file):
+                    return
+                source = 'original' if latest is None else 'external'
+            if st.st_size > VERSIONS_MAX_FILE_SIZE:
+                return
+            file.seek(0)
+            version_store.record(relpath, file.read(), source)
+    except Exception as e:
+        print(f"Error recording a version of {relpath}: {e}")
+
+def record_run(run, output):
+    """Add a run to the history, errors are logged and otherwise ignored"""
+    if run_history is None:
+        return
+    try:
+        run['output_lines'] = output.total
+        run_history.record(run, output.tail(output.lines.maxlen))
+    except Exception as e:
+        print(f"Error recording run of {run['script']}: {e}")
+
+def parse_size(value):
+    """Parse a byte count such as 1048576, '512M' or '2G'"""
+    if isinstance(value, (int, float)):
+        return int(value)
+    text = str(value).strip().upper().rstrip('B')
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+def normalize_profile(profile):
+    """Check and convert the values of a resource profile, empty values are dropped"""
+    normalized = {}
+    for key, value in profile.items():
+        if value in ('', None):
+            continue
+        if key in ('cpu_time', 'nproc', 'nofile', 'nice'):
+            normalized[key] = int(value)
+        elif key in ('memory', 'cgroup_memory_max'):
+            normalized[key] = parse_size(value)
+        elif key == 'cgroup_cpu_max':
+            # A number of CPUs, or cpu.max syntax such as "50000 100000"
+            value = str(value).strip()
+            normalized[key] = value if ' ' in value else f"{int(float(value) * 100000)} 100000"
+        elif key == 'ionice':
+            io_class, _, level = str(value).partition(':')
+            if io_class not in ResourceLimits.IOPRIO_CLASSES or (level and not 0 <= int(level) <= 7):
+                raise ValueError(f"Invalid ionice value '{value}'")
+            normalized[key] = str(value)
+        else:
+            raise ValueError(f"Unknown resource limit '{key}'")
+    return normalized
+
+class ScriptPatterns:
+    """A JSON file mapping glob patterns on script paths to settings.
+    
+    Every value is checked with `normalize` when the file is read. The file
+    is re-read when it changes, and an invalid file keeps the previous
+    patterns.
+    """
+    
+    def __init__(self, path, normalize):
+        self.path = path
+        self.normalize = normalize
+        self.patterns = []
+        self.mtime = None
+        self.lock = threading.Lock()
+    
+    def load(self):
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            mtime = None
+        with self.lock:
+            if mtime == self.mtime:
+                return
+            self.mtime = mtime
+            if mtime is None:
+                self.patterns = []
+                return
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                self.patterns = [(pattern, self.normalize(value)) for pattern, value in data.items()]
+            except (OSError, ValueError, AttributeError) as e:
+                print(f"Error loading {self.path}, keeping the previous settings: {e}")
+    
+    def match(self, relpath):
+        """Get the value of the first pattern matching a script, None if none does"""
+        self.load()
+        return next((value for pattern, value in self.patterns if fnmatch.fnmatchcase(relpath, pattern)), None)
+
+class ResourceProfiles:
+    """Resource limits per script.
+    
+    Defaults come from the SCRIPT_* settings. The RESOURCE_PROFILES file maps
+    glob patterns on script paths to limits, the first pattern matching a
+    script is merged over the defaults.
+    """
+    
+    def __init__(self, path, defaults):
+        self.defaults = defaults
+        self.patterns = ScriptPatterns(path, normalize_profile)
+    
+    def for_script(self, relpath):
+        profile = dict(self.defaults)
+        profile.update(self.patterns.match(relpath) or {})
+        return profile
+
+class ResourceLimits:
+    """Applies a resource profile to one script run.
+    
+    rlimits, nice and ionice are set in the child between fork and exec, so
+    they hold before the script runs its first instruction. cgroup limits
+    need SCRIPT_CGROUP to point at a delegated cgroup v2 directory, each run
+    gets its own child group which the child joins before exec.
+    """
+    
+    RLIMITS = (('cpu_time', resource.RLIMIT_CPU), ('memory', resource.RLIMIT_AS),
+               ('nproc', resource.RLIMIT_NPROC), ('nofile', resource.RLIMIT_NOFILE))
+    IOPRIO_CLASSES = {'realtime': 1, 'best-effort': 2, 'idle': 3}
+    # ioprio_set has no libc wrapper, the syscall number depends on the architecture
+    IOPRIO_SET = {'x86_64': 251, 'aarch64': 30, 'riscv64': 30, 'armv7l': 314, 'armv6l': 314, 'i686': 289}
+    libc = None
+    
+    def __init__(self, profile, name):
+        self.profile = profile
+        self.rlimits = []
+        for key, limit in self.RLIMITS:
+            if key in profile:
+                # An unprivileged process cannot raise its hard limit
+                hard = resource.getrlimit(limit)[1]
+                value = profile[key] if hard == resource.RLIM_INFINITY else min(profile[key], hard)
+                self.rlimits.append((limit, value))
+        self.nice = profile.get('nice')
+        self.ioprio = self.ioprio_value(profile.get('ionice'))
+        self.cgroup = None
+        self.procs_fd = None
+        if SCRIPT_CGROUP and ('cgroup_memory_max' in profile or 'cgroup_cpu_max' in profile):
+            self.create_cgroup(name)
+    
+    def ioprio_value(self, ionice):
+        if not ionice:
+            return None
+        if os.uname().machine not in self.IOPRIO_SET:
+            print(f"ionice is not supported on {os.uname().machine}")
+            return None
+        if ResourceLimits.libc is None:
+            ResourceLimits.libc = ctypes.CDLL(None, use_errno=True)
+        self.ioprio_syscall = self.IOPRIO_SET[os.uname().machine]
+        io_class, _, level = ionice.partition(':')
+        return (self.IOPRIO_CLASSES[io_class] << 13) | int(level or 4)
+    
+    def create_cgroup(self, name):
+        path = os.path.join(SCRIPT_CGROUP, f'run-{name}')
+        try:
+            os.mkdir(path)
+            self.cgroup = path
+            if 'cgroup_memory_max' in self.profile:
+                self.write_cgroup_file('memory.max', str(self.profile['cgroup_memory_max']))
+                # Let the OOM killer take the whole run rather than one process
+                self.write_cgroup_file('memory.oom.group', '1')
+            if 'cgroup_cpu_max' in self.profile:
+                self.write_cgroup_file('cpu.max', self.profile['cgroup_cpu_max'])
+            self.procs_fd = os.open(os.path.join(path, 'cgroup.procs'), os.O_WRONLY | os.O_CLOEXEC)
+        except OSError as e:
+            print(f"Running without cgroup limits, could not set up {path}: {e}")
+            self.remove_cgroup()
+    
+    def write_cgroup_file(self, name, value):
+        with open(os.path.join(self.cgroup, name), 'w') as f:
+            f.write(value)
+    
+    def read_cgroup_file(self, name):
+        try:
+            with open(os.path.join(self.cgroup, name), 'r') as f:
+                return f.read()
+        except OSError:
+            return None
+    
+    @property
+    def needed(self):
+        return bool(self.rlimits or self.nice is not None or self.ioprio is not None or self.procs_fd is not None)
+    
+    def preexec(self):
+        """Runs in the child process, only makes system calls"""
+        if self.procs_fd is not None:
+            # Writing 0 moves the writing process
+            os.write(self.procs_fd, b'0')
+        for limit, value in self.rlimits:
+            resource.setrlimit(limit, (value, value))
+        if self.nice is not None:
+            os.setpriority(os.PRIO_PROCESS, 0, self.nice)
+        if self.ioprio is not None:
+            # IOPRIO_WHO_PROCESS, 0 for this process
+            self.libc.syscall(self.ioprio_syscall, 1, 0, self.ioprio)
+    
+    def started(self):
+        """Close the parent's copy of the cgroup handle once the child has it"""
+        if self.procs_fd is not None:
+            os.close(self.procs_fd)
+            self.procs_fd = None
+    
+    def finish(self):
+        """Collect the cgroup statistics of the run and remove its cgroup"""
+        self.started()
+        stats = {}
+        if self.cgroup is None:
+            return stats
+        peak = self.read_cgroup_file('memory.peak')
+        if peak:
+            stats['cgroup_memory_peak'] = int(peak)
+        for line in (self.read_cgroup_file('cpu.stat') or '').splitlines():
+            key, _, value = line.partition(' ')
+            if key == 'usage_usec':
+                stats['cgroup_cpu'] = int(value) / 1000000
+        for line in (self.read_cgroup_file('memory.events') or '').splitlines():
+            key, _, value = line.partition(' ')
+            if key == 'oom_kill':
+                stats['oom_kills'] = int(value)
+        self.remove_cgroup()
+        return stats
+    
+    def remove_cgroup(self):
+        if self.cgroup is None:
+            return
+        if self.procs_fd is not None:
+            os.close(self.procs_fd)
+            self.procs_fd = None
+        try:
+            # Processes that left the process group are still in the cgroup
+            if os.path.exists(os.path.join(self.cgroup, 'cgroup.kill')):
+                self.write_cgroup_file('cgroup.kill', '1')
+            for _ in range(50):
+                try:
+                    os.rmdir(self.cgroup)
+                    break
+                except OSError as e:
+                    if e.errno != errno.EBUSY:
+                        raise
+                    time.sleep(0.02)
+        except OSError as e:
+            print(f"Error removing cgroup {self.cgroup}: {e}")
+        self.cgroup = None
+
+try:
+    resource_profiles = ResourceProfiles(RESOURCE_PROFILES, normalize_profile(DEFAULT_RESOURCE_PROFILE))
+except ValueError as e:
+    print(f"Ignoring invalid SCRIPT_* resource limits: {e}")
+    resource_profiles = ResourceProfiles(RESOURCE_PROFILES, {})
+
+def normalize_cache_rule(rule):
+    """Check a result cache rule, `true` caches a script on its content alone"""
+    if rule is True:
+        return {'inputs': [], 'env': [], 'ttl': 0, 'failures': False}
+    if not isinstance(rule, dict):
+        raise ValueError(f"Invalid cache rule '{rule}'")
+    unknown = set(rule) - {'inputs', 'env', 'ttl', 'failures'}
+    if unknown:
+        raise ValueError(f"Unknown cache rule keys: {', '.join(sorted(unknown))}")
+    inputs = rule.get('inputs', [])
+    env = rule.get('env', [])
+    if not all(isinstance(item, str) for item in inputs) or not all(isinstance(item, str) for item in env):
+        raise ValueError("Cache rule inputs and env must be lists of strings")
+    return {'inputs': list(inputs), 'env': list(env), 'ttl': float(rule.get('ttl', 0)),
+            'failures': bool(rule.get('failures', False))}
+
+class CacheRules:
+    """Scripts whose results may be cached.
+    
+    The CACHE_RULES file maps glob patterns on script paths to the input
+    files and environment variables a script reads besides its own content.
+    Only scripts matching a pattern are cached.
+    """
+    
+    def __init__(self, path):
+        self.patterns = ScriptPatterns(path, normalize_cache_rule)
+    
+    def for_script(self, relpath):
+        """Get the rule of a script, None when its results are not cached"""
+        return self.patterns.match(relpath)
+
+cache_rules = CacheRules(CACHE_RULES)
+
+class ResultCache(SQLiteStore):
+    """Output and exit status of cacheable scripts, keyed on everything they read.
+    
+    An entry is found by a hash of the script's path and content, its
+    arguments, the declared environment variables and the content of the
+    declared input files. Entries are dropped least recently used first to
+    stay within RESULT_CACHE_MAX_ENTRIES and RESULT_CACHE_MAX_BYTES. A
+    SQLite database, so every worker shares the entries and the counts.
+    """
+    
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS results (
+            key TEXT PRIMARY KEY,
+            script TEXT NOT NULL,
+            exit_code INTEGER NOT NULL,
+            output_lines INTEGER NOT NULL,
+            size INTEGER NOT NULL,
+            created REAL NOT NULL,
+            expires REAL,
+            last_used REAL NOT NULL,
+            hits INTEGER NOT NULL DEFAULT 0,
+            data BLOB NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used);
+        CREATE TABLE IF NOT EXISTS counters (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        );
+    '''
+    
+    def key(self, relpath, script_path, rule, env=None):
+        """Hash of what a run of the script depends on under `rule`"""
+        inputs = {}
+        for pattern in rule['inputs']:
+            if os.path.isabs(pattern):
+                names = [path for path in glob.glob(pattern, recursive=True) if os.path.isfile(path)]
+            else:
+                names = [file['relpath'] for file in get_all_files() if fnmatch.fnmatchcase(file['relpath'], pattern)]
+            for name in names:
+                try:
+                    inputs[name] = file_etag(os.path.join(SCRIPT_DIR, name))
+                except OSError:
+                    # Removed since it was listed
+                    inputs[name] = None
+        environ = os.environ if env is None else env
+        material = {
+            'script': relpath,
+            'content': file_etag(script_path),
+            # Scripts are run without arguments
+            'argv': [relpath],
+            'env': {name: environ.get(name) for name in rule['env']},
+            'inputs': inputs
+        }
+        return hashlib.sha256(json.dumps(material, sort_keys=True).encode()).hexdigest()
+    
+    def get(self, key):
+        """Get (exit_code, output lines, output_lines) of an entry or None, counting the hit or miss"""
+        conn = self.connection()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT exit_code, output_lines, expires, data FROM results WHERE key = ?',
+                               (key,)).fetchone()
+            if row is not None and row[2] is not None and row[2] <= now:
+                conn.execute('DELETE FROM results WHERE key = ?', (key,))
+                row = None
+            if row is not None:
+                conn.execute('UPDATE results SET last_used = ?, hits = hits + 1 WHERE key = ?', (now, key))
+            conn.execute('''INSERT INTO counters (name, value) VALUES (?, 1)
+                            ON CONFLICT (name) DO UPDATE SET value = value + 1''',
+                         ('hits' if row is not None else 'misses',))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        record_cache('result', row is not None)
+        if row is None:
+            return None
+        lines = zlib.decompress(row[3]).decode('utf-8').split('\n') if row[3] else []
+        return row[0], lines, row[1]
+    
+    def put(self, key, relpath, exit_code, lines, output_lines, ttl):
+        """Store a result and evict the least recently used entries beyond the limits"""
+        data = zlib.compress('\n'.join(lines).encode('utf-8')) if lines else b''
+        if len(data) > RESULT_CACHE_MAX_BYTES:
+            return
+        now = time.time()
+        conn = self.connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute('''INSERT OR REPLACE INTO results
+                            (key, script, exit_code, output_lines, size, created, expires, last_used, data)
+                            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                         (key, relpath, exit_code, output_lines, len(data), now, now + ttl if ttl else None, now, data))
+            count, size = conn.execute('SELECT count(*), coalesce(sum(size), 0) FROM results').fetchone()
+            evict = []
+            if count > RESULT_CACHE_MAX_ENTRIES or size > RESULT_CACHE_MAX_BYTES:
+                for old_key, old_size in conn.execute('SELECT key, size FROM results ORDER BY last_used'):
+                    if count <= RESULT_CACHE_MAX_ENTRIES and size <= RESULT_CACHE_MAX_BYTES:
+                        break
+                    evict.append((old_key,))
+                    count -= 1
+                    size -= old_size
+                conn.executemany('DELETE FROM results WHERE key = ?', evict)
+            if evict:
+                conn.execute('''INSERT INTO counters (name, value) VALUES ('evictions', ?)
+                                ON CONFLICT (name) DO UPDATE SET value = value + excluded.value''', (len(evict),))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+    
+    def stats(self):
+        """Entry counts, sizes and hit rate overall and per script"""
+        conn = self.connection()
+        counters = dict(conn.execute('SELECT name, value FROM counters'))
+        entries, size = conn.execute('SELECT count(*), coalesce(sum(size), 0) FROM results').fetchone()
+        lookups = counters.get('hits', 0) + counters.get('misses', 0)
+        scripts = [dict(zip(('script', 'entries', 'size', 'hits', 'last_used'), row)) for row in conn.execute(
+            '''SELECT script, count(*), sum(size), sum(hits), max(last_used)
+               FROM results GROUP BY script ORDER BY 4 DESC''')]
+        return {
+            'entries': entries,
+            'size': size,
+            'max_entries': RESULT_CACHE_MAX_ENTRIES,
+            'max_bytes': RESULT_CACHE_MAX_BYTES,
+            'hits': counters.get('hits', 0),
+            'misses': counters.get('misses', 0),
+            'evictions': counters.get('evictions', 0),
+            'hit_rate': counters.get('hits', 0) / lookups if lookups else None,
+            'scripts': scripts
+        }
+    
+    def clear(self, relpath=None):
+        """Drop every entry, or those of one script, returns how many were dropped"""
+        if relpath is None:
+            return self.connection().execute('DELETE FROM results').rowcount
+        return self.connection().execute('DELETE FROM results WHERE script = ?', (relpath,)).rowcount
+
+result_cache = ResultCache(RESULT_CACHE_DB) if RESULT_CACHE_DB else None
+
+def wait_for_process(process):
+    """Wait for a process to exit and return its resource usage.
+    
+    Uses wait4() so the usage of this one child is reported, returns None if
+    the process was already reaped elsewhere.
+    """
+    if isinstance(process, SpawnedProcess):
+        # A child of the spawner, which reports its usage
+        process.wait()
+        return process.usage
+    try:
+        _, status, usage = os.wait4(process.pid, 0)
+    except ChildProcessError:
+        process.wait()
+        return None
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return usage
+
+def signal_process_group(process, sig):
+    """Signal a script and every process it started"""
+    try:
+        os.killpg(process.pid, sig)
+    except ProcessLookupError:
+        pass
+
+class SpawnedProcess:
+    """A script started by the spawner, with the parts of Popen that execute_script() uses"""
+    
+    def __init__(self, read_fd):
+        self.stdout = os.fdopen(read_fd, 'rb')
+        self.pid = None
+        self.returncode = None
+        self.usage = None
+        self.error = None
+        self.launched = threading.Event()
+        self.exited = threading.Event()
+    
+    def wait(self, timeout=None):
+        self.exited.wait(timeout)
+        return self.returncode
+    
+    def poll(self):
+        return self.returncode
+
+class Spawner:
+    """Client of the spawner.py helper process.
+    
+    Runs with resource limits need a fork to set them before exec, which
+    gets slower as the worker's memory grows, and every child inherits the
+    peak RSS of the process it was forked from. Launches are sent to the
+    helper, a small process that forks in the worker's place, so neither
+    depends on the size of the worker. The helper is started along with
+    the app, so the first run does not wait for it, and again if it exits.
+    """
+    
+    PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'spawner.py')
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sock = None
+        self.process = None
+        self.pending = {}
+        self.next_id = 0
+        os.register_at_fork(after_in_child=self.forked)
+    
+    def start(self):
+        """Start the helper ahead of the first launch"""
+        try:
+            with self.lock:
+                self.connect()
+        except OSError as e:
+            print(f"Error starting the spawner: {e}")
+    
+    def forked(self):
+        # A forked child must not share its parent's helper, it connects its
+        # own on first use. Also runs before a preexec_fn, so only reset here
+        self.lock = threading.Lock()
+        if self.sock is not None:
+            self.sock.close()
+        self.sock = None
+        self.process = None
+        self.pending = {}
+    
+    def connect(self):
+        """Start the helper if it is not running, must hold self.lock"""
+        if self.sock is None:
+            ours, theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+            try:
+                self.process = subprocess.Popen([sys.executable, self.PATH, str(theirs.fileno())],
+                                                pass_fds=[theirs.fileno()],
+                                                stdin=subprocess.DEVNULL)
+            except OSError:
+                ours.close()
+                raise
+            finally:
+                theirs.close()
+            self.sock = ours
+            threading.Thread(target=self.read_loop, args=(ours,), name='spawner-reader', daemon=True).start()
+        return self.sock
+    
+    def spawn(self, argv, limits, env=None, cwd=None):
+        """Start `argv` with `limits` applied, returns a SpawnedProcess or raises OSError"""
+        read_fd, write_fd = os.pipe()
+        process = SpawnedProcess(read_fd)
+        request = {
+            'argv': argv,
+            'rlimits': limits.rlimits,
+            'nice': limits.nice,
+            'ioprio': [limits.ioprio_syscall, limits.ioprio] if limits.ioprio is not None else None,
+            'env': env,
+            'cwd': cwd
+        }
+        fds = [write_fd] if limits.procs_fd is None else [write_fd, limits.procs_fd]
+        try:
+            with self.lock:
+                sock = self.connect()
+                self.next_id += 1
+                request['id'] = self.next_id
+                self.pending[self.next_id] = process
+                try:
+                    socket.send_fds(sock, [json.dumps(request).encode()], fds)
+                except OSError:
+                    self.pending.pop(request['id'], None)
+                    raise
+        except OSError:
+            process.stdout.close()
+            raise
+        finally:
+            # The helper has its own copy now
+            os.close(write_fd)
+        process.launched.wait()
+        if process.error:
+            process.stdout.close()
+            raise OSError(process.error)
+        return process
+    
+    def read_loop(self, sock):
+        try:
+            while True:
+                data = sock.recv(65536)
+                if not data:
+                    break
+                message = json.loads(data)
+                with self.lock:
+                    process = self.pending.get(message['id'])
+                    if 'status' in message or 'error' in message:
+                        self.pending.pop(message['id'], None)
+                if process is None:
+                    continue
+                if 'pid' in message:
+                    process.pid = message['pid']
+                    process.launched.set()
+                elif 'error' in message:
+                    process.error = message['error']
+                    process.launched.set()
+                else:
+                    process.usage = resource.struct_rusage(message['usage'])
+                    process.returncode = message['status']
+                    process.exited.set()
+        except (OSError, ValueError) as e:
+            print(f"Error reading from the spawner: {e}")
+        finally:
+            with self.lock:
+                if self.sock is sock:
+                    self.sock = None
+                pending, self.pending = self.pending, {}
+                sock.close()
+            if self.process is not None and self.process.poll() is None:
+                self.process.wait()
+            # Their scripts go on without anyone to report how they ended
+            for process in pending.values():
+                process.error = process.error or 'Spawner exited'
+                if process.returncode is None:
+                    process.returncode = -1
+                process.launched.set()
+                process.exited.set()
+
+spawner = Spawner() if SCRIPT_SPAWNER else None
+if spawner:
+    spawner.start()
+executables = {}
+executables_lock = threading.Lock()
+
+def prepare_executable(script_path):
+    """Make sure a script can be executed, returns False if it is not a file.
+    
+    The access check, and the chmod when needed, run once per inode and
+    status change, later runs only stat the file.
+    """
+    try:
+        st = os.stat(script_path)
+    except FileNotFoundError:
+        return False
+    if not stat.S_ISREG(st.st_mode):
+        return False
+    key = (st.st_ino, st.st_ctime_ns)
+    with executables_lock:
+        if executables.get(script_path) == key:
+            return True
+    if not os.access(script_path, os.X_OK):
+        # Try to make it executable
+        os.chmod(script_path, 0o755)
+        st = os.stat(script_path)
+    with executables_lock:
+        executables[script_path] = (st.st_ino, st.st_ctime_ns)
+    return True
+
+def launch_script(script_path, limits, env=None, cwd=None):
+    """Start a script with its output on a pipe, through the spawner when it is on.
+    
+    A child's ru_maxrss starts from the size of the process it was forked
+    from, even across vfork and exec, so only scripts started by the small
+    spawner get a peak RSS that is their own.
+    """
+    started = time.monotonic()
+    if spawner:
+        try:
+            process = spawner.spawn([script_path], limits, env, cwd)
+            metrics.observe('script_manager_spawn_duration_seconds', time.monotonic() - started, method='spawner')
+            return process
+        except OSError as e:
+            print(f"Spawner failed, starting {script_path} directly: {e}")
+    # In its own session so that cancelling also stops what the script started
+    process = subprocess.Popen([script_path], 
+                               stdout=subprocess.PIPE, 
+                               stderr=subprocess.STDOUT,
+                               start_new_session=True,
+                               env=env,
+                               cwd=cwd,
+                               preexec_fn=limits.preexec if limits.needed else None)
+    metrics.observe('script_manager_spawn_duration_seconds', time.monotonic() - started,
+                    method='fork' if limits.needed else 'vfork')
+    return process
+
+def replay_cached_result(relpath, job_id, output, exit_code, lines, output_lines):
+    """Answer a run from the result cache as if the script had printed the stored output"""
+    started = time.time()
+    for line in lines:
+        output.append(line)
+    finished = time.time()
+    record_run({
+        'job_id': job_id,
+        'script': relpath,
+        'status': 'cached',
+        'started': started,
+        'finished': finished,
+        'duration': finished - started,
+        'exit_code': exit_code
+    }, output)
+    if exit_code == 0:
+        return True, "Script result served from cache"
+    return False, "Script execution failed (cached result): " + "\n".join(output.tail(20))
+
+def execute_script(script_path, timeout=None, job_id=None, output=None, env=None, cwd=None):
+    """Execute a shell script and return the result"""
+    owns_output = output is None
+    if owns_output:
+        output = OutputBuffer()
+    try:
+        # Check if the script exists and is executable
+        if not prepare_executable(script_path):
+            return False, "Script file not found"
+        
+        relpath = os.path.relpath(script_path, SCRIPT_DIR)
+        # Runs in a pipeline workspace leave files behind that the cache does not keep
+        rule = cache_rules.for_script(relpath) if result_cache and cwd is None else None
+        cache_key = None
+        if rule:
+            try:
+                cache_key = result_cache.key(relpath, script_path, rule, env)
+                cached = result_cache.get(cache_key)
+            except Exception as e:
+                print(f"Error reading the result cache for {relpath}: {e}")
+                cache_key = cached = None
+            if cached:
+                return replay_cached_result(relpath, job_id, output, *cached)
+        
+        # Execute the script, stderr is merged so lines keep their order
+        limits = ResourceLimits(resource_profiles.for_script(relpath), job_id or uuid.uuid4().hex)
+        started = time.time()
+        launched = time.monotonic()
+        try:
+            process = launch_script(script_path, limits, env, cwd)
+        except Exception:
+            limits.finish()
+            raise
+        limits.started()
+        if job_id:
+            with jobs_lock:
+                job_processes[job_id] = process
+                # The job may have been cancelled before the process existed
+                if job_cancelled(job_id):
+                    signal_process_group(process, signal.SIGTERM)
+        
+        timed_out = threading.Event()
+        def kill_on_timeout():
+            timed_out.set()
+            signal_process_group(process, signal.SIGKILL)
+        timer = threading.Timer(timeout, kill_on_timeout) if timeout else None
+        try:
+            if timer:
+                timer.start()
+            for line in iter_process_lines(process):
+                output.append(line)
+            usage = wait_for_process(process)
+        finally:
+            if timer:
+                timer.cancel()
+            process.stdout.close()
+            if job_id:
+                with jobs_lock:
+                    job_processes.pop(job_id, None)
+            cgroup_stats = limits.finish()
+        record_command('script', launched, process.returncode == 0 and not timed_out.is_set())
+        
+        finished = time.time()
+        if timed_out.is_set():
+            status = 'timeout'
+        elif job_id and job_cancelled(job_id):
+            status = 'cancelled'
+        else:
+            status = 'finished' if process.returncode == 0 else 'failed'
+        if cache_key and (status == 'finished' or status == 'failed' and rule['failures']):
+            try:
+                result_cache.put(cache_key, relpath, process.returncode, output.tail(output.lines.maxlen),
+                                 output.total, rule['ttl'])
+            except Exception as e:
+                print(f"Error storing the result of {relpath}: {e}")
+        run = {
+            'job_id': job_id,
+            'script': relpath,
+            'status': status,
+            'started': started,
+            'finished': finished,
+            'duration': finished - started,
+            'exit_code': process.returncode,
+            'limits': limits.profile
+        }
+        if usage:
+            run.update({
+                # ru_maxrss is in kilobytes on Linux, from the worker it carries the worker's own peak
+                'peak_rss': usage.ru_maxrss * 1024 if isinstance(process, SpawnedProcess) else None,
+                'peak_rss_source': 'spawner' if isinstance(process, SpawnedProcess) else None,
+                'user_cpu': usage.ru_utime,
+                'system_cpu': usage.ru_stime,
+                'read_blocks': usage.ru_inblock,
+                'write_blocks': usage.ru_oublock
+            })
+        run.update(cgroup_stats)
+        if run.get('peak_rss') is None and 'cgroup_memory_peak' in cgroup_stats:
+            run['peak_rss'] = cgroup_stats['cgroup_memory_peak']
+            run['peak_rss_source'] = 'cgroup'
+        record_run(run, output)
+        
+        if timed_out.is_set():
+            return False, f"Script timed out after {timeout} seconds"
+        if process.returncode == 0:
+            return True, "Script executed successfully"
+        else:
+            return False, "Script execution failed: " + "\n".join(output.tail(20))
+    except Exception as e:
+        return False, f"Error executing script: {str(e)}"
+    finally:
+        if owns_output:
+            output.close()
+
+# Job engine
+jobs = {}
+job_processes = {}
+jobs_lock = threading.Lock()
+job_queue = queue.Queue(maxsize=JOB_QUEUE_SIZE)
+job_workers = []
+
+def start_job_workers():
+    """Start the worker threads that run queued jobs"""
+    with jobs_lock:
+        if job_workers:
+            return
+        for i in range(JOB_WORKERS):
+            worker = threading.Thread(target=job_worker, name=f'job-worker-{i}', daemon=True)
+            worker.start()
+            job_workers.append(worker)
+        if state_store:
+            threading.Thread(target=job_cancel_watcher, name='job-cancel-watcher', daemon=True).start()
+
+def job_worker():
+    """Take jobs off the queue and run them one at a time"""
+    while True:
+        job_id = job_queue.get()
+        try:
+            run_job(job_id)
+        except Exception as e:
+            print(f"Error running job {job_id}: {e}")
+        finally:
+            job_queue.task_done()
+
+def job_cancel_watcher():
+    """Cancel local jobs that a request to another worker asked to cancel"""
+    while True:
+        time.sleep(STATE_POLL_INTERVAL)
+        with jobs_lock:
+            if not any(job['state'] in ('queued', 'running') for job in jobs.values()):
+                continue
+        try:
+            for job_id in state_store.cancel_requests('job'):
+                cancel_job(job_id)
+        except Exception as e:
+            print(f"Error checking for cancelled jobs: {e}")
+
+def store_job(job):
+    """Write a job record to the state store and tell open pages, called with jobs_lock held"""
+    event_hub.publish('jobs', job_event(job))
+    if state_store:
+        try:
+            state_store.save('job', job)
+        except Exception as e:
+            print(f"Error storing job {job['id']}: {e}")
+
+def run_job(job_id):
+    """Run a queued job and record its outcome"""
+    with jobs_lock:
+        job = jobs.get(job_id)
+        # Cancelled while still waiting in the queue
+        if job is None or job['state'] != 'queued':
+            return
+        job['state'] = 'running'
+        job['started'] = time.time()
+        store_job(job)
+    
+    success, message = execute_script(job['path'], timeout=JOB_TIMEOUT, job_id=job_id, output=job['output'])
+    # Other workers treat a finished job's stored output as complete
+    job['output'].flush()
+    
+    with jobs_lock:
+        if job['state'] == 'running':
+            job['state'] = 'finished' if success else 'failed'
+            job['message'] = message
+            job['finished'] = time.time()
+            store_job(job)
+    # Closed only once the final state is recorded so streams report it
+    job['output'].close()
+    prune_jobs()
+
+def submit_job(script_path, schedule_id=None):
+    """Queue a script for execution, returns the job or None if the queue is full"""
+    start_job_workers()
+    job_id = uuid.uuid4().hex
+    job = {
+        'id': job_id,
+        'script': os.path.relpath(script_path, SCRIPT_DIR),
+        'path': script_path,
+        'state': 'queued',
+        'message': 'Waiting for a free worker',
+        'created': time.time(),
+        'started': None,
+        'finished': None,
+        'schedule_id': schedule_id,
+        'output': OutputBuffer(store_id=job_id)
+    }
+    with jobs_lock:
+        jobs[job_id] = job
+        store_job(job)
+    try:
+        job_queue.put_nowait(job_id)
+    except queue.Full:
+        with jobs_lock:
+            jobs.pop(job_id, None)
+            if state_store:
+                state_store.delete(job_id)
+        return None
+    return job
+
+def get_job(job_id):
+    """Get the public fields of a job record"""
+    with jobs_lock:
+        job = jobs.get(job_id)
+    if job is None and state_store:
+        # Queued or run by another worker
+        job = state_store.load('job', job_id)
+    if job is None:
+        return None
+    return {key: value for key, value in job.items() if key not in ('path', 'output')}
+
+def get_job_output(job_id):
+    """Get the output buffer of a job"""
+    with jobs_lock:
+        job = jobs.get(job_id)
+    if job is not None:
+        return job['output']
+    if state_store and state_store.load('job', job_id):
+        return StoredOutput(job_id)
+    return None
+
+def cancel_job(job_id):
+    """Cancel a queued or running job"""
+    with jobs_lock:
+        job = jobs.get(job_id)
+    if job is None and state_store:
+        stored = state_store.load('job', job_id)
+        if stored is None:
+            return False, "Job not found"
+        if not state_store.request_cancel(job_id):
+            return False, f"Job is already {stored['state']}"
+        return True, "Cancellation requested"
+    
+    with jobs_lock:
+        if job is None:
+            return False, "Job not found"
+        if job['state'] not in ('queued', 'running'):
+            return False, f"Job is already {job['state']}"
+        job['state'] = 'cancelled'
+        job['message'] = 'Job cancelled'
+        job['finished'] = time.time()
+        store_job(job)
+        process = job_processes.get(job_id)
+        if process is None:
+            job['output'].close()
+    
+    if process is not None:
+        signal_process_group(process, signal.SIGTERM)
+    return True, "Job cancelled"
+
+def job_cancelled(job_id):
+    """Whether a job, or the pipeline run a step belongs to, was cancelled"""
+    run_id, _, step = job_id.partition(':')
+    if step:
+        return pipelines.get(run_id, {}).get('state') == 'cancelled'
+    return jobs.get(job_id, {}).get('state') == 'cancelled'
+
+def prune_jobs():
+    """Drop the oldest completed job records beyond JOB_HISTORY_LIMIT"""
+    if state_store:
+        state_store.prune('job', JOB_HISTORY_LIMIT)
+    with jobs_lock:
+        completed = [job for job in jobs.values() if job['finished'] is not None]
+        excess = len(completed) - JOB_HISTORY_LIMIT
+        if excess <= 0:
+            return
+        completed.sort(key=lambda job: job['finished'])
+        for job in completed[:excess]:
+            jobs.pop(job['id'], None)
+
+# Fan-out runs
+# Reads the script from stdin into a temporary file and runs it there, so it
+# runs with its own shebang and nothing has to be copied first
+NODE_SCRIPT_COMMAND = 'f=$(mktemp) && cat > "$f" && chmod +x "$f" && "$f"; code=$?; rm -f "$f"; exit $code'
+
+def node_script_command(node):
+    """Shell command that runs the script sent on stdin for a node"""
+    return f"export FANOUT_NODE={shlex.quote(node['name'])}; {NODE_SCRIPT_COMMAND}"
+
+class SshTransport:
+    """Runs a script on a node over ssh"""
+    
+    def command(self, node):
+        args = ['ssh'] + shlex.split(FANOUT_SSH_OPTIONS)
+        if node['port']:
+            args += ['-p', str(node['port'])]
+        if node['user']:
+            args += ['-l', node['user']]
+        return args + ['--', node['host'], node_script_command(node)]
+
+class LocalTransport:
+    """Runs a script the way a node would, as a local process, to try fan-out without hosts"""
+    
+    def command(self, node):
+        return ['sh', '-c', node_script_command(node)]
+
+FANOUT_TRANSPORTS = {'ssh': SshTransport(), 'local': LocalTransport()}
+
+def normalize_node(name, spec):
+    """Check one NODES_FILE entry, raises ValueError"""
+    if not isinstance(spec, dict) or not isinstance(spec.get('host'), str) or not spec['host']:
+        raise ValueError(f"Node {name} needs a host")
+    groups = spec.get('groups', [])
+    if not isinstance(groups, list) or not all(isinstance(group, str) for group in groups):
+        raise ValueError(f"Groups of node {name} must be a list of names")
+    transport = spec.get('transport', FANOUT_TRANSPORT)
+    if transport not in FANOUT_TRANSPORTS:
+        raise ValueError(f"Unknown transport {transport} for node {name}")
+    return {
+        'name': name,
+        'host': spec['host'],
+        'user': spec.get('user') or None,
+        'port': int(spec['port']) if spec.get('port') else None,
+        'groups': groups,
+        'transport': transport
+    }
+
+class NodeInventory:
+    """Hosts a script can be fanned out to.
+    
+    The NODES_FILE maps node names to {"host", "user", "port", "groups",
+    "transport"}, only the host is required. The file is re-read when it
+    changes.
+    """
+    
+    def __init__(self, path):
+        self.path = path
+        self.nodes = {}
+        self.mtime = None
+        self.lock = threading.Lock()
+    
+    def load(self):
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            mtime = None
+        with self.lock:
+            if mtime == self.mtime:
+                return self.nodes
+            self.mtime = mtime
+            if mtime is None:
+                self.nodes = {}
+                return self.nodes
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                self.nodes = {name: normalize_node(name, spec) for name, spec in data.items()}
+            except (OSError, ValueError, AttributeError) as e:
+                print(f"Error loading nodes, keeping the previous ones: {e}")
+            return self.nodes
+    
+    def select(self, names, groups):
+        """Get the nodes named in `names` or in one of `groups`, `*` names every node.
+        
+        Raises ValueError for a name or group that is not in the inventory.
+        """
+        nodes = self.load()
+        if '*' in names:
+            return list(nodes.values())
+        unknown = [name for name in names if name not in nodes]
+        if unknown:
+            raise ValueError(f"Unknown nodes: {', '.join(unknown)}")
+        known_groups = {group for node in nodes.values() for group in node['groups']}
+        unknown = [group for group in groups if group not in known_groups]
+        if unknown:
+            raise ValueError(f"Unknown groups: {', '.join(unknown)}")
+        return [node for name, node in nodes.items()
+                if name in names or any(group in groups for group in node['groups'])]
+
+node_inventory = NodeInventory(NODES_FILE)
+
+fanouts = {}
+fanouts_lock = threading.Lock()
+FANOUT_HISTORY_LIMIT = 50
+# Node states that count against max_failures
+FANOUT_FAILED_STATES = ('failed', 'timeout')
+
+def fanout_view(run):
+    """The public fields of a fan-out with its node counts"""
+    view = {key: value for key, value in run.items() if key not in ('path', 'outputs', 'processes')}
+    view['nodes'] = [dict(node) for node in run['nodes']]
+    view['counts'] = dict(Counter(node['state'] for node in run['nodes']))
+    return view
+
+def store_fanout(run):
+    """Write a fan-out record to the state store, called with fanouts_lock held"""
+    if state_store:
+        try:
+            state_store.save('fanout', fanout_view(run))
+        except Exception as e:
+            print(f"Error storing fan-out {run['id']}: {e}")
+
+def store_fanout_node(run, node):
+    """Write the state of one node, other workers follow its output through it"""
+    if state_store:
+        try:
+            state_store.save('fanout_node', {'id': run['outputs'][node['name']].store_id,
+                                             'state': node['state'], 'finished': node['finished']})
+        except Exception as e:
+            print(f"Error storing fan-out node {node['name']}: {e}")
+
+def submit_fanout(script_path, nodes, concurrency, batch_size, max_failures):
+    """Start running a script on `nodes`, returns the fan-out record"""
+    run_id = uuid.uuid4().hex
+    run = {
+        'id': run_id,
+        'script': os.path.relpath(script_path, SCRIPT_DIR),
+        'path': script_path,
+        'state': 'running',
+        'message': f'Running on {len(nodes)} nodes',
+        'created': time.time(),
+        'started': time.time(),
+        'finished': None,
+        'concurrency': concurrency,
+        'batch_size': batch_size,
+        'max_failures': max_failures,
+        'nodes': [{
+            'name': node['name'],
+            'host': node['host'],
+            'transport': node['transport'],
+            'batch': index // batch_size if batch_size else 0,
+            'state': 'queued',
+            'exit_code': None,
+            'started': None,
+            'finished': None,
+            'duration': None,
+            'last_line': None
+        } for index, node in enumerate(nodes)],
+        'outputs': {node['name']: OutputBuffer(maxlen=FANOUT_OUTPUT_LINES, store_id=f"{run_id}:{index}")
+                    for index, node in enumerate(nodes)},
+        'processes': {}
+    }
+    with fanouts_lock:
+        fanouts[run_id] = run
+        store_fanout(run)
+    for node in run['nodes']:
+        store_fanout_node(run, node)
+    inventory = {node['name']: node for node in nodes}
+    threading.Thread(target=run_fanout, args=(run, inventory), name=f'fanout-{run_id[:8]}', daemon=True).start()
+    return run
+
+def run_fanout(run, inventory):
+    """Run a fan-out batch by batch, at most `concurrency` nodes at a time"""
+    batch_size = run['batch_size'] or len(run['nodes'])
+    for first in range(0, len(run['nodes']), batch_size):
+        pending = deque(run['nodes'][first:first + batch_size])
+        workers = [threading.Thread(target=fanout_worker, args=(run, pending, inventory),
+                                    name=f"fanout-{run['id'][:8]}-{i}", daemon=True)
+                   for i in range(min(run['concurrency'], len(pending)))]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            while worker.is_alive():
+                worker.join(STATE_POLL_INTERVAL)
+                fanout_checkpoint(run)
+        if run['state'] != 'running':
+            break
+    
+    with fanouts_lock:
+        # Nodes that never started because the run was aborted or cancelled
+        for node in run['nodes']:
+            if node['state'] == 'queued':
+                node['state'] = 'cancelled' if run['state'] == 'cancelled' else 'skipped'
+        counts = Counter(node['state'] for node in run['nodes'])
+        failed = sum(counts[state] for state in FANOUT_FAILED_STATES)
+        if run['state'] == 'running':
+            run['state'] = 'failed' if failed else 'finished'
+        run['message'] = f"{counts['finished']} of {len(run['nodes'])} nodes succeeded, {failed} failed"
+        if counts['skipped']:
+            run['message'] += f", {counts['skipped']} skipped"
+        run['finished'] = time.time()
+        store_fanout(run)
+    for node in run['nodes']:
+        if node['state'] in ('skipped', 'cancelled') and node['started'] is None:
+            store_fanout_node(run, node)
+            run['outputs'][node['name']].close()
+    prune_fanouts()
+
+def fanout_checkpoint(run):
+    """Store the progress of a running fan-out and pick up cancel requests"""
+    if not state_store:
+        return
+    with fanouts_lock:
+        store_fanout(run)
+    try:
+        if run['id'] in state_store.cancel_requests('fanout'):
+            cancel_fanout(run['id'])
+    except Exception as e:
+        print(f"Error checking for cancelled fan-outs: {e}")
+
+def fanout_worker(run, pending, inventory):
+    """Take nodes of the current batch until it is empty or the run stops"""
+    while True:
+        with fanouts_lock:
+            if run['state'] != 'running' or not pending:
+                return
+            node = pending.popleft()
+            node['state'] = 'running'
+            node['started'] = time.time()
+        store_fanout_node(run, node)
+        try:
+            run_node(run, node, inventory[node['name']])
+        except Exception as e:
+            print(f"Error running fan-out node {node['name']}: {e}")
+            with fanouts_lock:
+                node['state'] = 'failed'
+                node['finished'] = time.time()
+        
+        output = run['outputs'][node['name']]
+        output.flush()
+        with fanouts_lock:
+            tail = output.tail(1)
+            node['last_line'] = tail[0] if tail else None
+            failed = sum(1 for other in run['nodes'] if other['state'] in FANOUT_FAILED_STATES)
+            if run['max_failures'] is not None and failed > run['max_failures'] and run['state'] == 'running':
+                run['state'] = 'aborted'
+                run['message'] = f"Aborted after {failed} failed nodes"
+        store_fanout_node(run, node)
+        output.close()
+
+def run_node(run, node, spec):
+    """Run the script on one node, recording its output, state and exit code"""
+    output = run['outputs'][node['name']]
+    started = time.monotonic()
+    try:
+        with open(run['path'], 'rb') as script:
+            process = subprocess.Popen(FANOUT_TRANSPORTS[spec['transport']].command(spec),
+                                       stdin=script,
+                                       stdout=subprocess.PIPE,
+                                       stderr=subprocess.STDOUT,
+                                       start_new_session=True)
+    except OSError as e:
+        output.append(f"Could not start {spec['transport']}: {e}")
+        with fanouts_lock:
+            node['state'] = 'failed'
+            node['finished'] = time.time()
+        return
+    with fanouts_lock:
+        run['processes'][node['name']] = process
+        # The run may have been cancelled before the process existed
+        if run['state'] == 'cancelled':
+            signal_process_group(process, signal.SIGTERM)
+    
+    timed_out = threading.Event()
+    def kill_on_timeout():
+        timed_out.set()
+        signal_process_group(process, signal.SIGKILL)
+    timer = threading.Timer(FANOUT_TIMEOUT, kill_on_timeout)
+    try:
+        timer.start()
+        for line in iter_process_lines(process):
+            output.append(line)
+        process.wait()
+    finally:
+        timer.cancel()
+        process.stdout.close()
+        with fanouts_lock:
+            run['processes'].pop(node['name'], None)
+    record_command(f"fanout {spec['transport']}", started, process.returncode == 0)
+    
+    with fanouts_lock:
+        node['exit_code'] = process.returncode
+        node['finished'] = time.time()
+        node['duration'] = node['finished'] - node['started']
+        if timed_out.is_set():
+            node['state'] = 'timeout'
+        elif run['state'] == 'cancelled':
+            node['state'] = 'cancelled'
+        else:
+            node['state'] = 'finished' if process.returncode == 0 else 'failed'
+
+def get_fanout(run_id):
+    """Get the public fields of a fan-out"""
+    with fanouts_lock:
+        run = fanouts.get(run_id)
+        if run is not None:
+            return fanout_view(run)
+    if state_store:
+        # Started by another worker
+        return state_store.load('fanout', run_id)
+    return None
+
+def get_fanout_output(run_id, name):
+    """Get the output buffer of one node of a fan-out"""
+    with fanouts_lock:
+        run = fanouts.get(run_id)
+    if run is not None:
+        return run['outputs'].get(name)
+    stored = state_store.load('fanout', run_id) if state_store else None
+    if stored is None:
+        return None
+    for index, node in enumerate(stored['nodes']):
+        if node['name'] == name:
+            return StoredOutput(f"{run_id}:{index}")
+    return None
+
+def cancel_fanout(run_id):
+    """Stop a running fan-out, nodes that did not start yet are skipped"""
+    with fanouts_lock:
+        run = fanouts.get(run_id)
+    if run is None and state_store:
+        stored = state_store.load('fanout', run_id)
+        if stored is None:
+            return False, "Fan-out not found"
+        if not state_store.request_cancel(run_id):
+            return False, f"Fan-out is already {stored['state']}"
+        return True, "Cancellation requested"
+    
+    with fanouts_lock:
+        if run is None:
+            return False, "Fan-out not found"
+        if run['state'] != 'running':
+            return False, f"Fan-out is already {run['state']}"
+        run['state'] = 'cancelled'
+        run['message'] = 'Fan-out cancelled'
+        store_fanout(run)
+        processes = list(run['processes'].values())
+    for process in processes:
+        signal_process_group(process, signal.SIGTERM)
+    return True, "Fan-out cancelled"
+
+def prune_fanouts():
+    """Drop the oldest completed fan-outs beyond FANOUT_HISTORY_LIMIT"""
+    if state_store:
+        for run_id in state_store.prune('fanout', FANOUT_HISTORY_LIMIT):
+            state_store.delete_children(run_id)
+    with fanouts_lock:
+        completed = sorted((run for run in fanouts.values() if run['finished'] is not None),
+                           key=lambda run: run['finished'])
+        for run in completed[:max(len(completed) - FANOUT_HISTORY_LIMIT, 0)]:
+            fanouts.pop(run['id'], None)
+
+# Pipelines
+PIPELINE_SUFFIX = '.pipeline.json'
+pipelines = {}
+pipelines_lock = threading.Lock()
+# Notified when a step ends or a pipeline is cancelled
+pipelines_changed = threading.Condition(pipelines_lock)
+PIPELINE_HISTORY_LIMIT = 50
+# Step states that let the steps after it run
+PIPELINE_DONE_STATES = ('finished', 'reused')
+PIPELINE_MAX_RETRY_DELAY = 300
+
+def load_pipeline(file_path):
+    """Read and check a pipeline definition, raises ValueError when it is invalid.
+    
+    Scripts are relative to the directory of the pipeline file. Returns the
+    steps in an order where every step comes after the steps it needs.
+    """
+    try:
+        with open(file_path, 'r', encoding='utf-8') as f:
+            definition = json.load(f)
+    except OSError as e:
+        raise ValueError(f"Could not read pipeline: {e}")
+    except json.JSONDecodeError as e:
+        raise ValueError(f"Invalid JSON: {e}")
+    if not isinstance(definition, dict) or not isinstance(definition.get('steps'), dict) or not definition['steps']:
+        raise ValueError("A pipeline needs a 'steps' object")
+    
+    base = os.path.relpath(os.path.dirname(file_path), SCRIPT_DIR)
+    steps = {}
+    for name, spec in definition['steps'].items():
+        if isinstance(spec, str):
+            spec = {'script': spec}
+        if not isinstance(spec, dict) or not isinstance(spec.get('script'), str):
+            raise ValueError(f"Step {name} needs a 'script'")
+        script_path = resolve_script_path(os.path.join(base, spec['script']))
+        if script_path is None or not script_path.endswith('.sh'):
+            raise ValueError(f"Step {name} does not name a .sh file in the script directory")
+        needs = spec.get('needs', [])
+        if isinstance(needs, str):
+            needs = [needs]
+        unknown = [need for need in needs if need not in definition['steps']]
+        if unknown:
+            raise ValueError(f"Step {name} needs unknown steps: {', '.join(unknown)}")
+        try:
+            retries = int(spec.get('retries', definition.get('retries', 0)))
+            retry_delay = float(spec.get('retry_delay', definition.get('retry_delay', PIPELINE_RETRY_DELAY)))
+            timeout = float(spec.get('timeout', definition.get('timeout', JOB_TIMEOUT)))
+        except (TypeError, ValueError):
+            raise ValueError(f"Step {name} has an invalid retries, retry_delay or timeout")
+        if retries < 0 or retry_delay < 0 or timeout <= 0:
+            raise ValueError(f"Step {name} has an invalid retries, retry_delay or timeout")
+        steps[name] = {
+            'name': name,
+            'script': os.path.relpath(script_path, SCRIPT_DIR),
+            'needs': list(dict.fromkeys(needs)),
+            'retries': retries,
+            'retry_delay': retry_delay,
+            'timeout': timeout
+        }
+    
+    # Kahn's algorithm, whatever is left over is part of a cycle
+    remaining = {name: len(step['needs']) for name, step in steps.items()}
+    ordered = []
+    ready = deque(name for name, count in remaining.items() if count == 0)
+    while ready:
+        name = ready.popleft()
+        ordered.append(steps[name])
+        for other in steps.values():
+            if name in other['needs']:
+                remaining[other['name']] -= 1
+                if remaining[other['name']] == 0:
+                    ready.append(other['name'])
+    if len(ordered) < len(steps):
+        cycle = sorted(name for name in steps if remaining[name] > 0)
+        raise ValueError(f"Steps depend on each other in a cycle: {', '.join(cycle)}")
+    try:
+        concurrency = int(definition.get('concurrency', PIPELINE_CONCURRENCY))
+    except (TypeError, ValueError):
+        raise ValueError("Invalid concurrency")
+    return {
+        'steps': ordered,
+        'concurrency': min(max(concurrency, 1), PIPELINE_CONCURRENCY),
+        'keep_workspace': bool(definition.get('keep_workspace', False))
+    }
+
+def pipeline_view(run):
+    """The public fields of a pipeline run with its step counts"""
+    view = {key: value for key, value in run.items() if key not in ('path', 'outputs')}
+    view['steps'] = [dict(step) for step in run['steps']]
+    view['counts'] = dict(Counter(step['state'] for step in run['steps']))
+    return view
+
+def store_pipeline(run):
+    """Write a pipeline record to the state store, called with pipelines_lock held"""
+    if state_store:
+        try:
+            state_store.save('pipeline', pipeline_view(run))
+        except Exception as e:
+            print(f"Error storing pipeline {run['id']}: {e}")
+
+def store_pipeline_step(run, step):
+    """Write the state of one step, other workers follow its output through it"""
+    if state_store:
+        try:
+            state_store.save('pipeline_step', {'id': run['outputs'][step['name']].store_id,
+                                               'state': step['state'], 'finished': step['finished']})
+        except Exception as e:
+            print(f"Error storing pipeline step {step['name']}: {e}")
+
+def submit_pipeline(file_path, definition, resumed=None):
+    """Start running a pipeline, returns its record.
+    
+    A run resumed from `resumed`, an earlier run that failed, works in the
+    same workspace and reuses the steps that finished there.
+    """
+    run_id = uuid.uuid4().hex
+    done = {step['name'] for step in resumed['steps'] if step['state'] in PIPELINE_DONE_STATES} if resumed else set()
+    run = {
+        'id': run_id,
+        'pipeline': os.path.relpath(file_path, SCRIPT_DIR),
+        'path': file_path,
+        'state': 'running',
+        'message': f"Running {len(definition['steps'])} steps",
+        'created': time.time(),
+        'started': time.time(),
+        'finished': None,
+        'duration': None,
+        'concurrency': definition['concurrency'],
+        'workspace': resumed['workspace'] if resumed else os.path.join(PIPELINE_WORKSPACE_DIR, run_id),
+        'keep_workspace': definition['keep_workspace'],
+        'resumed_from': resumed['id'] if resumed else None,
+        'critical_path': None,
+        'steps': [dict(step,
+                       state='reused' if step['name'] in done else 'waiting',
+                       attempts=0,
+                       ready=None,
+                       started=None,
+                       finished=None,
+                       duration=None,
+                       wait=None,
+                       message=None) for step in definition['steps']],
+        'outputs': {step['name']: OutputBuffer(store_id=f"{run_id}:{step['name']}") for step in definition['steps']}
+    }
+    with pipelines_lock:
+        pipelines[run_id] = run
+        store_pipeline(run)
+    for step in run['steps']:
+        store_pipeline_step(run, step)
+    os.makedirs(run['workspace'], exist_ok=True)
+    threading.Thread(target=run_pipeline, args=(run,), name=f'pipeline-{run_id[:8]}', daemon=True).start()
+    return run
+
+def run_pipeline(run):
+    """Run the steps of a pipeline as their needs finish, at most `concurrency` at a time"""
+    steps = {step['name']: step for step in run['steps']}
+    running = set()
+    while True:
+        with pipelines_lock:
+            running = {name for name in running if steps[name]['state'] in ('running', 'retrying')}
+            for step in run['steps']:
+                if step['state'] != 'waiting':
+                    continue
+                needs = [steps[name]['state'] for name in step['needs']]
+                if any(state not in PIPELINE_DONE_STATES + ('waiting', 'running', 'retrying') for state in needs):
+                    # A step it needs failed, this one cannot run in this run
+                    step['state'] = 'skipped'
+                    step['finished'] = time.time()
+                    store_pipeline_step(run, step)
+                    run['outputs'][step['name']].close()
+                    continue
+                if any(state not in PIPELINE_DONE_STATES for state in needs):
+                    continue
+                if step['ready'] is None:
+                    step['ready'] = time.time()
+                if run['state'] == 'running' and len(running) < run['concurrency']:
+                    step['state'] = 'running'
+                    running.add(step['name'])
+                    threading.Thread(target=pipeline_worker, args=(run, step),
+                                     name=f"pipeline-{run['id'][:8]}-{step['name']}", daemon=True).start()
+            if not running:
+                break
+            pipelines_changed.wait(STATE_POLL_INTERVAL)
+        pipeline_checkpoint(run)
+    
+    with pipelines_lock:
+        # Steps that never started because the run was cancelled or a step before them failed
+        for step in run['steps']:
+            if step['state'] == 'waiting':
+                step['state'] = 'cancelled' if run['state'] == 'cancelled' else 'skipped'
+                step['finished'] = time.time()
+        counts = Counter(step['state'] for step in run['steps'])
+        failed = counts['failed']
+        if run['state'] == 'running':
+            run['state'] = 'failed' if failed or counts['skipped'] else 'finished'
+        done = counts['finished'] + counts['reused']
+        run['message'] = f"{done} of {len(run['steps'])} steps succeeded, {failed} failed"
+        if counts['skipped']:
+            run['message'] += f", {counts['skipped']} skipped"
+        run['finished'] = time.time()
+        run['duration'] = run['finished'] - run['started']
+        run['critical_path'] = critical_path(run)
+        store_pipeline(run)
+    for step in run['steps']:
+        if step['started'] is None and not run['outputs'][step['name']].closed:
+            store_pipeline_step(run, step)
+            run['outputs'][step['name']].close()
+    if run['state'] == 'finished' and not run['keep_workspace']:
+        shutil.rmtree(run['workspace'], ignore_errors=True)
+    prune_pipelines()
+
+def pipeline_checkpoint(run):
+    """Store the progress of a running pipeline and pick up cancel requests"""
+    if not state_store:
+        return
+    with pipelines_lock:
+        store_pipeline(run)
+    try:
+        if run['id'] in state_store.cancel_requests('pipeline'):
+            cancel_pipeline(run['id'])
+    except Exception as e:
+        print(f"Error checking for cancelled pipelines: {e}")
+
+def pipeline_worker(run, step):
+    """Run one step, retrying it with exponential backoff"""
+    output = run['outputs'][step['name']]
+    step_id = f"{run['id']}:{step['name']}"
+    env = dict(os.environ,
+               PIPELINE_RUN_ID=run['id'],
+               PIPELINE_STEP=step['name'],
+               PIPELINE_WORKSPACE=run['workspace'])
+    with pipelines_lock:
+        step['started'] = time.time()
+        step['wait'] = step['started'] - step['ready']
+    while True:
+        with pipelines_lock:
+            step['attempts'] += 1
+            step['state'] = 'running'
+        store_pipeline_step(run, step)
+        env['PIPELINE_ATTEMPT'] = str(step['attempts'])
+        try:
+            success, message = execute_script(os.path.join(SCRIPT_DIR, step['script']), timeout=step['timeout'],
+                                              job_id=step_id, output=output, env=env, cwd=run['workspace'])
+        except Exception as e:
+            success, message = False, f"Error running step: {e}"
+        
+        with pipelines_lock:
+            step['message'] = message
+            if success or run['state'] != 'running' or step['attempts'] > step['retries']:
+                break
+            delay = min(step['retry_delay'] * 2 ** (step['attempts'] - 1), PIPELINE_MAX_RETRY_DELAY)
+            step['state'] = 'retrying'
+            output.append(f"Attempt {step['attempts']} failed, retrying in {delay:g}s")
+            # Woken up early when the run is cancelled
+            pipelines_changed.wait_for(lambda: run['state'] != 'running', delay)
+            if run['state'] != 'running':
+                break
+    
+    with pipelines_lock:
+        if success:
+            step['state'] = 'finished'
+        else:
+            step['state'] = 'cancelled' if run['state'] == 'cancelled' else 'failed'
+        step['finished'] = time.time()
+        step['duration'] = step['finished'] - step['started']
+        pipelines_changed.notify_all()
+    output.flush()
+    store_pipeline_step(run, step)
+    output.close()
+
+def critical_path(run):
+    """The chain of steps that decided when the run finished.
+    
+    Starts from the step that finished last and goes back through the step
+    each one waited for the longest, the one of its needs that finished
+    last. Steps reused from an earlier run took no time in this one.
+    """
+    steps = {step['name']: step for step in run['steps'] if step['started'] is not None}
+    if not steps:
+        return None
+    current = max(steps.values(), key=lambda step: step['finished'])
+    path = []
+    while current is not None:
+        path.append(current)
+        needs = [steps[name] for name in current['needs'] if name in steps]
+        current = max(needs, key=lambda step: step['finished']) if needs else None
+    path.reverse()
+    return {
+        'steps': [{'name': step['name'], 'duration': step['duration'], 'wait': step['wait']} for step in path],
+        'duration': sum(step['duration'] or 0 for step in path),
+        'wait': sum(step['wait'] or 0 for step in path)
+    }
+
+def get_pipeline(run_id):
+    """Get the public fields of a pipeline run"""
+    with pipelines_lock:
+        run = pipelines.get(run_id)
+        if run is not None:
+            return pipeline_view(run)
+    if state_store:
+        # Started by another worker
+        return state_store.load('pipeline', run_id)
+    return None
+
+def get_pipeline_output(run_id, name):
+    """Get the output buffer of one step of a pipeline run"""
+    with pipelines_lock:
+        run = pipelines.get(run_id)
+    if run is not None:
+        return run['outputs'].get(name)
+    stored = state_store.load('pipeline', run_id) if state_store else None
+    if stored is None or not any(step['name'] == name for step in stored['steps']):
+        return None
+    return StoredOutput(f"{run_id}:{name}")
+
+def cancel_pipeline(run_id):
+    """Stop a running pipeline, steps that did not start yet are cancelled"""
+    with pipelines_lock:
+        run = pipelines.get(run_id)
+    if run is None and state_store:
+        stored = state_store.load('pipeline', run_id)
+        if stored is None:
+            return False, "Pipeline run not found"
+        if not state_store.request_cancel(run_id):
+            return False, f"Pipeline run is already {stored['state']}"
+        return True, "Cancellation requested"
+    
+    with pipelines_lock:
+        if run is None:
+            return False, "Pipeline run not found"
+        if run['state'] != 'running':
+            return False, f"Pipeline run is already {run['state']}"
+        run['state'] = 'cancelled'
+        run['message'] = 'Pipeline cancelled'
+        store_pipeline(run)
+        pipelines_changed.notify_all()
+    with jobs_lock:
+        processes = [job_processes.get(f"{run_id}:{step['name']}") for step in run['steps']]
+    for process in processes:
+        if process is not None:
+            signal_process_group(process, signal.SIGTERM)
+    return True, "Pipeline cancelled"
+
+def resume_pipeline(run_id):
+    """Run a failed or cancelled pipeline again from the steps that did not finish.
+    
+    Returns (run, error message).
+    """
+    resumed = get_pipeline(run_id)
+    if resumed is None:
+        return None, "Pipeline run not found"
+    if resumed['state'] not in ('failed', 'cancelled'):
+        return None, f"Pipeline run is {resumed['state']}, only failed or cancelled runs can be resumed"
+    if not os.path.isdir(resumed['workspace']):
+        return None, "The workspace of the run was removed"
+    with pipelines_lock:
+        active = [run for run in pipelines.values() if run['state'] == 'running']
+    if state_store:
+        active += state_store.active('pipeline')
+    if any(run['workspace'] == resumed['workspace'] for run in active):
+        return None, "A run in the same workspace is still running"
+    file_path = resolve_script_path(resumed['pipeline'])
+    # The current definition, the failed steps may have been fixed
+    definition = load_pipeline(file_path)
+    return submit_pipeline(file_path, definition, resumed), None
+
+def prune_pipelines():
+    """Drop the oldest completed pipeline runs beyond PIPELINE_HISTORY_LIMIT and their workspaces"""
+    if state_store:
+        for run_id in state_store.prune('pipeline', PIPELINE_HISTORY_LIMIT):
+            state_store.delete_children(run_id)
+    with pipelines_lock:
+        completed = sorted((run for run in pipelines.values() if run['finished'] is not None),
+                           key=lambda run: run['finished'])
+        for run in completed[:max(len(completed) - PIPELINE_HISTORY_LIMIT, 0)]:
+            pipelines.pop(run['id'], None)
+        known = {run['workspace'] for run in pipelines.values()}
+    if state_store:
+        known.update(run['workspace'] for run in state_store.records('pipeline'))
+    try:
+        names = os.listdir(PIPELINE_WORKSPACE_DIR)
+    except FileNotFoundError:
+        return
+    # Resumed runs share a workspace, it goes with the last run using it
+    for name in names:
+        path = os.path.join(PIPELINE_WORKSPACE_DIR, name)
+        if path not in known:
+            shutil.rmtree(path, ignore_errors=True)
+
+def list_pipelines():
+    """Find the pipeline definitions in SCRIPT_DIR and check each one"""
+    found = []
+    for file in get_all_files():
+        relpath = file['relpath']
+        if not relpath.endswith(PIPELINE_SUFFIX):
+            continue
+        entry = {'pipeline': relpath}
+        try:
+            definition = load_pipeline(os.path.join(SCRIPT_DIR, relpath))
+            entry['steps'] = [{'name': step['name'], 'script': step['script'], 'needs': step['needs']}
+                              for step in definition['steps']]
+            entry['concurrency'] = definition['concurrency']
+        except ValueError as e:
+            entry['error'] = str(e)
+        found.append(entry)
+    return found
+
+# Scheduler
+class CronExpression:
+    """Five field cron expression: minute, hour, day of month, month, day of week.
+    
+    Supports `*`, numbers, names, ranges, lists and steps. As in cron, when
+    both day fields are restricted a day matching either one fires.
+    """
+    
+    FIELDS = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+    NAMES = {
+        3: ('jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec'),
+        4: ('sun', 'mon', 'tue', 'wed', 'thu', 'fri', 'sat')
+    }
+    MACROS = {
+        '@hourly': '0 * * * *',
+        '@daily': '0 0 * * *',
+        '@midnight': '0 0 * * *',
+        '@weekly': '0 0 * * 0',
+        '@monthly': '0 0 1 * *',
+        '@yearly': '0 0 1 1 *',
+        '@annually': '0 0 1 1 *'
+    }
+    
+    def __init__(self, text):
+        fields = self.MACROS.get(text.strip().lower(), text).split()
+        if len(fields) != 5:
+            raise ValueError("Cron expression needs 5 fields")
+        self.minutes, self.hours, self.days, self.months, self.weekdays = [
+            self.parse_field(field, index) for index, field in enumerate(fields)]
+        # Sunday may be written as 0 or 7
+        if 7 in self.weekdays:
+            self.weekdays = (self.weekdays - {7}) | {0}
+        self.any_day = fields[2] == '*'
+        self.any_weekday = fields[4] == '*'
+    
+    def parse_value(self, value, index):
+        names = self.NAMES.get(index)
+        if names and value.lower() in names:
+            return names.index(value.lower()) + (1 if index == 3 else 0)
+        return int(value)
+    
+    def parse_field(self, field, index):
+        low, high = self.FIELDS[index]
+        values = set()
+        for part in field.split(','):
+            spec, _, step = part.partition('/')
+            step = int(step) if step else 1
+            if spec == '*':
+                start, end = low, high
+            elif '-' in spec:
+                start, end = (self.parse_value(value, index) for value in spec.split('-', 1))
+            else:
+                start = self.parse_value(spec, index)
+                end = high if step > 1 else start
+            if step < 1 or not low <= start <= end <= high:
+                raise ValueError(f"Invalid cron field '{field}'")
+            values.update(range(start, end + 1, step))
+        return values
+    
+    def matches_day(self, moment):
+        in_days = moment.day in self.days
+        in_weekdays = (moment.weekday() + 1) % 7 in self.weekdays
+        if self.any_day:
+            return in_weekdays
+        if self.any_weekday:
+            return in_days
+        return in_days or in_weekdays
+    
+    def next_after(self, timestamp):
+        """Get the first matching minute after `timestamp`, in local time"""
+        moment = datetime.fromtimestamp(timestamp).replace(second=0, microsecond=0) + timedelta(minutes=1)
+        last_year = moment.year + 5
+        while moment.year <= last_year:
+            if moment.month not in self.months:
+                moment = (moment.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self.matches_day(moment):
+                moment = moment.replace(hour=0, minute=0) + timedelta(days=1)
+            elif moment.hour not in self.hours:
+                moment = moment.replace(minute=0) + timedelta(hours=1)
+            elif moment.minute not in self.minutes:
+                moment += timedelta(minutes=1)
+            else:
+                return moment.timestamp()
+        raise ValueError("Cron expression never matches")
+
+class Scheduler(SQLiteStore):
+    """Runs scripts on cron expressions or fixed intervals.
+    
+    Schedules are kept in SQLite so they survive restarts and every worker
+    can edit them. One worker, the holder of a file lock, runs them from a
+    heap ordered by due time with a single thread.
+    """
+    
+    OVERLAP_POLICIES = ('skip', 'queue', 'kill')
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS schedules (
+            id TEXT PRIMARY KEY,
+            script TEXT NOT NULL,
+            cron TEXT,
+            interval REAL,
+            jitter REAL NOT NULL DEFAULT 0,
+            overlap TEXT NOT NULL DEFAULT 'skip',
+            catch_up INTEGER NOT NULL DEFAULT 0,
+            enabled INTEGER NOT NULL DEFAULT 1,
+            created REAL NOT NULL,
+            last_run REAL
+        );
+    '''
+    COLUMNS = ('id', 'script', 'cron', 'interval', 'jitter', 'overlap', 'catch_up', 'enabled', 'created', 'last_run')
+    PRAGMAS = ('journal_mode=WAL',)
+    
+    def __init__(self, path):
+        super().__init__(path)
+        self.cron_cache = {}
+        self.lock_file = None
+        self.wakeup = threading.Event()
+        self.heap = []
+        self.schedules = {}
+        self.pending = deque()
+        self.active_jobs = set()
+        self.last_jobs = {}
+        self.data_version = None
+    
+    def row_to_schedule(self, row):
+        schedule = dict(zip(self.COLUMNS, row))
+        schedule['catch_up'] = bool(schedule['catch_up'])
+        schedule['enabled'] = bool(schedule['enabled'])
+        return schedule
+    
+    def list(self):
+        rows = self.connection().execute(f"SELECT {', '.join(self.COLUMNS)} FROM schedules ORDER BY script, id")
+        return [self.row_to_schedule(row) for row in rows]
+    
+    def get(self, schedule_id):
+        row = self.connection().execute(
+            f"SELECT {', '.join(self.COLUMNS)} FROM schedules WHERE id = ?", (schedule_id,)).fetchone()
+        return self.row_to_schedule(row) if row else None
+    
+    def validate(self, schedule):
+        """Check a schedule record, returns an error message or None"""
+        if not schedule.get('script') or resolve_script_path(schedule['script']) is None:
+            return "A script inside SCRIPT_DIR is required"
+        if not schedule['script'].endswith('.sh'):
+            return "Only .sh files can be executed"
+        if bool(schedule.get('cron')) == bool(schedule.get('interval')):
+            return "Give either a cron expression or an interval"
+        try:
+            if schedule.get('cron'):
+                self.parse_cron(schedule['cron']).next_after(time.time())
+            elif float(schedule['interval']) < 1:
+                return "Interval must be at least 1 second"
+            if float(schedule.get('jitter') or 0) < 0:
+                return "Jitter cannot be negative"
+        except (TypeError, ValueError) as e:
+            return str(e) or "Invalid schedule"
+        if schedule.get('overlap', 'skip') not in self.OVERLAP_POLICIES:
+            return f"Overlap must be one of {', '.join(self.OVERLAP_POLICIES)}"
+        return None
+    
+    def save(self, schedule):
+        """Insert or replace a schedule, the running worker picks it up"""
+        values = dict(schedule)
+        values.setdefault('id', uuid.uuid4().hex)
+        values.setdefault('created', time.time())
+        values['jitter'] = float(values.get('jitter') or 0)
+        values['interval'] = float(values['interval']) if values.get('interval') else None
+        values['cron'] = values.get('cron') or None
+        values['overlap'] = values.get('overlap') or 'skip'
+        values['catch_up'] = bool(values.get('catch_up', False))
+        values['enabled'] = bool(values.get('enabled', True))
+        values.setdefault('last_run', None)
+        self.connection().execute(
+            f"INSERT OR REPLACE INTO schedules ({', '.join(self.COLUMNS)}) VALUES ({', '.join('?' * len(self.COLUMNS))})",
+            [values[column] for column in self.COLUMNS])
+        self.wakeup.set()
+        return values
+    
+    def delete(self, schedule_id):
+        cursor = self.connection().execute('DELETE FROM schedules WHERE id = ?', (schedule_id,))
+        self.wakeup.set()
+        return cursor.rowcount > 0
+    
+    def parse_cron(self, text):
+        cron = self.cron_cache.get(text)
+        if cron is None:
+            cron = self.cron_cache[text] = CronExpression(text)
+        return cron
+    
+    def jitter_offset(self, schedule):
+        """Stable per-schedule delay in [0, jitter) so schedules sharing a time spread out"""
+        if not schedule['jitter']:
+            return 0
+        return zlib.crc32(schedule['id'].encode()) / 2 ** 32 * schedule['jitter']
+    
+    def next_run(self, schedule, after):
+        """Get the first run time of a schedule after `after`"""
+        offset = self.jitter_offset(schedule)
+        if schedule['cron']:
+            return self.parse_cron(schedule['cron']).next_after(after - offset) + offset
+        anchor = schedule['created'] + offset
+        return anchor + max(int((after - anchor) // schedule['interval']) + 1, 1) * schedule['interval']
+    
+    def start(self):
+        threading.Thread(target=self.run, name='scheduler', daemon=True).start()
+    
+    def run(self):
+        # Only one worker runs the schedules
+        self.lock_file = flock_leader(self.path + '.lock')
+        while True:
+            try:
+                self.tick()
+            except Exception as e:
+                print(f"Scheduler error: {e}")
+                time.sleep(1)
+    
+    def reload(self):
+        """Rebuild the heap from the database, firing missed runs that catch up"""
+        now = time.time()
+        self.schedules = {schedule['id']: schedule for schedule in self.list() if schedule['enabled']}
+        self.heap = []
+        for schedule in self.schedules.values():
+            due = self.next_run(schedule, schedule['last_run'] or schedule['created'])
+            if due <= now and not schedule['catch_up']:
+                due = self.next_run(schedule, now)
+            self.heap.append((due, schedule['id']))
+        heapq.heapify(self.heap)
+    
+    def tick(self):
+        version = self.connection().execute('PRAGMA data_version').fetchone()[0]
+        if version != self.data_version or self.wakeup.is_set():
+            self.wakeup.clear()
+            self.data_version = version
+            self.reload()
+        
+        now = time.time()
+        while self.heap and self.heap[0][0] <= now:
+            _, schedule_id = heapq.heappop(self.heap)
+            schedule = self.schedules.get(schedule_id)
+            if schedule is None:
+                continue
+            schedule['last_run'] = now
+            self.connection().execute('UPDATE schedules SET last_run = ? WHERE id = ?', (now, schedule_id))
+            # Missed runs are coalesced into the one firing now
+            heapq.heappush(self.heap, (self.next_run(schedule, now), schedule_id))
+            if schedule_id not in self.pending:
+                self.pending.append(schedule_id)
+        self.dispatch()
+        
+        # Wake for the next due run, while runs wait for a free slot, and to
+        # notice schedules that other workers changed
+        timeout = 1 if self.pending else 5
+        if self.heap:
+            timeout = min(timeout, max(self.heap[0][0] - time.time(), 0))
+        self.wakeup.wait(timeout)
+    
+    def dispatch(self):
+        """Start pending runs while fewer than SCHEDULER_MAX_RUNNING are active"""
+        self.active_jobs = {job_id for job_id in self.active_jobs
+                            if (get_job(job_id) or {}).get('state') in ('queued', 'running')}
+        waiting = deque()
+        while self.pending:
+            schedule = self.schedules.get(self.pending.popleft())
+            if schedule is None:
+                continue
+            previous = self.last_jobs.get(schedule['id'])
+            overlapping = previous in self.active_jobs
+            if overlapping and schedule['overlap'] == 'skip':
+                print(f"Skipping scheduled run of {schedule['script']}, the previous run is still active")
+            elif overlapping and schedule['overlap'] == 'kill':
+                # Takes over the slot of the run it replaces
+                cancel_job(previous)
+                self.active_jobs.discard(previous)
+                self.start_run(schedule)
+            elif overlapping:
+                # Queued behind the previous run, later firings are coalesced into this one
+                waiting.append(schedule['id'])
+            elif len(self.active_jobs) < SCHEDULER_MAX_RUNNING:
+                self.start_run(schedule)
+            else:
+                waiting.append(schedule['id'])
+        self.pending = waiting
+    
+    def start_run(self, schedule):
+        script_path = resolve_script_path(schedule['script'])
+        if script_path is None or not os.path.isfile(script_path):
+            print(f"Skipping scheduled run of {schedule['script']}, the script does not exist")
+            return
+        # Schedules stored before the check in validate() was added
+        if not script_path.endswith('.sh'):
+            print(f"Skipping scheduled run of {schedule['script']}, only .sh files can be executed")
+            return
+        job = submit_job(script_path, schedule_id=schedule['id'])
+        if job is None:
+            print(f"Skipping scheduled run of {schedule['script']}, the job queue is full")
+            return
+        self.last_jobs[schedule['id']] = job['id']
+        self.active_jobs.add(job['id'])
+
+scheduler = Scheduler(SCHEDULE_DB) if SCHEDULE_DB else None
+
+def tmux_quote(value):
+    """Quote a value for use in a tmux command line"""
+    value = str(value).replace('\n', ' ')
+    for char in ('\\', '"', '$'):
+        value = value.replace(char, '\\' + char)
+    return f'"{value}"'
+
+class TmuxControlClient:
+    """Long-lived `tmux -C` connection.
+    
+    Commands are written to tmux's stdin and the %begin/%end block that
+    answers each one is matched back to the caller in order. Notifications
+    such as %output are passed to `on_notification` as (name, args).
+    """
+    
+    def __init__(self, args, on_notification=None):
+        self.on_notification = on_notification
+        self.pending = deque()
+        self.lock = threading.Lock()
+        self.closed = threading.Event()
+        self.process = subprocess.Popen(['tmux', '-C'] + args,
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.DEVNULL,
+                                        env=dict(os.environ, TERM=TMUX_CLIENT_TERM),
+                                        text=True,
+                                        encoding='utf-8',
+                                        errors='replace')
+        self.reader = threading.Thread(target=self.read_loop, name='tmux-control', daemon=True)
+        self.reader.start()
+    
+    def command(self, command, timeout=5):
+        """Run a tmux command, returns (success, output lines)"""
+        label = 'tmux ' + command.split(' ', 1)[0]
+        started = time.monotonic()
+        request = {'done': threading.Event(), 'lines': [], 'success': False}
+        with self.lock:
+            if self.closed.is_set():
+                return False, ['tmux connection closed']
+            try:
+                self.pending.append(request)
+                self.process.stdin.write(command + '\n')
+                self.process.stdin.flush()
+            except (BrokenPipeError, OSError):
+                self.pending.remove(request)
+                return False, ['tmux connection closed']
+        if not request['done'].wait(timeout):
+            record_command(label, started, False)
+            return False, ['tmux command timed out']
+        record_command(label, started, request['success'])
+        return request['success'], request['lines']
+    
+    def read_loop(self):
+        block = None
+        try:
+            for line in self.process.stdout:
+                line = line.rstrip('\n')
+                if block is not None:
+                    # Only the matching %end/%error closes a block, output may start with %
+                    if line.startswith(('%end ', '%error ')) and line.split(' ')[2] == block['number']:
+                        request = block['request']
+                        if request is not None:
+                            request['success'] = line.startswith('%end ')
+                            request['done'].set()
+                        block = None
+                    elif block['request'] is not None:
+                        block['request']['lines'].append(line)
+                    continue
+                
+                if line.startswith('%begin '):
+                    parts = line.split(' ')
+                    # Flag 1 marks replies to our own commands, the rest answer
+                    # the command tmux was started with
+                    request = None
+                    if parts[3] == '1':
+                        with self.lock:
+                            request = self.pending.popleft() if self.pending else None
+                    block = {'number': parts[2], 'request': request}
+                elif line.startswith('%'):
+                    name, _, args = line.partition(' ')
+                    if self.on_notification:
+                        self.on_notification(name, args)
+                    if name == '%exit':
+                        break
+        except Exception as e:
+            print(f"Error reading from tmux: {e}")
+        finally:
+            self.close()
+            if self.on_notification:
+                self.on_notification('%closed', '')
+    
+    def close(self):
+        """Shut down the connection and fail any waiting commands"""
+        with self.lock:
+            if self.closed.is_set():
+                return
+            self.closed.set()
+            while self.pending:
+                request = self.pending.popleft()
+                request['lines'] = ['tmux connection closed']
+                request['done'].set()
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+        if self.process.poll() is None:
+            self.process.terminate()
+
+class TmuxStreamer:
+    """Shares one control-mode connection between all viewers of a session.
+    
+    %output notifications mark the pane dirty, the pane is then captured over
+    the same connection at most once per TMUX_STREAM_INTERVAL and only the
+    lines that changed are sent to subscribers.
+    """
+    
+    def __init__(self, session_name):
+        self.session_name = session_name
+        self.target = f'{session_name}:0.0'
+        self.lines = None
+        self.subscribers = []
+        self.lock = threading.Lock()
+        self.dirty = threading.Event()
+        self.stopped = threading.Event()
+        self.dirty.set()
+        self.client = TmuxControlClient(['attach-session', '-r', '-t', session_name],
+                                        on_notification=self.handle_notification)
+        self.thread = threading.Thread(target=self.run, name=f'tmux-stream-{session_name}', daemon=True)
+        self.thread.start()
+    
+    def handle_notification(self, name, args):
+        if name == '%output':
+            self.dirty.set()
+        elif name in ('%exit', '%closed'):
+            self.stopped.set()
+            self.dirty.set()
+    
+    def run(self):
+        # Viewers should never change the size of the session's windows
+        self.client.command('refresh-client -f ignore-size')
+        while not self.stopped.is_set():
+            self.dirty.wait()
+            if self.stopped.is_set():
+                break
+            self.dirty.clear()
+            success, lines = self.client.command(f'capture-pane -p -t {tmux_quote(self.target)}')
+            if success:
+                # Drop the blank rows below the cursor
+                while lines and not lines[-1].strip():
+                    lines.pop()
+                self.publish(lines)
+            # Coalesce bursts of output into one capture
+            self.stopped.wait(TMUX_STREAM_INTERVAL)
+        self.client.close()
+        with self.lock:
+            for subscriber in self.subscribers:
+                self.send(subscriber, 'closed', None)
+    
+    def publish(self, lines):
+        with self.lock:
+            previous = self.lines
+            self.lines = lines
+            if previous is None:
+                for subscriber in self.subscribers:
+                    self.send(subscriber, 'snapshot', {'lines': lines})
+                return
+            changes = {i: line for i, line in enumerate(lines) if i >= len(previous) or previous[i] != line}
+            if not changes and len(lines) == len(previous):
+                return
+            delta = {'length': len(lines), 'changes': changes}
+            for subscriber in self.subscribers:
+                self.send(subscriber, 'delta', delta)
+    
+    def send(self, subscriber, kind, payload):
+        try:
+            subscriber.put_nowait((kind, payload))
+        except queue.Full:
+            # The viewer fell behind, replace its backlog with a fresh snapshot
+            with subscriber.mutex:
+                subscriber.queue.clear()
+            kind, payload = ('closed', None) if kind == 'closed' else ('snapshot', {'lines': self.lines})
+            subscriber.put_nowait((kind, payload))
+    
+    def subscribe(self):
+        subscriber = queue.Queue(maxsize=TMUX_SUBSCRIBER_QUEUE)
+        with self.lock:
+            if self.lines is not None:
+                subscriber.put_nowait(('snapshot', {'lines': self.lines}))
+            if self.stopped.is_set() and not self.thread.is_alive():
+                subscriber.put_nowait(('closed', None))
+            self.subscribers.append(subscriber)
+        return subscriber
+    
+    def unsubscribe(self, subscriber):
+        """Remove a subscriber, returns the number still listening"""
+        with self.lock:
+            if subscriber in self.subscribers:
+                self.subscribers.remove(subscriber)
+            return len(self.subscribers)
+    
+    def stop(self):
+        self.stopped.set()
+        self.dirty.set()
+
+tmux_streamers = {}
+tmux_streamers_lock = threading.Lock()
+
+def subscribe_tmux_session(session_name):
+    """Join the shared streamer for a session, starting it if needed"""
+    with tmux_streamers_lock:
+        streamer = tmux_streamers.get(session_name)
+        if streamer is None or streamer.stopped.is_set():
+            streamer = TmuxStreamer(session_name)
+            tmux_streamers[session_name] = streamer
+        return streamer, streamer.subscribe()
+
+def unsubscribe_tmux_session(streamer, subscriber):
+    """Leave a session streamer, stopping it when the last viewer is gone"""
+    with tmux_streamers_lock:
+        if streamer.unsubscribe(subscriber) == 0:
+            streamer.stop()
+            if tmux_streamers.get(streamer.session_name) is streamer:
+                del tmux_streamers[streamer.session_name]
+
+class TmuxSessionManager:
+    """Owns the app's control-mode connection and a live table of sessions.
+    
+    Every tmux operation is sent over one long-lived `tmux -C` client instead
+    of forking `tmux` per call. The client sits in a hidden session of its own
+    (TMUX_CONTROL_SESSION) so it never depends on one of the user's sessions.
+    Session and window notifications wake a background thread that reloads
+    the table, so reads are a dictionary copy.
+    """
+    
+    # Notifications after which the session list may look different
+    TABLE_EVENTS = ('%sessions-changed', '%session-renamed', '%window-add', '%window-close',
+                    '%unlinked-window-add', '%unlinked-window-close', '%client-session-changed',
+                    '%client-detached', '%exit', '%closed')
+    
+    def __init__(self):
+        self.client = None
+        self.lock = threading.Lock()
+        self.retry_at = 0
+        self.sessions = {}
+        self.version = 0
+        self.loaded = False
+        self.changed = threading.Event()
+        self.refresher = None
+        # Called with the lock held when the session table changes, must not block
+        self.listeners = []
+    
+    def connection(self):
+        """Get the control client, connecting if needed.
+        
+        Returns None when tmux cannot be started, in which case the next
+        attempt waits for TMUX_RECONNECT_INTERVAL.
+        """
+        with self.lock:
+            if self.refresher is None:
+                self.refresher = threading.Thread(target=self.refresh_loop, name='tmux-sessions', daemon=True)
+                self.refresher.start()
+            if self.client is not None and not self.client.closed.is_set():
+                return self.client
+            if time.time() < self.retry_at:
+                return None
+            try:
+                # -A attaches to the session when another worker already created it
+                self.client = TmuxControlClient(['new-session', '-A', '-s', TMUX_CONTROL_SESSION],
+                                                on_notification=self.handle_notification)
+            except Exception as e:
+                print(f"Error connecting to tmux: {e}")
+                self.client = None
+                self.retry_at = time.time() + TMUX_RECONNECT_INTERVAL
+                return None
+            client = self.client
+        
+        # Output and our terminal size are of no interest to this client
+        client.command('refresh-client -f no-output,ignore-size')
+        if client.closed.is_set():
+            with self.lock:
+                self.retry_at = time.time() + TMUX_RECONNECT_INTERVAL
+            return None
+        return client
+    
+    def handle_notification(self, name, args):
+        if name in self.TABLE_EVENTS:
+            self.changed.set()
+    
+    def refresh_loop(self):
+        while True:
+            self.changed.wait()
+            self.changed.clear()
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f"Error refreshing tmux sessions: {e}")
+    
+    def refresh(self):
+        """Reload the session table from tmux"""
+        client = self.connection()
+        sessions = {}
+        if client is not None:
+            success, lines = client.command('list-sessions -F "#{session_windows} #{session_created} '
+                                            '#{session_name}"')
+            if not success and not client.closed.is_set():
+                # A live server with no sessions answers with an error
+                lines = []
+            # Count attached clients ourselves, streamers and other workers'
+            # control clients should not mark a session as attached
+            listed, clients = client.command('list-clients -F "#{client_termname} #{session_name}"')
+            attached = Counter(name for term, _, name in (line.partition(' ') for line in clients if listed)
+                               if term != TMUX_CLIENT_TERM)
+            for line in lines if success else []:
+                parts = line.split(' ', 2)
+                if len(parts) != 3 or parts[2] == TMUX_CONTROL_SESSION:
+                    continue
+                windows, created, name = parts
+                full_info = f"{name}: {windows} windows (created {time.ctime(int(created))})"
+                if attached[name] > 0:
+                    full_info += " (attached)"
+                sessions[name] = {'name': name, 'full_info': full_info}
+        with self.lock:
+            if sessions != self.sessions or not self.loaded:
+                self.sessions = sessions
+                self.version += 1
+                for listener in self.listeners:
+                    listener()
+            self.loaded = True
+    
+    def list_sessions(self):
+        return self.list_sessions_versioned()[0]
+    
+    def list_sessions_versioned(self):
+        """Get (sessions, version) of the session table"""
+        with self.lock:
+            stale = not self.loaded or self.client is None or self.client.closed.is_set()
+        if stale:
+            self.refresh()
+        with self.lock:
+            return list(self.sessions.values()), self.version
+    
+    def command(self, command):
+        """Run a tmux command over the control connection"""
+        client = self.connection()
+        if client is None:
+            return False, ['no tmux server running']
+        return client.command(command)
+
+tmux_control = TmuxSessionManager()
+
+def get_tmux_sessions():
+    """Get all running tmux sessions"""
+    try:
+        return tmux_control.list_sessions()
+    except Exception as e:
+        print(f"Error getting tmux sessions: {e}")
+        return []
+
+def kill_tmux_session(session_name):
+    """Kill a specific tmux session"""
+    try:
+        success, _ = tmux_control.command(f'kill-session -t {tmux_quote(session_name)}')
+        return success
+    except Exception as e:
+        print(f"Error killing tmux session: {e}")
+        return False
+
+def get_tmux_session_output(session_name, window=0, pane=0):
+    """Get the current output from a tmux session"""
+    try:
+        success, lines = tmux_control.command(f'capture-pane -p -t {tmux_quote(f"{session_name}:{window}.{pane}")}')
+        if success:
+            return '\n'.join(lines) + '\n'
+        return "Error capturing output"
+    except Exception as e:
+        return f"Error: {str(e)}"
+
+# Git helper functions
+def run_git(args, text=True):
+    """Run a git command in the script directory.
+    
+    Anything run through here may change the repository, so the cached git
+    state is dropped afterwards.
+    """
+    try:
+        return run_command(['git'] + args, f'git {args[0]}',
+                           cwd=SCRIPT_DIR,
+                           stdout=subprocess.PIPE,
+                           stderr=subprocess.PIPE,
+                           text=text)
+    finally:
+        git_state_cache.invalidate()
+
+def parse_git_status(output):
+    """Parse `git status --porcelain=v2 --branch -z` output"""
+    state = {'branch': None, 'upstream': None, 'ahead': 0, 'behind': 0, 'status': []}
+    records = iter(output.split('\0'))
+    for record in records:
+        if record.startswith('# branch.head '):
+            head = record[len('# branch.head '):]
+            # `git branch --show-current` prints nothing for a detached HEAD
+            state['branch'] = '' if head == '(detached)' else head
+        elif record.startswith('# branch.upstream '):
+            state['upstream'] = record[len('# branch.upstream '):]
+        elif record.startswith('# branch.ab '):
+            ahead, behind = record[len('# branch.ab '):].split(' ')
+            state['ahead'] = int(ahead)
+            state['behind'] = abs(int(behind))
+        elif record[:2] in ('1 ', '2 ', 'u '):
+            fields = record.split(' ', {'1': 8, '2': 9, 'u': 10}[record[0]])
+            status = fields[1].replace('.', ' ')
+            if record[0] == '2':
+                # Renames are followed by the original path in its own record
+                next(records, None)
+            state['status'].append({
+                'filename': fields[-1],
+                'status': status,
+                'staged': status[0] != ' ',
+                'modified': status[1] != ' ',
+                'untracked': False
+            })
+        elif record.startswith('? '):
+            state['status'].append({
+                'filename': record[2:],
+                'status': '??',
+                'staged': False,
+                'modified': True,
+                'untracked': True
+            })
+    return state
+
+class GitStateCache:
+    """Branch, ahead/behind, status and recent commits of the script repository.
+    
+    A refresh costs two git processes (`status --porcelain=v2 --branch` and
+    `log`). The result is reused until the index, HEAD or refs change on
+    disk, the file index sees a change in the working tree, or the app runs
+    a git command itself.
+    """
+    
+    LOG_LIMIT = 10
+    # Seconds before checking again whether SCRIPT_DIR has become a repository
+    NOT_A_REPO_RECHECK = 30
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.state = None
+        self.key = None
+        self.git_dir = None
+        self.checked_at = 0
+        # Goes up every time the state is loaded again
+        self.version = 0
+        # Called after the app changed the repository itself, must not block
+        self.listeners = []
+    
+    def invalidate(self):
+        self.key = None
+        for listener in self.listeners:
+            listener()
+    
+    def find_git_dir(self):
+        if self.git_dir is not None:
+            return self.git_dir
+        if time.time() - self.checked_at < self.NOT_A_REPO_RECHECK:
+            return None
+        self.checked_at = time.time()
+        if not os.path.exists(SCRIPT_DIR):
+            return None
+        result = run_command(['git', 'rev-parse', '--absolute-git-dir'], 'git rev-parse',
+                             cwd=SCRIPT_DIR,
+                             stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE,
+                             text=True)
+        if result.returncode == 0:
+            self.git_dir = result.stdout.strip()
+        return self.git_dir
+    
+    def cache_key(self):
+        """Mtimes of everything a status or log result depends on"""
+        files = ['index', 'HEAD', 'packed-refs', 'FETCH_HEAD']
+        if self.state and self.state['branch']:
+            files.append(os.path.join('refs', 'heads', self.state['branch']))
+        if self.state and self.state['upstream']:
+            files.append(os.path.join('refs', 'remotes', self.state['upstream']))
+        mtimes = []
+        for name in files:
+            try:
+                mtimes.append(os.stat(os.path.join(self.git_dir, name)).st_mtime_ns)
+            except OSError:
+                mtimes.append(None)
+        # Edits in the working tree show up as a new file index generation
+        file_index.snapshot()
+        return (file_index.generation, tuple(mtimes))
+    
+    def get(self):
+        """Get the cached state, refreshing it if anything changed"""
+        return self.get_versioned()[0]
+    
+    def get_versioned(self):
+        """Get (state, version) of the cached state, refreshing it if anything changed"""
+        with self.lock:
+            if self.find_git_dir() is None:
+                return None, self.version
+            if not os.path.isdir(self.git_dir):
+                # The repository was removed
+                self.git_dir = None
+                self.state = None
+                return None, self.version
+            key = self.cache_key()
+            record_cache('git_state', self.state is not None and key == self.key)
+            if self.state is None or key != self.key:
+                self.state = self.load()
+                self.version += 1
+                # Taken again, the branch or upstream may be new
+                self.key = self.cache_key()
+            return self.state, self.version
+    
+    def load(self):
+        status = run_command(['git', 'status', '--porcelain=v2', '--branch', '-z'], 'git status',
+                             cwd=SCRIPT_DIR,
+                             stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE,
+                             text=True)
+        if status.returncode != 0:
+            return {'branch': None, 'upstream': None, 'ahead': 0, 'behind': 0, 'status': None, 'commits': []}
+        state = parse_git_status(status.stdout)
+        
+        log = run_command(['git', 'log', '--format=%h %s', f'-{self.LOG_LIMIT}'], 'git log',
+                          cwd=SCRIPT_DIR,
+                          stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE,
+                          text=True)
+        commits = []
+        # Fails on a repository without commits
+        if log.returncode == 0:
+            for line in log.stdout.strip().split('\n'):
+                parts = line.split(' ', 1)
+                if len(parts) >= 2:
+                    commits.append({
+                        'hash': parts[0],
+                        'message': parts[1]
+                    })
+        state['commits'] = commits
+        return state
+
+git_state_cache = GitStateCache()
+
+def is_git_repo():
+    """Check if the script directory is a git repository"""
+    try:
+        return git_state_cache.get() is not None
     except Exception:
         return False
 
 def get_git_status():
     """Get git status of files in the repository"""
     try:
-        if not is_git_repo():
-            return None
-        
-        # Get status
-        result = subprocess.run(['git', 'status', '--porcelain'], 
-                               cwd=SCRIPT_DIR, 
-                               stdout=subprocess.PIPE, 
-                               stderr=subprocess.PIPE, 
-                               text=True)
-        
-        if result.returncode != 0:
-            return None
-        
-        files = []
-        for line in result.stdout.strip().split('\n'):
-            if line:
-                status = line[:2]
-                filename = line[3:]
-                files.append({
-                    'filename': filename,
-                    'status': status,
-                    'staged': status[0] != ' ' and status[0] != '?',
-                    'modified': status[1] != ' ',
-                    'untracked': status == '??'
-                })
-        
-        return files
+        state = git_state_cache.get()
+        return state['status'] if state else None
     except Exception as e:
         print(f"Error getting git status: {e}")
         return None
@@ -210,52 +4684,83 @@ def get_git_status():
 def get_git_branch():
     """Get current git branch"""
     try:
-        if not is_git_repo():
-            return None
-        
-        result = subprocess.run(['git', 'branch', '--show-current'], 
-                               cwd=SCRIPT_DIR, 
-                               stdout=subprocess.PIPE, 
-                               stderr=subprocess.PIPE, 
-                               text=True)
-        
-        if result.returncode == 0:
-            return result.stdout.strip()
-        return None
+        state = git_state_cache.get()
+        return state['branch'] if state else None
     except Exception:
         return None
 
+# Commands used by the batch endpoints, the paths are appended after `--`
+GIT_BATCH_COMMANDS = {
+    'stage': ['add'],
+    'unstage': ['restore', '--staged'],
+    'discard': ['checkout', 'HEAD']
+}
+# Keep each command line well below the kernel's argv limit
+GIT_ARGV_CHUNK_BYTES = 64 * 1024
+
+def chunk_paths(paths, limit=GIT_ARGV_CHUNK_BYTES):
+    """Split paths into groups whose combined length stays under `limit`"""
+    chunk, size = [], 0
+    for path in paths:
+        if chunk and size + len(path) + 1 > limit:
+            yield chunk
+            chunk, size = [], 0
+        chunk.append(path)
+        size += len(path) + 1
+    if chunk:
+        yield chunk
+
+def git_batch(action, filenames):
+    """Stage, unstage or discard many files with one git process per chunk.
+    
+    Returns one {'filename', 'success', 'error'} result per file. When a
+    chunk fails its files are retried one by one to find the culprits.
+    """
+    command = GIT_BATCH_COMMANDS[action]
+    if action == 'unstage' and run_git(['rev-parse', '--verify', '--quiet', 'HEAD']).returncode != 0:
+        # Before the first commit there is no HEAD to restore the index from
+        command = ['rm', '-r', '--cached', '--quiet']
+    results = {}
+    valid = []
+    for filename in filenames:
+        if resolve_script_path(filename) is None:
+            results[filename] = 'Path is outside the script directory'
+        else:
+            valid.append(filename)
+    
+    for chunk in chunk_paths(valid):
+        result = run_git(command + ['--'] + chunk)
+        if result.returncode == 0:
+            results.update({filename: None for filename in chunk})
+            continue
+        if len(chunk) == 1:
+            results[chunk[0]] = result.stderr.strip() or f'Failed to {action} file'
+            continue
+        for filename in chunk:
+            single = run_git(command + ['--', filename])
+            results[filename] = None if single.returncode == 0 else (single.stderr.strip() or f'Failed to {action} file')
+    
+    return [{'filename': filename, 'success': results[filename] is None, 'error': results[filename]}
+            for filename in filenames]
+
 def git_add_file(filename):
     """Add a file to git staging area"""
     try:
-        result = subprocess.run(['git', 'add', filename], 
-                               cwd=SCRIPT_DIR, 
-                               stdout=subprocess.PIPE, 
-                               stderr=subprocess.PIPE)
-        return result.returncode == 0
+        return git_batch('stage', [filename])[0]['success']
     except Exception:
         return False
 
 def git_unstage_file(filename):
     """Remove a file from git staging area"""
     try:
-        result = subprocess.run(['git', 'reset', 'HEAD', filename], 
-                               cwd=SCRIPT_DIR, 
-                               stdout=subprocess.PIPE, 
-                               stderr=subprocess.PIPE)
-        return result.returncode == 0
+        return git_batch('unstage', [filename])[0]['success']
     except Exception:
         return False
 
 def git_discard_changes(filename):
     """Discard changes to a file"""
     try:
-        # First, check if file is in working directory
-        result = subprocess.run(['git', 'checkout', 'HEAD', '--', filename], 
-                               cwd=SCRIPT_DIR, 
-                               stdout=subprocess.PIPE, 
-                               stderr=subprocess.PIPE)
-        return result.returncode == 0
+        return git_batch('discard', [filename])[0]['success']
     except Exception:
         return False
 
@@ -263,22 +4768,13 @@ def git_discard_all_changes():
     """Discard all changes in the working directory"""
     try:
         # Reset all staged changes
-        reset_result = subprocess.run(['git', 'reset', 'HEAD'], 
-                                     cwd=SCRIPT_DIR, 
-                                     stdout=subprocess.PIPE, 
-                                     stderr=subprocess.PIPE)
+        reset_result = run_git(['reset', 'HEAD'])
         
         # Discard all working directory changes
-        checkout_result = subprocess.run(['git', 'checkout', 'HEAD', '--', '.'], 
-                                        cwd=SCRIPT_DIR, 
-                                        stdout=subprocess.PIPE, 
-                                        stderr=subprocess.PIPE)
+        checkout_result = run_git(['checkout', 'HEAD', '--', '.'])
         
         # Clean untracked files
-        clean_result = subprocess.run(['git', 'clean', '-fd'], 
-                                     cwd=SCRIPT_DIR, 
-                                     stdout=subprocess.PIPE, 
-                                     stderr=subprocess.PIPE)
+        clean_result = run_git(['clean', '-fd'])
         
         return reset_result.returncode == 0 and checkout_result.returncode == 0
     except Exception:
@@ -290,11 +4786,7 @@ def git_commit(message):
         if not message.strip():
             return False, "Commit message cannot be empty"
         
-        result = subprocess.run(['git', 'commit', '-m', message], 
-                               cwd=SCRIPT_DIR, 
-                               stdout=subprocess.PIPE, 
-                               stderr=subprocess.PIPE, 
-                               text=True)
+        result = run_git(['commit', '-m', message])
         
         if result.returncode == 0:
             return True, "Changes committed successfully"
@@ -303,49 +4795,20 @@ def git_commit(message):
     except Exception as e:
         return False, str(e)
 
-def git_push():
-    """Push changes to remote repository"""
-    try:
-        result = subprocess.run(['git', 'push'], 
-                               cwd=SCRIPT_DIR, 
-                               stdout=subprocess.PIPE, 
-                               stderr=subprocess.PIPE, 
-                               text=True)
-        
-        if result.returncode == 0:
-            return True, "Changes pushed successfully"
-        else:
-            return False, result.stderr or "Push failed"
-    except Exception as e:
-        return False, str(e)
-
-def git_pull():
-    """Pull changes from remote repository"""
-    try:
-        result = subprocess.run(['git', 'pull'], 
-                               cwd=SCRIPT_DIR, 
-                               stdout=subprocess.PIPE, 
-                               stderr=subprocess.PIPE, 
-                               text=True)
-        
-        if result.returncode == 0:
-            return True, result.stdout or "Repository updated"
-        else:
-            return False, result.stderr or "Pull failed"
-    except Exception as e:
-        return False, str(e)
-
 def get_commit_history(limit=10):
     """Get recent commit history"""
     try:
-        if not is_git_repo():
+        state = git_state_cache.get()
+        if not state:
             return []
+        if limit <= GitStateCache.LOG_LIMIT:
+            return state['commits'][:limit]
         
-        result = subprocess.run(['git', 'log', '--oneline', f'-{limit}'], 
-                               cwd=SCRIPT_DIR, 
-                               stdout=subprocess.PIPE, 
-                               stderr=subprocess.PIPE, 
-                               text=True)
+        result = run_command(['git', 'log', '--format=%h %s', f'-{limit}'], 'git log',
+                             cwd=SCRIPT_DIR, 
+                             stdout=subprocess.PIPE, 
+                             stderr=subprocess.PIPE, 
+                             text=True)
         
         if result.returncode != 0:
             return []
@@ -364,70 +4827,911 @@ def get_commit_history(limit=10):
     except Exception:
         return []
 
+# Background git network operations
+GIT_PROGRESS_RE = re.compile(r'^(?:remote: )?([A-Za-z ]+):\s+(\d+)%')
+
+git_tasks = {}
+git_tasks_lock = threading.Lock()
+git_task_queue = deque()
+git_task_ready = threading.Condition(git_tasks_lock)
+git_task_worker = None
+
+def submit_git_task(op):
+    """Queue a push, pull or fetch, returns the task record.
+    
+    Only one network operation runs per repository at a time. Asking for an
+    operation that is already queued or running returns that task instead of
+    starting another one.
+    """
+    global git_task_worker
+    with git_tasks_lock:
+        for task in git_tasks.values():
+            if task['op'] == op and task['state'] in ('queued', 'running'):
+                return task
+        if state_store:
+            for task in state_store.active('git'):
+                if task['op'] == op:
+                    return task
+        
+        task_id = uuid.uuid4().hex
+        task = {
+            'id': task_id,
+            'op': op,
+            'state': 'queued',
+            'message': f'Waiting to {op}',
+            'progress': None,
+            'created': time.time(),
+            'started': None,
+            'finished': None,
+            'output': OutputBuffer(store_id=task_id)
+        }
+        git_tasks[task_id] = task
+        store_git_task(task)
+        git_task_queue.append(task)
+        if git_task_worker is None:
+            git_task_worker = threading.Thread(target=git_task_loop, name='git-network', daemon=True)
+            git_task_worker.start()
+        git_task_ready.notify()
+        
+        # Keep the records of the last finished tasks only
+        finished = sorted((t for t in git_tasks.values() if t['finished']), key=lambda t: t['finished'])
+        for old in finished[:-20]:
+            del git_tasks[old['id']]
+        if state_store:
+            state_store.prune('git', 20)
+        return task
+
+def store_git_task(task):
+    """Write a git task record to the state store"""
+    if state_store:
+        try:
+            state_store.save('git', task)
+        except Exception as e:
+            print(f"Error storing git task {task['id']}: {e}")
+
+def git_task_loop():
+    while True:
+        with git_tasks_lock:
+            while not git_task_queue:
+                git_task_ready.wait()
+            task = git_task_queue.popleft()
+            task['state'] = 'running'
+            task['started'] = time.time()
+            store_git_task(task)
+        lock_file = None
+        try:
+            if state_store:
+                lock_file = git_network_lock()
+            success, message = run_git_network(task)
+        except Exception as e:
+            success, message = False, str(e)
+        finally:
+            if lock_file:
+                lock_file.close()
+        task['output'].flush()
+        with git_tasks_lock:
+            task['state'] = 'finished' if success else 'failed'
+            task['message'] = message
+            task['finished'] = time.time()
+            store_git_task(task)
+        task['output'].close()
+
+def git_network_lock():
+    """Hold a file lock so workers never run network operations at the same time"""
+    lock_file = open(STATE_DB + '.git-lock', 'a')
+    fcntl.flock(lock_file, fcntl.LOCK_EX)
+    return lock_file
+
+def run_git_network(task):
+    """Run a git network command, recording its --progress output"""
+    op = task['op']
+    default_messages = {
+        'push': ("Changes pushed successfully", "Push failed"),
+        'pull': ("Repository updated", "Pull failed"),
+        'fetch': ("Remote refs updated", "Fetch failed")
+    }
+    # Never wait on a credential prompt nobody can answer
+    env = dict(os.environ, GIT_TERMINAL_PROMPT='0')
+    started = time.monotonic()
+    process = subprocess.Popen(['git', op, '--progress'],
+                               cwd=SCRIPT_DIR,
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT,
+                               env=env)
+    timer = threading.Timer(GIT_NETWORK_TIMEOUT, process.kill)
+    timer.start()
+    lines = []
+    stored_progress = 0
+    try:
+        pending = b''
+        while True:
+            chunk = os.read(process.stdout.fileno(), 4096)
+            if not chunk:
+                break
+            # Progress meters redraw themselves with a carriage return
+            parts = re.split(rb'[\r\n]', pending + chunk)
+            pending = parts.pop()
+            for part in parts:
+                line = part.decode('utf-8', errors='replace').strip()
+                if not line:
+                    continue
+                match = GIT_PROGRESS_RE.match(line)
+                if match:
+                    task['progress'] = {'phase': match.group(1).strip(), 'percent': int(match.group(2))}
+                    if state_store and time.monotonic() - stored_progress >= STATE_POLL_INTERVAL:
+                        stored_progress = time.monotonic()
+                        with git_tasks_lock:
+                            store_git_task(task)
+                else:
+                    lines.append(line)
+                task['output'].append(line)
+        if pending.strip():
+            line = pending.decode('utf-8', errors='replace').strip()
+            lines.append(line)
+            task['output'].append(line)
+        process.wait()
+    finally:
+        timer.cancel()
+        process.stdout.close()
+        git_state_cache.invalidate()
+    record_command(f'git {op}', started, process.returncode == 0)
+    
+    success_message, failure_message = default_messages[op]
+    if process.returncode == 0:
+        return True, success_message if op != 'pull' else ('\n'.join(lines[-5:]) or success_message)
+    return False, '\n'.join(lines[-10:]) or failure_message
+
+def get_git_task(task_id):
+    """Get the public fields of a git task record"""
+    with git_tasks_lock:
+        task = git_tasks.get(task_id)
+    if task is None and state_store:
+        task = state_store.load('git', task_id)
+    if task is None:
+        return None
+    return {key: value for key, value in task.items() if key != 'output'}
+
+def git_fetch_loop():
+    """Fetch in the background so ahead/behind counts stay current"""
+    while True:
+        time.sleep(GIT_FETCH_INTERVAL)
+        try:
+            # Every worker runs this loop, skip if another one fetched recently
+            last = state_store.last_finished('git') if state_store else None
+            if last and last['op'] == 'fetch' and time.time() - last['finished'] < GIT_FETCH_INTERVAL / 2:
+                continue
+            if is_git_repo():
+                submit_git_task('fetch')
+        except Exception as e:
+            print(f"Error starting background fetch: {e}")
+
+def start_git_fetcher():
+    if GIT_ENABLED and GIT_FETCH_INTERVAL > 0:
+        threading.Thread(target=git_fetch_loop, name='git-fetch', daemon=True).start()
+
+class EventHub:
+    """Pushes dashboard changes to every open /api/events stream.
+    
+    A single producer watches each source, the file index, git state, the
+    tmux session table and jobs, and publishes one event per change, so the
+    work done grows with the number of changes rather than with the number
+    of open pages. Every stream has a bounded queue, one that falls behind
+    gets a single `resync` event in place of its backlog.
+    """
+    
+    TOPICS = ('files', 'git', 'jobs', 'tmux')
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers = {}
+        self.wakeup = threading.Event()
+        self.producer = None
+        self.versions = {}
+        self.job_progress = {}
+        self.remote_jobs = {}
+    
+    def subscribe(self, topics):
+        subscriber = queue.Queue(maxsize=EVENT_SUBSCRIBER_QUEUE)
+        with self.lock:
+            self.subscribers[subscriber] = topics
+            if self.producer is None:
+                self.producer = threading.Thread(target=self.run, name='event-producer', daemon=True)
+                self.producer.start()
+        self.wakeup.set()
+        return subscriber
+    
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.pop(subscriber, None)
+    
+    def publish(self, topic, payload):
+        with self.lock:
+            for subscriber, topics in self.subscribers.items():
+                if topic in topics:
+                    self.send(subscriber, topic, payload)
+    
+    def send(self, subscriber, topic, payload):
+        try:
+            subscriber.put_nowait((topic, payload))
+        except queue.Full:
+            # The page fell behind, it reloads everything instead
+            with subscriber.mutex:
+                subscriber.queue.clear()
+            subscriber.put_nowait(('resync', {}))
+    
+    def run(self):
+        while True:
+            self.wakeup.wait(EVENT_POLL_INTERVAL)
+            self.wakeup.clear()
+            with self.lock:
+                topics = set().union(*self.subscribers.values())
+            for topic in self.TOPICS:
+                if topic not in topics:
+                    continue
+                try:
+                    getattr(self, f'check_{topic}')()
+                except Exception as e:
+                    print(f"Error checking {topic} for events: {e}")
+    
+    def check_files(self):
+        # Changes are published by the file index listener, this only keeps
+        # a polling index up to date
+        file_index.snapshot()
+    
+    def check_git(self):
+        if not GIT_ENABLED:
+            return
+        state, version = git_state_cache.get_versioned()
+        if state is not None and version != self.versions.get('git'):
+            self.versions['git'] = version
+            self.publish('git', git_status_payload(state))
+    
+    def check_tmux(self):
+        sessions, version = tmux_control.list_sessions_versioned()
+        if version != self.versions.get('tmux'):
+            self.versions['tmux'] = version
+            self.publish('tmux', {'sessions': sessions})
+    
+    def check_jobs(self):
+        """Publish the output progress of running jobs and the jobs of other workers"""
+        with jobs_lock:
+            running = {job['id']: job_event(job) for job in jobs.values() if job['state'] == 'running'}
+        for job_id, event in running.items():
+            if self.job_progress.get(job_id) != event['output_lines']:
+                self.job_progress[job_id] = event['output_lines']
+                self.publish('jobs', event)
+        self.job_progress = {job_id: lines for job_id, lines in self.job_progress.items() if job_id in running}
+        
+        if state_store is None:
+            return
+        remote = {}
+        for record, output_lines in state_store.progress('job'):
+            if record['id'] in running or record['id'] in jobs:
+                continue
+            remote[record['id']] = (record['state'], output_lines)
+            if self.remote_jobs.get(record['id']) != remote[record['id']]:
+                self.publish('jobs', dict(record, output_lines=output_lines))
+        for job_id in self.remote_jobs.keys() - remote.keys():
+            # Finished on another worker
+            record = state_store.load('job', job_id)
+            if record is not None:
+                self.publish('jobs', dict(record, output_lines=None))
+        self.remote_jobs = remote
+
+event_hub = EventHub()
+file_index.listeners.append(lambda dirs: event_hub.publish('files', {'generation': file_index.generation, 'dirs': dirs}))
+git_state_cache.listeners.append(event_hub.wakeup.set)
+tmux_control.listeners.append(event_hub.wakeup.set)
+
+def job_event(job):
+    """The public fields of a job with its output line count, called with jobs_lock held"""
+    event = {key: value for key, value in job.items() if key not in ('path', 'output')}
+    event['output_lines'] = job['output'].total
+    return event
+
+class ResponseCache:
+    """Bodies of polled routes, kept until the state they show changes.
+    
+    Entries are keyed by route and by the version of the state behind them,
+    so a poll that finds nothing new costs a version check. Requests that
+    arrive while an entry is being built wait for it instead of building
+    their own, and each compressed copy is made once.
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.build_locks = {}
+    
+    def get(self, name, version, build):
+        """Get the entry of `name` for `version`, build() returns (body, mimetype)"""
+        entry = self.entries.get(name)
+        if entry is not None and entry['version'] == version:
+            record_cache('response', True)
+            return entry
+        with self.lock:
+            build_lock = self.build_locks.setdefault(name, threading.Lock())
+        with build_lock:
+            # Built by another request while this one waited
+            entry = self.entries.get(name)
+            if entry is not None and entry['version'] == version:
+                record_cache('response', True)
+                return entry
+            record_cache('response', False)
+            body, mimetype = build()
+            if isinstance(body, str):
+                body = body.encode('utf-8')
+            entry = {
+                'version': version,
+                'body': body,
+                'mimetype': mimetype,
+                # From the body, so every worker and restart agrees on it
+                'etag': hashlib.sha256(body).hexdigest()[:32],
+                'encoded': {}
+            }
+            self.entries[name] = entry
+            return entry
+    
+    def encoded(self, entry, encoding):
+        body = entry['encoded'].get(encoding)
+        if body is None:
+            body = compress_body(entry['body'], encoding)
+            entry['encoded'][encoding] = body
+        return body
+
+response_cache = ResponseCache()
+
+def choose_encoding():
+    """Best compression the client accepts, None for none"""
+    if brotli is not None and request.accept_encodings['br']:
+        return 'br'
+    if request.accept_encodings['gzip']:
+        return 'gzip'
+    return None
+
+def compress_body(body, encoding):
+    if encoding == 'br':
+        return brotli.compress(body, quality=5)
+    return gzip.compress(body, COMPRESS_LEVEL, mtime=0)
+
+def cached_response(name, version, build):
+    """Serve a polled route through response_cache, with a 304 when the client is up to date"""
+    entry = response_cache.get(name, version, build)
+    encoding = choose_encoding() if len(entry['body']) >= COMPRESS_MIN_SIZE else None
+    # Strong ETags name one representation, compressed copies get their own
+    etag = f"{entry['etag']}-{encoding}" if encoding else entry['etag']
+    if request.if_none_match.contains_weak(etag) or request.if_none_match.contains_weak(entry['etag']):
+        response = Response(status=304)
+    else:
+        response = Response(response_cache.encoded(entry, encoding) if encoding else entry['body'],
+                            mimetype=entry['mimetype'])
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+    response.set_etag(etag)
+    # Browsers keep the body but check back on every poll
+    response.headers['Cache-Control'] = 'no-cache'
+    response.vary.add('Accept-Encoding')
+    return response
+
+def cached_json(name, version, build):
+    """cached_response() for a route returning build() as JSON"""
+    return cached_response(name, version, lambda: (app.json.dumps(build()) + '\n', 'application/json'))
+
+@app.after_request
+def compress_response(response):
+    """Compress large bodies of the responses that were not cached"""
+    if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+            or 'Content-Encoding' in response.headers or response.mimetype not in COMPRESS_MIMETYPES):
+        return response
+    response.vary.add('Accept-Encoding')
+    body = response.get_data()
+    encoding = choose_encoding()
+    if encoding is None or len(body) < COMPRESS_MIN_SIZE:
+        return response
+    response.set_data(compress_body(body, encoding))
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+def output_event_stream(output, get_result):
+    """Serve an OutputBuffer as Server-Sent Events.
+    
+    Each line is sent with its number as the event id so a reconnecting
+    EventSource resumes where it left off. A final `done` event carries
+    `get_result()`.
+    """
+    last_event_id = request.headers.get('Last-Event-ID', '')
+    cursor = int(last_event_id) + 1 if last_event_id.isdigit() else 0
+    
+    def generate(cursor):
+        while True:
+            lines, end, skipped, done = output.read(cursor, timeout=15)
+            if skipped:
+                yield f"event: skipped\ndata: {skipped}\n\n"
+            for offset, line in enumerate(lines, start=end - len(lines)):
+                yield f"id: {offset}\ndata: {line}\n\n"
+            cursor = end
+            if done:
+                yield f"event: done\ndata: {json.dumps(get_result())}\n\n"
+                return
+            if not lines and not skipped:
+                # Keep proxies from closing an idle connection
+                yield ": keepalive\n\n"
+    
+    return Response(generate(cursor), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 @app.route('/')
 def index():
     return render_template('index.html')
 
 @app.route('/scripts')
 def scripts():
-    """Main scripts management page"""
-    files = get_all_files()
+    """Main scripts management page, the file tree is loaded through /api/tree"""
     git_enabled = GIT_ENABLED
     git_configured = is_git_repo() if git_enabled else False
     current_branch = get_git_branch() if git_configured else None
     
-    return render_template('scripts.html', 
-                         files=files, 
-                         git_enabled=git_enabled,
-                         git_configured=git_configured,
-                         current_branch=current_branch)
+    def render():
+        return render_template('scripts.html', 
+                               git_enabled=git_enabled,
+                               git_configured=git_configured,
+                               current_branch=current_branch)
+    
+    # Flashed messages are for this user only
+    if session.get('_flashes'):
+        return render()
+    return cached_response('scripts', (git_enabled, git_configured, current_branch),
+                           lambda: (render(), 'text/html'))
 
-@app.route('/script/edit/<filename>')
+@app.route('/script/edit/<path:filename>')
 def edit_script(filename):
     """Edit a specific script file"""
-    file_path = os.path.join(SCRIPT_DIR, filename)
-    if not os.path.exists(file_path) or not os.path.isfile(file_path):
+    file_path = resolve_script_path(filename)
+    if file_path is None or not os.path.isfile(file_path):
         abort(404)
     
-    content = read_file_content(file_path)
+    file_info = editor_file_info(filename, file_path)
+    content = None if file_info['large'] else read_file_content(file_path)
+    return render_template('edit_script.html', file=file_info, content=content)
+
+def editor_file_info(filename, file_path):
+    """Describe a file for the editor page"""
+    size = os.path.getsize(file_path)
     file_info = {
         'name': filename,
         'path': file_path,
-        'size': os.path.getsize(file_path),
+        'size': size,
         'modified': os.path.getmtime(file_path),
         'is_executable': filename.endswith('.sh'),
-        'extension': os.path.splitext(filename)[1].lower()
+        'extension': os.path.splitext(filename)[1].lower(),
+        # Too big to edit in a textarea, the page loads it a window at a time
+        'large': size > EDITOR_INLINE_LIMIT,
+        # Saves must start from this version of the file
+        'etag': file_etag(file_path),
+        'patchable': False
     }
-    return render_template('edit_script.html', file=file_info, content=content)
+    if not file_info['large']:
+        with open(file_path, 'rb') as file:
+            data = file.read()
+        try:
+            data.decode('utf-8')
+            # The editor can only work out byte offsets of its edits when the
+            # textarea holds the file unchanged: UTF-8, no CR and no leading
+            # newline for the browser to drop
+            file_info['patchable'] = b'\r' not in data and not data.startswith(b'\n')
+        except UnicodeDecodeError:
+            pass
+    return file_info
+
+def if_match_etags():
+    """Get the etags of an If-Match header, None if there is none or it is *"""
+    if not request.if_match or request.if_match.star_tag:
+        return None
+    return request.if_match.as_set(include_weak=True)
 
-@app.route('/script/save/<filename>', methods=['POST'])
+@app.route('/script/save/<path:filename>', methods=['POST'])
 def save_script(filename):
     """Save changes to a script file"""
-    file_path = os.path.join(SCRIPT_DIR, filename)
+    file_path = resolve_script_path(filename)
+    if file_path is None:
+        abort(404)
     content = request.form.get('content', '')
+    # The version the editor was opened on, saving over a newer one is refused
+    expected = {request.form['etag']} if request.form.get('etag') else if_match_etags()
     
-    if write_file_content(file_path, content):
+    status, _ = write_file_content(file_path, content, expected)
+    if status == 'saved':
         flash(f'File "{filename}" saved successfully', 'success')
+    elif status == 'conflict' and os.path.isfile(file_path):
+        flash(f'"{filename}" was changed by someone else after you opened it. '
+              'Your version is shown below, save again to replace theirs.', 'warning')
+        file_info = editor_file_info(filename, file_path)
+        # The textarea holds the submitted version, not the one on disk
+        file_info['patchable'] = False
+        return render_template('edit_script.html', file=file_info, content=content), 409
     else:
         flash(f'Error saving file "{filename}"', 'danger')
     
     return redirect(url_for('edit_script', filename=filename))
 
-@app.route('/script/run/<filename>')
+@app.route('/api/file/<path:filename>', methods=['GET'])
+def api_file_info(filename):
+    """Get the size, modification time and etag of a file"""
+    file_path = resolve_script_path(filename)
+    if file_path is None or not os.path.isfile(file_path):
+        return jsonify({"status": "error", "message": "File not found"}), 404
+    etag = file_etag(file_path)
+    response = jsonify({
+        "status": "success",
+        "size": os.path.getsize(file_path),
+        "modified": os.path.getmtime(file_path),
+        "etag": etag
+    })
+    response.set_etag(etag)
+    return response
+
+@app.route('/api/file/<path:filename>', methods=['PATCH'])
+def api_file_patch(filename):
+    """Apply byte range edits to the version of a file named by If-Match"""
+    file_path = resolve_script_path(filename)
+    if file_path is None or not os.path.isfile(file_path):
+        return jsonify({"status": "error", "message": "File not found"}), 404
+    expected = if_match_etags()
+    if not expected or len(expected) != 1:
+        return jsonify({"status": "error", "message": "If-Match with the etag of the edited version is required"}), 428
+    edits = (request.get_json(silent=True) or {}).get('edits')
+    if not isinstance(edits, list) or not all(isinstance(edit, dict) for edit in edits):
+        return jsonify({"status": "error", "message": "A list of edits is required"}), 400
+    # bool is an int too
+    is_offset = lambda value: isinstance(value, int) and not isinstance(value, bool)
+    if not all(is_offset(edit.get('start')) and is_offset(edit.get('end')) and isinstance(edit.get('text', ''), str)
+               for edit in edits):
+        return jsonify({"status": "error", "message": "Edits need start, end and text"}), 400
+    
+    try:
+        status, value = patch_file(file_path, edits, next(iter(expected)))
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    return file_save_response(filename, status, value)
+
+def file_save_response(filename, status, value):
+    """Turn the result of replace_file() into an API response"""
+    if status == 'saved':
+        response = jsonify({"status": "success", "message": f"File {filename} saved", "etag": value})
+        response.set_etag(value)
+        return response
+    if status == 'conflict':
+        return jsonify({"status": "error", "message": "The file was changed since that version", "etag": value}), 412
+    return jsonify({"status": "error", "message": f"Error saving file {filename}: {value}"}), 500
+
+@app.route('/api/file/<path:filename>', methods=['PUT'])
+def api_file_upload(filename):
+    """Replace a file with the request body, streamed to disk in chunks"""
+    file_path = resolve_script_path(filename)
+    if file_path is None or os.path.isdir(file_path) or not os.path.isdir(os.path.dirname(file_path)):
+        return jsonify({"status": "error", "message": "Invalid file path"}), 404
+    status, value = write_file_stream(file_path, request.stream, if_match_etags())
+    return file_save_response(filename, status, value)
+
+@app.route('/api/file/<path:filename>/lines')
+def api_file_lines(filename):
+    """Read a window of lines, `start` counts from 0"""
+    file_path = resolve_script_path(filename)
+    if file_path is None or not os.path.isfile(file_path):
+        return jsonify({"status": "error", "message": "File not found"}), 404
+    try:
+        start = max(int(request.args.get('start', 0)), 0)
+        count = min(max(int(request.args.get('count', 200)), 1), 5000)
+    except ValueError:
+        return jsonify({"status": "error", "message": "Invalid start or count"}), 400
+    return jsonify(dict(read_file_lines(file_path, start, count), status="success"))
+
+def revision_view(revision, current_etag):
+    """The public fields of a revision, its etag is that of the file it was saved as"""
+    view = {key: value for key, value in revision.items() if key != 'hash'}
+    view['etag'] = revision['hash'][:32] if revision['hash'] else None
+    view['current'] = view['etag'] is not None and view['etag'] == current_etag
+    return view
+
+def revision_text(data):
+    """Lines of a revision for a diff, None for binary content"""
+    try:
+        return data.decode('utf-8').splitlines(keepends=True)
+    except UnicodeDecodeError:
+        return None
+
+@app.route('/api/file/<path:filename>/versions')
+def api_file_versions(filename):
+    """List the saved revisions of a file, newest first, a page at a time"""
+    if version_store is None:
+        return jsonify({"status": "error", "message": "Version store is disabled"}), 404
+    file_path = resolve_script_path(filename)
+    if file_path is None:
+        return jsonify({"status": "error", "message": "File not found"}), 404
+    try:
+        limit = min(max(int(request.args.get('limit', 50)), 1), 1000)
+        before = int(request.args['cursor']) if request.args.get('cursor') else None
+    except ValueError:
+        return jsonify({"status": "error", "message": "Invalid limit or cursor"}), 400
+    
+    revisions, next_cursor = version_store.revisions(os.path.relpath(file_path, SCRIPT_DIR), before, limit)
+    current = file_etag(file_path) if os.path.isfile(file_path) else None
+    return jsonify({"status": "success", "revisions": [revision_view(revision, current) for revision in revisions],
+                    "next_cursor": next_cursor})
+
+@app.route('/api/file/<path:filename>/versions/<int:revision_id>')
+def api_file_version(filename, revision_id):
+    """Get the content of one revision"""
+    file_path = resolve_script_path(filename)
+    revision, data = (version_store.read(os.path.relpath(file_path, SCRIPT_DIR), revision_id)
+                      if version_store and file_path else (None, None))
+    if data is None:
+        return jsonify({"status": "error", "message": "Revision not found"}), 404
+    response = Response(data, mimetype='text/plain')
+    response.set_etag(revision['hash'][:32])
+    return response
+
+@app.route('/api/file/<path:filename>/versions/<int:revision_id>/restore', methods=['POST'])
+def api_file_restore(filename, revision_id):
+    """Make a revision the current content of the file, also brings back a deleted file"""
+    file_path = resolve_script_path(filename)
+    revision, data = (version_store.read(os.path.relpath(file_path, SCRIPT_DIR), revision_id)
+                      if version_store and file_path else (None, None))
+    if data is None:
+        return jsonify({"status": "error", "message": "Revision not found"}), 404
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    status, value = replace_file(file_path, [data], if_match_etags(), source='restore')
+    return file_save_response(filename, status, value)
+
+@app.route('/api/file/<path:filename>/diff')
+def api_file_diff(filename):
+    """Unified diff between two revisions, or between a revision and the file as it is now"""
+    file_path = resolve_script_path(filename)
+    if version_store is None or file_path is None:
+        return jsonify({"status": "error", "message": "File not found"}), 404
+    relpath = os.path.relpath(file_path, SCRIPT_DIR)
+    try:
+        from_id = int(request.args['from'])
+        to_id = int(request.args['to']) if request.args.get('to') else None
+    except (KeyError, ValueError):
+        return jsonify({"status": "error", "message": "Invalid from or to revision"}), 400
+    
+    sides = []
+    for revision_id in (from_id, to_id):
+        if revision_id is None:
+            label = f'{relpath} (current)'
+            try:
+                with open(file_path, 'rb') as file:
+                    data = file.read(EDITOR_INLINE_LIMIT + 1)
+            except FileNotFoundError:
+                data = b''
+        else:
+            revision, data = version_store.read(relpath, revision_id)
+            if revision is None:
+                return jsonify({"status": "error", "message": f"Revision {revision_id} not found"}), 404
+            label = f'{relpath} (revision {revision_id})'
+            data = data or b''
+        if len(data) > EDITOR_INLINE_LIMIT:
+            return jsonify({"status": "error", "message": "File is too large to diff"}), 413
+        sides.append((label, data))
+    
+    (from_label, from_data), (to_label, to_data) = sides
+    from_lines, to_lines = revision_text(from_data), revision_text(to_data)
+    if from_lines is None or to_lines is None:
+        diff = '' if from_data == to_data else 'Binary files differ\n'
+    else:
+        diff = ''.join(difflib.unified_diff(from_lines, to_lines, from_label, to_label))
+    return jsonify({"status": "success", "diff": diff})
+
+@app.route('/api/versions')
+def api_versions():
+    """Size of the version store and the deleted files it can restore"""
+    if version_store is None:
+        return jsonify({"status": "error", "message": "Version store is disabled"}), 404
+    try:
+        limit = min(max(int(request.args.get('limit', 100)), 1), 1000)
+    except ValueError:
+        return jsonify({"status": "error", "message": "Invalid limit"}), 400
+    return jsonify({"status": "success", "usage": version_store.usage(), "deleted": version_store.deleted(limit)})
+
+@app.route('/api/file/<path:filename>/bytes')
+def api_file_bytes(filename):
+    """Read a window of raw bytes"""
+    file_path = resolve_script_path(filename)
+    if file_path is None or not os.path.isfile(file_path):
+        return jsonify({"status": "error", "message": "File not found"}), 404
+    try:
+        offset = max(int(request.args.get('offset', 0)), 0)
+        length = min(max(int(request.args.get('length', 65536)), 0), FILE_CHUNK_SIZE)
+    except ValueError:
+        return jsonify({"status": "error", "message": "Invalid offset or length"}), 400
+    mm, _, size = open_file_window(file_path)
+    try:
+        data = mm[offset:offset + length] if mm is not None else b''
+    finally:
+        if mm is not None:
+            mm.close()
+    return Response(data, mimetype='application/octet-stream',
+                    headers={'X-File-Size': str(size), 'X-Offset': str(min(offset, size))})
+
+@app.route('/api/file/<path:filename>/preview')
+def api_file_preview(filename):
+    """Get the head and tail of a file"""
+    file_path = resolve_script_path(filename)
+    if file_path is None or not os.path.isfile(file_path):
+        return jsonify({"status": "error", "message": "File not found"}), 404
+    try:
+        length = min(max(int(request.args.get('bytes', 65536)), 1), FILE_CHUNK_SIZE)
+    except ValueError:
+        return jsonify({"status": "error", "message": "Invalid byte count"}), 400
+    return jsonify(dict(read_file_preview(file_path, length), status="success"))
+
+@app.route('/script/run/<path:filename>')
 def run_script(filename):
-    """Execute a shell script"""
+    """Queue a shell script for execution"""
     if not filename.endswith('.sh'):
         return jsonify({"status": "error", "message": "Only .sh files can be executed"})
     
-    file_path = os.path.join(SCRIPT_DIR, filename)
-    if not os.path.exists(file_path):
+    file_path = resolve_script_path(filename)
+    if file_path is None or not os.path.exists(file_path):
         return jsonify({"status": "error", "message": "Script not found"})
+    if 'nodes' in request.args or 'groups' in request.args:
+        return run_script_fanout(file_path)
+    
+    job = submit_job(file_path)
+    if job is None:
+        return jsonify({"status": "error", "message": "Job queue is full, try again later"}), 503
+    return jsonify({"status": "success", "message": "Script queued", "job_id": job['id']})
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    """Get the state of a script job"""
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({"status": "error", "message": "Job not found"}), 404
+    return jsonify({"status": "success", "job": job})
+
+@app.route('/jobs/<job_id>/stream')
+def job_stream(job_id):
+    """Stream the output of a script job as Server-Sent Events"""
+    output = get_job_output(job_id)
+    if output is None:
+        return jsonify({"status": "error", "message": "Job not found"}), 404
+    
+    return output_event_stream(output, lambda: get_job(job_id))
+
+@app.route('/jobs/<job_id>/cancel', methods=['POST'])
+def job_cancel(job_id):
+    """Cancel a queued or running script job"""
+    success, message = cancel_job(job_id)
+    if success:
+        return jsonify({"status": "success", "message": message})
+    else:
+        return jsonify({"status": "error", "message": message}), 400
+
+def run_script_fanout(file_path):
+    """Start a fan-out from the /script/run query parameters"""
+    split = lambda name: [item for item in request.args.get(name, '').split(',') if item]
+    try:
+        nodes = node_inventory.select(split('nodes'), split('groups'))
+        concurrency = int(request.args.get('concurrency', FANOUT_CONCURRENCY))
+        batch_size = int(request.args.get('batch_size', 0)) or None
+        max_failures = request.args.get('max_failures', '')
+        if max_failures.endswith('%'):
+            # A share of all nodes, rounded down
+            max_failures = int(float(max_failures[:-1]) * len(nodes) / 100)
+        else:
+            max_failures = int(max_failures) if max_failures else None
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    if not nodes:
+        return jsonify({"status": "error", "message": "No nodes selected"}), 400
+    if batch_size is not None and batch_size < 1 or max_failures is not None and max_failures < 0:
+        return jsonify({"status": "error", "message": "Invalid batch_size or max_failures"}), 400
+    
+    run = submit_fanout(file_path, nodes, min(max(concurrency, 1), FANOUT_CONCURRENCY), batch_size, max_failures)
+    return jsonify({"status": "success", "message": f"Script queued on {len(nodes)} nodes", "fanout_id": run['id']})
+
+@app.route('/fanout/<run_id>')
+def fanout_status(run_id):
+    """Get the state of a fan-out and the result of every node"""
+    run = get_fanout(run_id)
+    if run is None:
+        return jsonify({"status": "error", "message": "Fan-out not found"}), 404
+    return jsonify({"status": "success", "fanout": run})
+
+@app.route('/fanout/<run_id>/nodes/<name>/stream')
+def fanout_node_stream(run_id, name):
+    """Stream the output of one node of a fan-out as Server-Sent Events"""
+    output = get_fanout_output(run_id, name)
+    if output is None:
+        return jsonify({"status": "error", "message": "Node not found"}), 404
+    
+    def result():
+        run = get_fanout(run_id)
+        return next((node for node in run['nodes'] if node['name'] == name), None) if run else None
+    return output_event_stream(output, result)
+
+@app.route('/fanout/<run_id>/cancel', methods=['POST'])
+def fanout_cancel(run_id):
+    """Cancel a running fan-out"""
+    success, message = cancel_fanout(run_id)
+    if success:
+        return jsonify({"status": "success", "message": message})
+    else:
+        return jsonify({"status": "error", "message": message}), 400
+
+@app.route('/api/nodes')
+def api_nodes():
+    """List the nodes of the inventory"""
+    return jsonify({"status": "success", "nodes": list(node_inventory.load().values())})
+
+@app.route('/pipeline/run/<path:filename>')
+def run_pipeline_route(filename):
+    """Start a run of a pipeline definition"""
+    if not filename.endswith(PIPELINE_SUFFIX):
+        return jsonify({"status": "error", "message": f"Pipelines are {PIPELINE_SUFFIX} files"}), 400
+    
+    file_path = resolve_script_path(filename)
+    if file_path is None or not os.path.exists(file_path):
+        return jsonify({"status": "error", "message": "Pipeline not found"}), 404
+    try:
+        definition = load_pipeline(file_path)
+        if 'concurrency' in request.args:
+            definition['concurrency'] = min(max(int(request.args['concurrency']), 1), PIPELINE_CONCURRENCY)
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    
+    run = submit_pipeline(file_path, definition)
+    return jsonify({"status": "success", "message": f"Pipeline started with {len(run['steps'])} steps",
+                    "pipeline_id": run['id']})
+
+@app.route('/pipeline/<run_id>')
+def pipeline_status(run_id):
+    """Get the state of a pipeline run with the timing of every step"""
+    run = get_pipeline(run_id)
+    if run is None:
+        return jsonify({"status": "error", "message": "Pipeline run not found"}), 404
+    return jsonify({"status": "success", "pipeline": run})
+
+@app.route('/pipeline/<run_id>/steps/<name>/stream')
+def pipeline_step_stream(run_id, name):
+    """Stream the output of one step of a pipeline run as Server-Sent Events"""
+    output = get_pipeline_output(run_id, name)
+    if output is None:
+        return jsonify({"status": "error", "message": "Step not found"}), 404
     
-    success, message = execute_script(file_path)
+    def result():
+        run = get_pipeline(run_id)
+        return next((step for step in run['steps'] if step['name'] == name), None) if run else None
+    return output_event_stream(output, result)
+
+@app.route('/pipeline/<run_id>/cancel', methods=['POST'])
+def pipeline_cancel(run_id):
+    """Cancel a running pipeline"""
+    success, message = cancel_pipeline(run_id)
     if success:
         return jsonify({"status": "success", "message": message})
     else:
-        return jsonify({"status": "error", "message": message})
+        return jsonify({"status": "error", "message": message}), 400
+
+@app.route('/pipeline/<run_id>/resume', methods=['POST'])
+def pipeline_resume(run_id):
+    """Run a failed pipeline again from the steps that did not finish"""
+    try:
+        run, message = resume_pipeline(run_id)
+    except ValueError as e:
+        run, message = None, str(e)
+    if run is None:
+        return jsonify({"status": "error", "message": message}), 400
+    reused = sum(1 for step in run['steps'] if step['state'] == 'reused')
+    return jsonify({"status": "success", "message": f"Pipeline resumed, {reused} finished steps reused",
+                    "pipeline_id": run['id']})
+
+@app.route('/api/pipelines')
+def api_pipelines():
+    """List the pipeline definitions in the script directory"""
+    return jsonify({"status": "success", "pipelines": list_pipelines()})
 
 @app.route('/script/create', methods=['GET', 'POST'])
 def create_script():
@@ -450,10 +5754,12 @@ def create_script():
             flash('File already exists', 'danger')
             return redirect(url_for('create_script'))
         
-        if write_file_content(file_path, content):
+        status, _ = write_file_content(file_path, content)
+        if status == 'saved':
             # Make .sh files executable
             if filename.endswith('.sh'):
                 os.chmod(file_path, 0o755)
+                file_index.invalidate(file_path)
             flash(f'File "{filename}" created successfully', 'success')
             return redirect(url_for('edit_script', filename=filename))
         else:
@@ -466,20 +5772,243 @@ def tmux_manager():
     """Tmux sessions management page"""
     return render_template('tmux.html')
 
-@app.route('/script/delete/<filename>')
+@app.route('/script/delete/<path:filename>')
 def delete_script(filename):
     """Delete a script file"""
-    file_path = os.path.join(SCRIPT_DIR, filename)
-    if delete_file(file_path):
+    file_path = resolve_script_path(filename)
+    if file_path is not None and delete_file(file_path):
         return jsonify({"status": "success", "message": f"File {filename} deleted"})
     else:
         return jsonify({"status": "error", "message": f"Failed to delete file {filename}"})
 
+@app.route('/api/tree')
+def api_tree():
+    """List one folder of SCRIPT_DIR, a page at a time"""
+    path = request.args.get('path', '').strip('/')
+    sort = request.args.get('sort', 'name')
+    order = request.args.get('order', 'asc')
+    filter_text = request.args.get('filter', '')
+    if sort not in ('name', 'modified', 'size') or order not in ('asc', 'desc'):
+        return jsonify({"status": "error", "message": "Invalid sort"}), 400
+    try:
+        limit = min(max(int(request.args.get('limit', 100)), 1), 1000)
+    except ValueError:
+        return jsonify({"status": "error", "message": "Invalid limit"}), 400
+    
+    if path:
+        resolved = resolve_script_path(path)
+        if resolved is None:
+            return jsonify({"status": "error", "message": "Folder not found"}), 404
+        path = os.path.relpath(resolved, os.path.normpath(SCRIPT_DIR))
+    
+    cursor = None
+    if request.args.get('cursor'):
+        try:
+            cursor = tuple(json.loads(base64.urlsafe_b64decode(request.args['cursor'])))
+        except (ValueError, TypeError):
+            return jsonify({"status": "error", "message": "Invalid cursor"}), 400
+    
+    try:
+        result = file_index.list_dir(path, sort, order, filter_text, cursor, limit)
+    except TypeError:
+        # A cursor taken from a listing with a different sort
+        return jsonify({"status": "error", "message": "Invalid cursor"}), 400
+    if result is None:
+        return jsonify({"status": "error", "message": "Folder not found"}), 404
+    
+    entries, next_cursor, total = result
+    if next_cursor is not None:
+        next_cursor = base64.urlsafe_b64encode(json.dumps(next_cursor).encode()).decode()
+    return jsonify({
+        "status": "success",
+        "path": path,
+        "entries": entries,
+        "next_cursor": next_cursor,
+        "total": total
+    })
+
+@app.route('/api/search')
+def api_search():
+    """Search the contents and paths of all files in SCRIPT_DIR"""
+    if search_index is None:
+        return jsonify({"status": "error", "message": "Search is disabled"}), 404
+    query = request.args.get('q', '')
+    regex = request.args.get('regex', 'false').lower() in ('1', 'true')
+    try:
+        limit = min(max(int(request.args.get('limit', 20)), 1), 100)
+        offset = max(int(request.args.get('offset', 0)), 0)
+    except ValueError:
+        return jsonify({"status": "error", "message": "Invalid limit or offset"}), 400
+    
+    started = time.monotonic()
+    try:
+        results, more = search_index.search(query, regex, offset, limit)
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    return jsonify({
+        "status": "success",
+        "results": results,
+        "more": more,
+        "took_ms": round((time.monotonic() - started) * 1000, 1)
+    })
+
+@app.route('/api/runs')
+def api_runs():
+    """Query the run history, newest first, a page at a time"""
+    if run_history is None:
+        return jsonify({"status": "error", "message": "Run history is disabled"}), 404
+    try:
+        limit = min(max(int(request.args.get('limit', 50)), 1), 1000)
+        since = float(request.args['since']) if request.args.get('since') else None
+        until = float(request.args['until']) if request.args.get('until') else None
+        if request.args.get('hours'):
+            since = time.time() - float(request.args['hours']) * 3600
+    except ValueError:
+        return jsonify({"status": "error", "message": "Invalid limit or time range"}), 400
+    
+    cursor = None
+    if request.args.get('cursor'):
+        try:
+            cursor = tuple(json.loads(base64.urlsafe_b64decode(request.args['cursor'])))
+            if len(cursor) != 2:
+                raise ValueError
+        except (ValueError, TypeError):
+            return jsonify({"status": "error", "message": "Invalid cursor"}), 400
+    
+    runs, next_cursor = run_history.query(script=request.args.get('script') or None,
+                                          status=request.args.get('status') or None,
+                                          since=since, until=until, cursor=cursor, limit=limit)
+    if next_cursor is not None:
+        next_cursor = base64.urlsafe_b64encode(json.dumps(next_cursor).encode()).decode()
+    return jsonify({"status": "success", "runs": runs, "next_cursor": next_cursor})
+
+@app.route('/api/runs/<int:run_id>')
+def api_run(run_id):
+    """Get one recorded run including its output"""
+    run = run_history.get(run_id) if run_history else None
+    if run is None:
+        return jsonify({"status": "error", "message": "Run not found"}), 404
+    return jsonify({"status": "success", "run": run})
+
+@app.route('/api/runs/usage')
+def api_runs_usage():
+    """Resource usage per script, the most expensive scripts first"""
+    if run_history is None:
+        return jsonify({"status": "error", "message": "Run history is disabled"}), 404
+    try:
+        hours = float(request.args.get('hours', 24))
+        limit = min(max(int(request.args.get('limit', 50)), 1), 1000)
+    except ValueError:
+        return jsonify({"status": "error", "message": "Invalid hours or limit"}), 400
+    return jsonify({"status": "success", "scripts": run_history.usage(time.time() - hours * 3600, limit)})
+
+@app.route('/api/cache/results', methods=['GET', 'DELETE'])
+def api_result_cache():
+    """Hit rate and size of the result cache, DELETE empties it or drops one `script`"""
+    if result_cache is None:
+        return jsonify({"status": "error", "message": "Result cache is disabled"}), 404
+    if request.method == 'DELETE':
+        dropped = result_cache.clear(request.args.get('script'))
+        return jsonify({"status": "success", "message": f"Dropped {dropped} cached results"})
+    return jsonify({"status": "success", "cache": result_cache.stats()})
+
+@app.route('/api/cache/rules/<path:filename>')
+def api_cache_rule(filename):
+    """Get the cache rule a script runs with, null when its results are not cached"""
+    file_path = resolve_script_path(filename)
+    if file_path is None:
+        return jsonify({"status": "error", "message": "Script not found"}), 404
+    relpath = os.path.relpath(file_path, os.path.normpath(SCRIPT_DIR))
+    return jsonify({"status": "success", "script": relpath, "rule": cache_rules.for_script(relpath)})
+
+@app.route('/api/limits/<path:filename>')
+def api_script_limits(filename):
+    """Get the resource limits a script runs with"""
+    file_path = resolve_script_path(filename)
+    if file_path is None:
+        return jsonify({"status": "error", "message": "Script not found"}), 404
+    relpath = os.path.relpath(file_path, os.path.normpath(SCRIPT_DIR))
+    return jsonify({"status": "success", "script": relpath, "limits": resource_profiles.for_script(relpath)})
+
+@app.route('/api/schedules', methods=['GET', 'POST'])
+def api_schedules():
+    """List schedules or add one"""
+    if scheduler is None:
+        return jsonify({"status": "error", "message": "Scheduler is disabled"}), 404
+    if request.method == 'POST':
+        schedule = request.get_json(silent=True) or {}
+        schedule.pop('id', None)
+        schedule.pop('last_run', None)
+        error = scheduler.validate(schedule)
+        if error:
+            return jsonify({"status": "error", "message": error}), 400
+        return jsonify({"status": "success", "schedule": schedule_response(scheduler.save(schedule))}), 201
+    
+    return jsonify({"status": "success", "schedules": [schedule_response(s) for s in scheduler.list()]})
+
+@app.route('/api/schedules/<schedule_id>', methods=['GET', 'PUT', 'DELETE'])
+def api_schedule(schedule_id):
+    """Get, change or remove one schedule"""
+    current = scheduler.get(schedule_id) if scheduler else None
+    if current is None:
+        return jsonify({"status": "error", "message": "Schedule not found"}), 404
+    if request.method == 'DELETE':
+        scheduler.delete(schedule_id)
+        return jsonify({"status": "success", "message": "Schedule deleted"})
+    if request.method == 'PUT':
+        changes = request.get_json(silent=True) or {}
+        schedule = dict(current, **{key: value for key, value in changes.items()
+                                    if key in Scheduler.COLUMNS and key not in ('id', 'created', 'last_run')})
+        # Switching between cron and interval clears the other one
+        if changes.get('cron'):
+            schedule['interval'] = None
+        elif changes.get('interval'):
+            schedule['cron'] = None
+        error = scheduler.validate(schedule)
+        if error:
+            return jsonify({"status": "error", "message": error}), 400
+        current = scheduler.save(schedule)
+    
+    return jsonify({"status": "success", "schedule": schedule_response(current)})
+
+def schedule_response(schedule):
+    """Add the next run time to a schedule record"""
+    next_run = scheduler.next_run(schedule, time.time()) if schedule['enabled'] else None
+    return dict(schedule, next_run=next_run)
+
+@app.route('/api/events')
+def api_events():
+    """Stream file, git, job and tmux session changes, one stream per page"""
+    topics = {topic for topic in request.args.get('topics', ','.join(EventHub.TOPICS)).split(',') if topic}
+    if not topics or not topics <= set(EventHub.TOPICS):
+        return jsonify({"status": "error", "message": f"Topics must be among {', '.join(EventHub.TOPICS)}"}), 400
+    subscriber = event_hub.subscribe(topics)
+    
+    def generate():
+        try:
+            while True:
+                try:
+                    topic, payload = subscriber.get(timeout=15)
+                except queue.Empty:
+                    # Keeps proxies open and lets us notice closed clients
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"event: {topic}\ndata: {json.dumps(payload)}\n\n"
+        finally:
+            event_hub.unsubscribe(subscriber)
+    
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 @app.route('/tmux/sessions')
 def tmux_sessions():
     """Get all running tmux sessions"""
-    sessions = get_tmux_sessions()
-    return jsonify(sessions)
+    try:
+        sessions, version = tmux_control.list_sessions_versioned()
+    except Exception as e:
+        print(f"Error getting tmux sessions: {e}")
+        return jsonify([])
+    return cached_json('tmux_sessions', version, lambda: sessions)
 
 @app.route('/tmux/kill/<session_name>')
 def tmux_kill_session(session_name):
@@ -499,18 +6028,26 @@ def tmux_session_output(session_name):
 @app.route('/tmux/stream/<session_name>')
 def tmux_stream_session(session_name):
     """Stream output from a tmux session"""
+    streamer, subscriber = subscribe_tmux_session(session_name)
+    
     def generate():
-        last_output = ""
-        while True:
-            output = get_tmux_session_output(session_name)
-            if output != last_output:
-                last_output = output
-                # Fix the backslash issue in f-string
-                escaped_output = output.replace('\n', '\\n')
-                yield f"data: {escaped_output}\n\n"
-            time.sleep(1)
+        try:
+            while True:
+                try:
+                    kind, payload = subscriber.get(timeout=15)
+                except queue.Empty:
+                    # Keeps proxies open and lets us notice closed clients
+                    yield ": keepalive\n\n"
+                    continue
+                if kind == 'closed':
+                    yield "event: closed\ndata: {}\n\n"
+                    return
+                yield f"event: {kind}\ndata: {json.dumps(payload)}\n\n"
+        finally:
+            unsubscribe_tmux_session(streamer, subscriber)
     
-    return Response(generate(), mimetype='text/event-stream')
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 # Source Control Routes
 @app.route('/git/status')
@@ -519,18 +6056,22 @@ def git_status():
     if not GIT_ENABLED:
         return jsonify({"error": "Git is not enabled"}), 400
     
-    if not is_git_repo():
+    state, version = git_state_cache.get_versioned()
+    if state is None:
         return jsonify({"error": "Not a git repository"}), 400
     
-    status = get_git_status()
-    branch = get_git_branch()
-    commits = get_commit_history(5)
-    
-    return jsonify({
-        "status": status or [],
-        "branch": branch,
-        "commits": commits
-    })
+    return cached_json('git_status', version, lambda: git_status_payload(state))
+
+def git_status_payload(state):
+    """The /git/status body for a git_state_cache state"""
+    return {
+        "status": state['status'] or [],
+        "branch": state['branch'],
+        "upstream": state['upstream'],
+        "ahead": state['ahead'],
+        "behind": state['behind'],
+        "commits": state['commits'][:5]
+    }
 
 @app.route('/git/stage/<filename>', methods=['POST'])
 def git_stage_file(filename):
@@ -568,6 +6109,28 @@ def git_discard_file_route(filename):
     else:
         return jsonify({"error": f"Failed to discard changes to {filename}"}), 500
 
+@app.route('/git/stage', methods=['POST'])
+@app.route('/git/unstage', methods=['POST'])
+@app.route('/git/discard', methods=['POST'])
+def git_batch_route():
+    """Stage, unstage or discard a list of files in one request"""
+    if not GIT_ENABLED or not is_git_repo():
+        return jsonify({"error": "Git not available"}), 400
+    
+    action = request.path.rsplit('/', 1)[-1]
+    data = request.get_json(silent=True) or {}
+    files = data.get('files')
+    if not isinstance(files, list) or not files or not all(isinstance(f, str) and f for f in files):
+        return jsonify({"error": "A non-empty list of files is required"}), 400
+    
+    results = git_batch(action, files)
+    failed = sum(1 for result in results if not result['success'])
+    past_tense = {'stage': 'staged', 'unstage': 'unstaged', 'discard': 'discarded'}[action]
+    message = f"{len(results) - failed} of {len(results)} file{'s' if len(results) != 1 else ''} {past_tense}"
+    if failed:
+        return jsonify({"error": message, "results": results}), 500
+    return jsonify({"message": message, "results": results})
+
 @app.route('/git/discard-all', methods=['POST'])
 def git_discard_all_route():
     """Discard all changes"""
@@ -600,44 +6163,60 @@ def git_commit_route():
 
 @app.route('/git/push', methods=['POST'])
 def git_push_route():
-    """Push changes to remote"""
+    """Push changes to remote in the background"""
     if not GIT_ENABLED or not is_git_repo():
         return jsonify({"error": "Git not available"}), 400
     
-    success, message = git_push()
-    if success:
-        return jsonify({"message": message})
-    else:
-        return jsonify({"error": message}), 500
+    task = submit_git_task('push')
+    return jsonify({"message": "Push started", "task_id": task['id']}), 202
 
 @app.route('/git/pull', methods=['POST'])
 def git_pull_route():
-    """Pull changes from remote"""
+    """Pull changes from remote in the background"""
     if not GIT_ENABLED or not is_git_repo():
         return jsonify({"error": "Git not available"}), 400
     
-    success, message = git_pull()
-    if success:
-        return jsonify({"message": message})
+    task = submit_git_task('pull')
+    return jsonify({"message": "Pull started", "task_id": task['id']}), 202
+
+@app.route('/git/fetch', methods=['POST'])
+def git_fetch_route():
+    """Fetch from remote in the background"""
+    if not GIT_ENABLED or not is_git_repo():
+        return jsonify({"error": "Git not available"}), 400
+    
+    task = submit_git_task('fetch')
+    return jsonify({"message": "Fetch started", "task_id": task['id']}), 202
+
+@app.route('/git/tasks/<task_id>')
+def git_task_status(task_id):
+    """Get the state and progress of a git network operation"""
+    task = get_git_task(task_id)
+    if task is None:
+        return jsonify({"error": "Task not found"}), 404
+    return jsonify(task)
+
+@app.route('/git/tasks/<task_id>/stream')
+def git_task_stream(task_id):
+    """Stream the progress output of a git network operation"""
+    with git_tasks_lock:
+        task = git_tasks.get(task_id)
+    if task is not None:
+        output = task['output']
+    elif state_store and state_store.load('git', task_id):
+        output = StoredOutput(task_id)
     else:
-        return jsonify({"error": message}), 500
+        return jsonify({"error": "Task not found"}), 404
+    return output_event_stream(output, lambda: get_git_task(task_id))
 
 # API Routes for Homepage Widget
 @app.route('/api/stats')
 def api_stats():
     """API endpoint for homepage widget - returns script statistics"""
     try:
-        files = get_all_files()
-        
-        # Count different file types
-        total_scripts = len(files)
-        executable_scripts = len([f for f in files if f.get('executable', False)])
-        shell_scripts = len([f for f in files if f['name'].endswith('.sh')])
-        python_scripts = len([f for f in files if f['name'].endswith('.py')])
-        config_files = len([f for f in files if f['name'].endswith(('.conf', '.cfg', '.ini', '.env', '.yaml', '.yml', '.json'))])
-        
-        # Calculate total size
-        total_size = sum(f.get('size', 0) for f in files)
+        # Versions are read first, a newer state under an older version only costs a rebuild
+        version = (file_index.generation, git_state_cache.version)
+        _, file_stats = file_index.snapshot()
         
         # Get git info if available
         git_info = {}
@@ -652,24 +6231,16 @@ def api_stats():
         else:
             git_info = {'enabled': False}
         
-        # Get most recent file
-        recent_file = None
-        if files:
-            most_recent = max(files, key=lambda x: x.get('modified', 0))
-            recent_file = {
-                'name': most_recent['name'],
-                'modified': most_recent.get('modified', 0)
-            }
-        
-        return jsonify({
-            'total_scripts': total_scripts,
-            'executable_scripts': executable_scripts,
-            'shell_scripts': shell_scripts,
-            'python_scripts': python_scripts,
-            'config_files': config_files,
-            'total_size_bytes': total_size,
+        # last_updated is when these numbers last changed
+        return cached_json('stats', version, lambda: {
+            'total_scripts': file_stats['total_scripts'],
+            'executable_scripts': file_stats['executable_scripts'],
+            'shell_scripts': file_stats['shell_scripts'],
+            'python_scripts': file_stats['python_scripts'],
+            'config_files': file_stats['config_files'],
+            'total_size_bytes': file_stats['total_size_bytes'],
             'git': git_info,
-            'recent_file': recent_file,
+            'recent_file': file_stats['recent_file'],
             'status': 'online',
             'last_updated': int(datetime.now().timestamp())
         })
@@ -681,5 +6252,75 @@ def api_stats():
             'last_updated': int(datetime.now().timestamp())
         }), 500
 
+@app.route('/healthz')
+def healthz():
+    """Liveness probe, answers as long as the worker can serve requests"""
+    return jsonify({"status": "ok", "pid": os.getpid()})
+
+@app.route('/readyz')
+def readyz():
+    """Readiness probe, checks what a worker needs to do useful work"""
+    checks = {
+        'script_dir': os.path.isdir(SCRIPT_DIR) and os.access(SCRIPT_DIR, os.R_OK | os.W_OK),
+        'job_queue': not job_queue.full()
+    }
+    if state_store:
+        try:
+            state_store.ping()
+            checks['state_store'] = True
+        except Exception as e:
+            print(f"State store not ready: {e}")
+            checks['state_store'] = False
+    ready = all(checks.values())
+    return jsonify({"status": "ready" if ready else "not ready", "checks": checks}), 200 if ready else 503
+
+def count_jobs():
+    with jobs_lock:
+        states = Counter(job['state'] for job in jobs.values())
+    return [({'state': state}, states[state]) for state in StateStore.ACTIVE_STATES]
+
+def count_fanout_nodes():
+    with fanouts_lock:
+        states = Counter(node['state'] for run in fanouts.values() if run['finished'] is None for node in run['nodes'])
+    return [({'state': state}, states[state]) for state in StateStore.ACTIVE_STATES]
+
+def count_pipeline_steps():
+    with pipelines_lock:
+        states = Counter(step['state'] for run in pipelines.values() if run['finished'] is None for step in run['steps'])
+    return [({'state': state}, states[state]) for state in ('waiting', 'running', 'retrying')]
+
+metrics.define('gauge', 'script_manager_jobs', 'Jobs of this server by state', count_jobs)
+metrics.define('gauge', 'script_manager_fanout_nodes', 'Nodes of running fan-outs by state', count_fanout_nodes)
+metrics.define('gauge', 'script_manager_pipeline_steps', 'Steps of running pipelines by state', count_pipeline_steps)
+metrics.define('gauge', 'script_manager_job_queue_depth', 'Jobs waiting for a job worker', job_queue.qsize)
+metrics.define('gauge', 'script_manager_git_task_queue_depth', 'Git network commands waiting to run',
+               lambda: len(git_task_queue))
+metrics.define('gauge', 'script_manager_event_subscribers', 'Open /api/events streams',
+               lambda: len(event_hub.subscribers))
+metrics.define('gauge', 'script_manager_tmux_streams', 'Tmux sessions streamed to viewers',
+               lambda: len(tmux_streamers))
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus metrics of every worker"""
+    return Response(metrics.scrape(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/profiles/<name>')
+def get_profile(name):
+    """Download a request profile written to PROFILE_DIR"""
+    path = os.path.join(PROFILE_DIR, os.path.basename(name))
+    if not PROFILE_DIR or not name.endswith('.folded') or not os.path.isfile(path):
+        return jsonify({"status": "error", "message": "Profile not found"}), 404
+    with open(path) as file:
+        return Response(file.read(), mimetype='text/plain')
+
+start_git_fetcher()
+metrics.start()
+if scheduler:
+    scheduler.start()
+if search_index:
+    search_index.start()
+
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=4000, debug=True)
+    # Development server, use gunicorn -c gunicorn.conf.py app:app in production
+    app.run(host='0.0.0.0', port=4000, debug=DEBUG)
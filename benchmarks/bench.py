@@ -0,0 +1,492 @@
+"""Benchmarks for Script Manager.
+
+Builds a synthetic script directory, a git repository with a long history
+and a few tmux sessions, then times the main routes in-process through the
+Flask test client and over HTTP against a gunicorn server with concurrent
+clients. Data sets are generated from a seed, so two runs with the same
+options measure the same tree.
+
+    python benchmarks/bench.py --files 10000 --commits 2000
+    python benchmarks/bench.py --save benchmarks/baseline.json
+    python benchmarks/bench.py --compare benchmarks/baseline.json
+"""
+from datetime import datetime
+import argparse
+import http.client
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# (bytes, weight) of generated files, most scripts are small
+FILE_SIZES = ((200, 60), (4 * 1024, 30), (64 * 1024, 9), (1024 * 1024, 1))
+FILE_TYPES = (('.sh', 50), ('.py', 25), ('.conf', 15), ('.txt', 10))
+FILES_PER_DIR = 50
+MAX_DEPTH = 4
+
+def weighted(rng, choices):
+    values, weights = zip(*choices)
+    return rng.choices(values, weights)[0]
+
+def file_body(rng, extension, size):
+    """Text of roughly `size` bytes, with words the search benchmark looks for"""
+    header = {'.sh': '#!/bin/bash\n', '.py': '#!/usr/bin/env python3\n'}.get(extension, '')
+    lines = [header]
+    total = len(header)
+    number = 0
+    while total < size:
+        line = f"echo line {number} {rng.choice(('backup', 'deploy', 'rotate', 'sync'))} {rng.getrandbits(32):08x}\n"
+        lines.append(line)
+        total += len(line)
+        number += 1
+    return ''.join(lines)
+
+def build_script_dir(root, files, seed):
+    """Write `files` scripts into nested folders of FILES_PER_DIR each"""
+    rng = random.Random(seed)
+    dirs = ['']
+    written = 0
+    while written < files:
+        # Each folder gets a batch of files and sometimes subfolders
+        relpath = dirs[written // FILES_PER_DIR % len(dirs)]
+        if relpath.count(os.sep) < MAX_DEPTH - 1 and rng.random() < 0.3:
+            dirs.append(os.path.join(relpath, f'dir-{len(dirs)}'))
+        os.makedirs(os.path.join(root, relpath), exist_ok=True)
+        extension = weighted(rng, FILE_TYPES)
+        path = os.path.join(root, relpath, f'file-{written}{extension}')
+        with open(path, 'w') as file:
+            file.write(file_body(rng, extension, weighted(rng, FILE_SIZES)))
+        if extension in ('.sh', '.py'):
+            os.chmod(path, 0o755)
+        written += 1
+    
+    # Fixed scripts the execution benchmark runs
+    os.makedirs(os.path.join(root, 'bench'), exist_ok=True)
+    with open(os.path.join(root, 'bench', 'hello.sh'), 'w') as file:
+        file.write('#!/bin/bash\nfor i in $(seq 1 100); do echo "hello $i"; done\n')
+    os.chmod(os.path.join(root, 'bench', 'hello.sh'), 0o755)
+
+def git(root, *args, **kwargs):
+    return subprocess.run(['git', *args], cwd=root, check=True, stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE, **kwargs)
+
+def build_git_repo(root, commits, seed):
+    """Commit the tree, add `commits` more with fast-import, then leave some changes uncommitted"""
+    rng = random.Random(seed)
+    git(root, 'init', '-q', '-b', 'main')
+    git(root, 'config', 'user.name', 'Benchmark')
+    git(root, 'config', 'user.email', 'bench@example.com')
+    git(root, 'add', '-A')
+    git(root, 'commit', '-q', '-m', 'Initial scripts')
+    
+    stream = []
+    for number in range(commits):
+        body = f'note {number} {rng.getrandbits(64):016x}\n'.encode()
+        message = f'Update notes {number}'.encode()
+        stream.append(b'commit refs/heads/main\n')
+        stream.append(f'committer Benchmark <bench@example.com> {1700000000 + number * 60} +0000\n'.encode())
+        stream.append(b'data %d\n%s\n' % (len(message), message))
+        if number == 0:
+            stream.append(b'from refs/heads/main^0\n')
+        stream.append(f'M 644 inline history/notes-{number % 50}.txt\n'.encode())
+        stream.append(b'data %d\n%s\n' % (len(body), body))
+    git(root, 'fast-import', '--quiet', input=b''.join(stream))
+    git(root, 'reset', '-q', '--hard')
+    
+    # A realistic status has modified and untracked files in it
+    for number in range(20):
+        with open(os.path.join(root, 'history', f'notes-{number}.txt'), 'a') as file:
+            file.write('local change\n')
+    for number in range(10):
+        with open(os.path.join(root, f'untracked-{number}.sh'), 'w') as file:
+            file.write('#!/bin/bash\necho untracked\n')
+
+def build_data(workdir, args):
+    """Create the data set in `workdir`, reusing one built with the same options"""
+    options = {'files': args.files, 'commits': args.commits, 'seed': args.seed}
+    marker = os.path.join(workdir, 'dataset.json')
+    script_dir = os.path.join(workdir, 'scripts')
+    if os.path.exists(marker):
+        with open(marker) as file:
+            if json.load(file) == options:
+                print(f"Reusing data set in {workdir}")
+                return script_dir
+        shutil.rmtree(workdir)
+    os.makedirs(workdir, exist_ok=True)
+    started = time.time()
+    build_script_dir(script_dir, args.files, args.seed)
+    if args.commits:
+        build_git_repo(script_dir, args.commits, args.seed)
+    with open(marker, 'w') as file:
+        json.dump(options, file)
+    print(f"Built {args.files} files and {args.commits} commits in {time.time() - started:.1f}s")
+    return script_dir
+
+def start_tmux(env, sessions):
+    """Start `sessions` detached sessions on the benchmark's own tmux server"""
+    if not shutil.which('tmux'):
+        print("tmux not found, tmux routes are skipped")
+        return False
+    for number in range(sessions):
+        subprocess.run(['tmux', 'new-session', '-d', '-s', f'bench-{number}', '-x', '200', '-y', '50',
+                        'seq 1 5000; exec sleep 86400'], env=env, check=True)
+    return True
+
+def stop_tmux(env):
+    subprocess.run(['tmux', 'kill-server'], env=env, stderr=subprocess.DEVNULL)
+
+def app_env(workdir, script_dir, args):
+    """Settings of the app under test, everything it writes stays in `workdir`"""
+    tmux_dir = os.path.join(workdir, 'tmux')
+    os.makedirs(tmux_dir, exist_ok=True)
+    # Inside a tmux session TMUX would point tmux at the user's own server
+    env = {key: value for key, value in os.environ.items() if key != 'TMUX'}
+    return dict(env,
+                SCRIPT_DIR=script_dir,
+                GIT_ENABLED='true',
+                TMUX_TMPDIR=tmux_dir,
+                SEARCH_DB=os.path.join(workdir, 'search.db'),
+                HISTORY_DB=os.path.join(workdir, 'history.db'),
+                STATE_DB=os.path.join(workdir, 'state.db') if args.workers > 1 else '',
+                SCHEDULE_DB='',
+                RESOURCE_PROFILES=os.path.join(workdir, 'resource_profiles.json'),
+                JOB_QUEUE_SIZE=str(max(100, args.concurrency * 4)),
+                WEB_WORKERS=str(args.workers),
+                WEB_THREADS=str(args.threads),
+                METRICS_FLUSH_INTERVAL='1',
+                SCRIPT_NICE=args.script_nice,
+                SCRIPT_SPAWNER='false' if args.no_spawner else 'true')
+
+class TestClient:
+    """The Flask test client behind the interface HttpClient has"""
+    
+    def __init__(self, app):
+        self.client = app.test_client()
+    
+    def request(self, method, path, headers=None):
+        response = self.client.open(path, method=method, headers=headers or {})
+        return response.status_code, response.headers, response.get_data()
+
+class HttpClient:
+    """One keep-alive connection to the server"""
+    
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.conn = None
+    
+    def request(self, method, path, headers=None):
+        for attempt in range(2):
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection(self.host, self.port, timeout=60)
+            try:
+                self.conn.request(method, path, headers=headers or {})
+                response = self.conn.getresponse()
+                return response.status, response.headers, response.read()
+            except (http.client.HTTPException, ConnectionError):
+                # The server closed an idle keep-alive connection
+                self.conn.close()
+                self.conn = None
+                if attempt:
+                    raise
+
+def get(path, headers=None):
+    """A route that sends one request"""
+    def call(client):
+        return client.request('GET', path, headers)[0]
+    return call
+
+def conditional(path):
+    """A poll that sends back the ETag of the previous one"""
+    def call(client):
+        etag = getattr(client, 'etags', {}).get(path)
+        status, headers, _ = client.request('GET', path, {'If-None-Match': etag} if etag else None)
+        if headers.get('ETag'):
+            client.etags = dict(getattr(client, 'etags', {}), **{path: headers['ETag']})
+        return 200 if status == 304 else status
+    return call
+
+def run_script(path):
+    """Queue a script and poll its job until it finished"""
+    def call(client):
+        status, _, body = client.request('GET', f'/script/run/{path}')
+        if status != 200:
+            return status
+        job_id = json.loads(body)['job_id']
+        while True:
+            status, _, body = client.request('GET', f'/jobs/{job_id}')
+            if status != 200:
+                return status
+            state = json.loads(body)['job']['state']
+            if state not in ('queued', 'running'):
+                return 200 if state == 'finished' else 500
+            time.sleep(0.005)
+    return call
+
+def routes(has_tmux):
+    """Name and callable of every benchmarked route"""
+    result = [
+        ('scripts', get('/scripts')),
+        ('stats', get('/api/stats')),
+        ('stats_etag', conditional('/api/stats')),
+        ('tree', get('/api/tree?path=')),
+        ('tree_filter', get('/api/tree?path=&filter=file-1&sort=size&order=desc')),
+        ('file', get('/api/file/bench/hello.sh')),
+        ('search', get('/api/search?q=rotate')),
+        ('search_regex', get('/api/search?q=line%204[0-9]%20sync&regex=1')),
+        ('git_status', get('/git/status')),
+        ('git_status_etag', conditional('/git/status')),
+        ('run_script', run_script('bench/hello.sh'))
+    ]
+    if has_tmux:
+        result += [
+            ('tmux_sessions', get('/tmux/sessions')),
+            ('tmux_output', get('/tmux/output/bench-0'))
+        ]
+    return result
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+def measure(make_client, call, requests, concurrency, warmup):
+    """Run `call` `requests` times spread over `concurrency` clients"""
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    # Timing starts once every client has warmed up
+    ready = threading.Barrier(concurrency + 1)
+    
+    def worker(count):
+        client = make_client()
+        try:
+            for _ in range(warmup):
+                call(client)
+        finally:
+            ready.wait()
+        own, failed = [], 0
+        for _ in range(count):
+            started = time.perf_counter()
+            try:
+                status = call(client)
+            except Exception:
+                status = None
+            elapsed = time.perf_counter() - started
+            if status == 200:
+                own.append(elapsed)
+            else:
+                failed += 1
+        with lock:
+            latencies.extend(own)
+            errors.append(failed)
+    
+    counts = [requests // concurrency + (1 if i < requests % concurrency else 0) for i in range(concurrency)]
+    threads = [threading.Thread(target=worker, args=(count,)) for count in counts]
+    for thread in threads:
+        thread.start()
+    ready.wait()
+    started = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': sum(errors),
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 3) if latencies else None,
+        'p90_ms': round(percentile(latencies, 0.9) * 1000, 3) if latencies else None,
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3) if latencies else None,
+        'max_ms': round(latencies[-1] * 1000, 3) if latencies else None,
+        'throughput': round(len(latencies) / elapsed, 1)
+    }
+
+def wait_for_search(search_db, files, timeout):
+    """Let the first index sync finish, search would be measured half built otherwise"""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with sqlite3.connect(search_db) as conn:
+                if conn.execute('SELECT count(*) FROM documents').fetchone()[0] >= files:
+                    return True
+        except sqlite3.Error:
+            # Not created yet
+            pass
+        time.sleep(0.5)
+    print("Search index not ready, search results are from a partial index")
+    return False
+
+def spawn_stats(client):
+    """Mean launch time of the scripts the app ran, by launch method"""
+    status, _, body = client.request('GET', '/metrics')
+    if status != 200:
+        return {}
+    totals = {}
+    for line in body.decode().splitlines():
+        match = re.match(r'script_manager_spawn_duration_seconds_(sum|count)\{method="(\w+)"\} (\S+)', line)
+        if match:
+            kind, method, value = match.groups()
+            totals.setdefault(method, {})[kind] = float(value)
+    return {f'spawn_{method}': {'launches': int(values['count']),
+                                'mean_ms': round(values['sum'] / values['count'] * 1000, 3)}
+            for method, values in totals.items() if values.get('count')}
+
+def run_suite(label, make_client, env, args, has_tmux, concurrency):
+    results = {}
+    # Any request starts the app's background indexing
+    make_client().request('GET', '/healthz')
+    wait_for_search(env['SEARCH_DB'], args.files, args.index_timeout)
+    for name, call in routes(has_tmux):
+        if args.routes and name not in args.routes:
+            continue
+        results[name] = measure(make_client, call, args.requests, concurrency, args.warmup)
+        print_row(label, name, results[name])
+    # Every worker has flushed its metrics by then
+    time.sleep(2)
+    for name, stats in spawn_stats(make_client()).items():
+        results[name] = stats
+        print(f"{label:<7} {name:<16} mean {stats['mean_ms']:8.2f}ms  {stats['launches']} launches")
+    return results
+
+def bench_in_process(env, args, has_tmux):
+    """Time the routes through the test client, one request at a time"""
+    # The app reads its settings when it is imported
+    os.environ.clear()
+    os.environ.update(env)
+    sys.path.insert(0, REPO_DIR)
+    import app
+    return run_suite('client', lambda: TestClient(app.app), env, args, has_tmux, 1)
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def bench_server(env, workdir, args, has_tmux):
+    """Time the routes over HTTP against gunicorn with concurrent clients"""
+    port = free_port()
+    env = dict(env, BIND=f'127.0.0.1:{port}')
+    log = open(os.path.join(workdir, 'gunicorn.log'), 'w')
+    server = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'app:app'],
+                              cwd=REPO_DIR, env=env, stdout=log, stderr=subprocess.STDOUT)
+    try:
+        deadline = time.time() + 60
+        while True:
+            try:
+                if HttpClient('127.0.0.1', port).request('GET', '/readyz')[0] == 200:
+                    break
+            except OSError:
+                pass
+            if server.poll() is not None or time.time() > deadline:
+                raise RuntimeError(f"Server did not start, see {log.name}")
+            time.sleep(0.2)
+        return run_suite('server', lambda: HttpClient('127.0.0.1', port), env, args, has_tmux, args.concurrency)
+    finally:
+        server.terminate()
+        server.wait()
+        log.close()
+
+def print_row(mode, name, stats):
+    print(f"{mode:<7} {name:<16} p50 {stats['p50_ms'] or 0:9.2f}ms  p99 {stats['p99_ms'] or 0:9.2f}ms  "
+          f"{stats['throughput']:9.1f} req/s  {stats['errors']} errors")
+
+def compare(baseline, current, threshold):
+    """Print the change of every route against a baseline, returns the regressions"""
+    regressions = []
+    print(f"\n{'mode':<7} {'route':<16} {'p50':>21} {'p99':>21} {'req/s':>21}")
+    for mode, routes_now in current['results'].items():
+        for name, now in routes_now.items():
+            before = baseline['results'].get(mode, {}).get(name)
+            if not before:
+                continue
+            cells = []
+            for key, higher_is_worse in (('p50_ms', True), ('p99_ms', True), ('throughput', False)):
+                old, new = before.get(key), now.get(key)
+                if not old or new is None:
+                    cells.append(f"{'-':>21}")
+                    continue
+                change = (new - old) / old
+                cells.append(f"{old:>8.2f} {new:>8.2f} {change:+4.0%}")
+                if (change if higher_is_worse else -change) > threshold:
+                    regressions.append((mode, name, key, change))
+            print(f"{mode:<7} {name:<16} {' '.join(cells)}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--files', type=int, default=1000, help='scripts in the generated tree (100 to 100000)')
+    parser.add_argument('--commits', type=int, default=1000, help='commits of git history, 0 for no repository')
+    parser.add_argument('--tmux-sessions', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--workdir', help='keep the data set here and reuse it, a temporary directory otherwise')
+    parser.add_argument('--mode', choices=('client', 'server', 'both'), default='both')
+    parser.add_argument('--requests', type=int, default=200, help='measured requests per route')
+    parser.add_argument('--warmup', type=int, default=5, help='unmeasured requests per client before timing')
+    parser.add_argument('--concurrency', type=int, default=8, help='concurrent clients against the server')
+    parser.add_argument('--workers', type=int, default=2, help='gunicorn worker processes')
+    parser.add_argument('--threads', type=int, default=16, help='threads per gunicorn worker')
+    parser.add_argument('--routes', nargs='*', help='only these routes')
+    parser.add_argument('--script-nice', default='', help='SCRIPT_NICE for the app, runs the scripts with a limit')
+    parser.add_argument('--no-spawner', action='store_true', help='start scripts from the workers instead of the spawner')
+    parser.add_argument('--index-timeout', type=float, default=300, help='seconds to wait for the search index')
+    parser.add_argument('--save', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='baseline JSON file to compare against')
+    parser.add_argument('--threshold', type=float, default=0.2, help='change counted as a regression')
+    args = parser.parse_args()
+    
+    workdir = args.workdir or tempfile.mkdtemp(prefix='script-manager-bench-')
+    try:
+        script_dir = build_data(os.path.abspath(workdir), args)
+        env = app_env(os.path.abspath(workdir), script_dir, args)
+        has_tmux = args.tmux_sessions > 0 and start_tmux(env, args.tmux_sessions)
+        try:
+            results = {}
+            if args.mode in ('server', 'both'):
+                results['server'] = bench_server(env, workdir, args, has_tmux)
+            # Last, the imported app keeps running in this process
+            if args.mode in ('client', 'both'):
+                results['client'] = bench_in_process(env, args, has_tmux)
+        finally:
+            if has_tmux:
+                stop_tmux(env)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+    
+    report = {
+        'meta': {
+            'date': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'options': {key: value for key, value in vars(args).items() if key not in ('save', 'compare')}
+        },
+        'results': results
+    }
+    if args.save:
+        with open(args.save, 'w') as file:
+            json.dump(report, file, indent=2, sort_keys=True)
+            file.write('\n')
+        print(f"Results saved to {args.save}")
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+        regressions = compare(baseline, report, args.threshold)
+        for mode, name, key, change in regressions:
+            print(f"Regression: {mode} {name} {key} {change:+.0%}")
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
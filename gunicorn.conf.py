@@ -0,0 +1,24 @@
+# Gunicorn settings for running Script Manager in production:
+#
+#   gunicorn -c gunicorn.conf.py app:app
+#
+# Settings are read from the same .env file as the app.
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+bind = os.getenv('BIND', '0.0.0.0:4000')
+workers = int(os.getenv('WEB_WORKERS', '2'))
+# Threaded workers so that open output streams do not block other requests
+worker_class = 'gthread'
+threads = int(os.getenv('WEB_THREADS', '16'))
+timeout = int(os.getenv('WEB_TIMEOUT', '120'))
+graceful_timeout = 30
+keepalive = 5
+accesslog = '-'
+
+# Each worker has its own job engine, they need a shared state database so
+# any worker can report on, stream and cancel jobs started through another.
+if workers > 1:
+    os.environ.setdefault('STATE_DB', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'state.db'))
@@ -0,0 +1,132 @@
+"""Launches scripts for Script Manager from a small helper process.
+
+A script run with resource limits needs a fork so the limits can be set
+between fork and exec, and forking a server worker copies its page tables,
+which takes longer the more memory the worker uses. A child also starts
+with the peak RSS of the process it was forked from, so scripts started
+by a large worker all report its size. The app hands its launches to this
+process instead, over the Unix socket it is started with. Forking here
+costs the same whatever the size of the app, and the peak RSS of a script
+is its own above the small size of this process.
+
+Each request is one JSON message with the stdout pipe of the script and,
+for cgroup limits, the cgroup.procs handle attached. The pid is sent back
+right away, the exit status and resource usage once the script exited.
+Only the standard library is used and nothing is imported that the app
+does not need, to keep this process small. It runs a single thread,
+exited scripts are reaped from the main loop when SIGCHLD arrives, so
+forking here never copies another thread's locks.
+"""
+import ctypes
+import json
+import os
+import resource
+import select
+import signal
+import socket
+import sys
+
+libc = None
+
+def send(sock, message):
+    sock.send(json.dumps(message).encode())
+
+def launch(request, output, procs):
+    """Fork and exec one script with its limits, returns its pid"""
+    global libc
+    if request['ioprio'] and libc is None:
+        # Loaded before the fork, the child should only make system calls
+        libc = ctypes.CDLL(None, use_errno=True)
+    argv = request['argv']
+    pid = os.fork()
+    if pid == 0:
+        try:
+            # In its own session so that cancelling also stops what the script started
+            os.setsid()
+            stdin = os.open(os.devnull, os.O_RDONLY)
+            os.dup2(stdin, 0)
+            os.dup2(output, 1)
+            os.dup2(output, 2)
+            if procs is not None:
+                # Writing 0 moves the writing process
+                os.write(procs, b'0')
+                os.close(procs)
+            # Only the copies on 0, 1 and 2 are left to the script
+            os.close(stdin)
+            os.close(output)
+            for limit, value in request['rlimits']:
+                resource.setrlimit(limit, (value, value))
+            if request['nice'] is not None:
+                os.setpriority(os.PRIO_PROCESS, 0, request['nice'])
+            if request['ioprio']:
+                syscall, value = request['ioprio']
+                # IOPRIO_WHO_PROCESS, 0 for this process
+                libc.syscall(syscall, 1, 0, value)
+            if request.get('cwd'):
+                os.chdir(request['cwd'])
+            if request.get('env') is not None:
+                os.execve(argv[0], argv, request['env'])
+            else:
+                os.execv(argv[0], argv)
+        except BaseException as e:
+            os.write(2, f"Could not start {argv[0]}: {e}\n".encode())
+        finally:
+            os._exit(127)
+    return pid
+
+def reap(sock, running):
+    """Report every script that has exited, `running` maps pids to request ids"""
+    while running:
+        try:
+            pid, status, usage = os.wait4(-1, os.WNOHANG)
+        except ChildProcessError:
+            break
+        if pid == 0:
+            break
+        request_id = running.pop(pid, None)
+        if request_id is not None:
+            send(sock, {'id': request_id, 'status': os.waitstatus_to_exitcode(status), 'usage': list(usage)})
+
+def main(fd):
+    # Passed on by the app as inheritable, scripts must not hold it open
+    os.set_inheritable(fd, False)
+    sock = socket.socket(fileno=fd)
+    # SIGCHLD writes to this pipe, which wakes up the select below
+    wakeup, wakeup_write = os.pipe()
+    os.set_blocking(wakeup, False)
+    os.set_blocking(wakeup_write, False)
+    signal.set_wakeup_fd(wakeup_write)
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+    running = {}
+    while True:
+        readable, _, _ = select.select([sock, wakeup], [], [])
+        if wakeup in readable:
+            while True:
+                try:
+                    os.read(wakeup, 512)
+                except BlockingIOError:
+                    break
+            reap(sock, running)
+        if sock not in readable:
+            continue
+        try:
+            data, fds, _, _ = socket.recv_fds(sock, 65536, 2)
+        except OSError:
+            break
+        # The app closed its end
+        if not data:
+            break
+        request = json.loads(data)
+        try:
+            pid = launch(request, fds[0], fds[1] if len(fds) > 1 else None)
+        except OSError as e:
+            send(sock, {'id': request['id'], 'error': str(e)})
+            continue
+        finally:
+            for received in fds:
+                os.close(received)
+        send(sock, {'id': request['id'], 'pid': pid})
+        running[pid] = request['id']
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]))
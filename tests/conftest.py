@@ -0,0 +1,22 @@
+import os
+import sys
+import tempfile
+
+# The app reads its settings when it is imported, keep everything it writes out of the checkout
+SCRIPT_DIR = tempfile.mkdtemp(prefix='script-manager-tests-')
+os.environ.update({
+    'SCRIPT_DIR': SCRIPT_DIR,
+    'GIT_ENABLED': 'false',
+    'STATE_DB': '',
+    'SCHEDULE_DB': '',
+    'SEARCH_DB': '',
+    'HISTORY_DB': '',
+    'VERSIONS_DB': '',
+    'RESULT_CACHE_DB': '',
+    'RESOURCE_PROFILES': os.path.join(SCRIPT_DIR, 'resource_profiles.json'),
+    'CACHE_RULES': os.path.join(SCRIPT_DIR, 'cache_rules.json'),
+    'NODES_FILE': os.path.join(SCRIPT_DIR, 'nodes.json'),
+    'PIPELINE_WORKSPACE_DIR': tempfile.mkdtemp(prefix='script-manager-workspaces-')
+})
+os.environ.pop('TMUX', None)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
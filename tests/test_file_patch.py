@@ -0,0 +1,33 @@
+import os
+
+import pytest
+
+import app
+
+@pytest.fixture
+def client():
+    with open(os.path.join(app.SCRIPT_DIR, 'patch.txt'), 'w') as f:
+        f.write('hello world\n')
+    return app.app.test_client()
+
+def patch(client, edits):
+    etag = client.get('/api/file/patch.txt').get_json()['etag']
+    return client.patch('/api/file/patch.txt', json={'edits': edits}, headers={'If-Match': f'"{etag}"'})
+
+def test_patch_replaces_a_range(client):
+    response = patch(client, [{'start': 0, 'end': 5, 'text': 'howdy'}])
+    assert response.status_code == 200
+    with open(os.path.join(app.SCRIPT_DIR, 'patch.txt')) as f:
+        assert f.read() == 'howdy world\n'
+
+@pytest.mark.parametrize('edit', [
+    {'start': 'a', 'end': 5, 'text': 'x'},
+    {'start': 0, 'text': 'x'},
+    {'start': 0, 'end': 2.5, 'text': 'x'},
+    {'start': True, 'end': 5, 'text': 'x'},
+    {'start': 0, 'end': 5, 'text': 7}
+])
+def test_patch_rejects_invalid_edits(client, edit):
+    response = patch(client, [edit])
+    assert response.status_code == 400
+    assert response.get_json()['message'] == "Edits need start, end and text"
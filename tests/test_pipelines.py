@@ -0,0 +1,83 @@
+import json
+import os
+import shutil
+import time
+
+import pytest
+
+import app
+
+STEPS = {
+    'build': 'build.sh',
+    'test': {'script': 'test.sh', 'needs': ['build']},
+    'deploy': {'script': 'deploy.sh', 'needs': ['test']}
+}
+
+@pytest.fixture
+def folder():
+    path = os.path.join(app.SCRIPT_DIR, 'pipes')
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+    scripts = {
+        'build.sh': 'echo built >> "$PIPELINE_WORKSPACE/build.log"',
+        # Fails until the workspace has a fixed marker
+        'test.sh': 'test -e "$PIPELINE_WORKSPACE/fixed"',
+        'deploy.sh': 'echo deployed'
+    }
+    for name, body in scripts.items():
+        script_path = os.path.join(path, name)
+        with open(script_path, 'w') as f:
+            f.write(f'#!/bin/bash\n{body}\n')
+        os.chmod(script_path, 0o755)
+    return path
+
+def write_pipeline(folder, steps):
+    with open(os.path.join(folder, 'ci.pipeline.json'), 'w') as f:
+        json.dump({'steps': steps}, f)
+
+def wait_for(run_id):
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        run = app.get_pipeline(run_id)
+        if run['finished'] is not None:
+            return run
+        time.sleep(0.05)
+    raise AssertionError(f"Pipeline {run_id} did not finish")
+
+def states(run):
+    return {step['name']: step['state'] for step in run['steps']}
+
+def test_cycle_is_rejected(folder):
+    write_pipeline(folder, dict(STEPS, build={'script': 'build.sh', 'needs': ['deploy']}))
+    response = app.app.test_client().get('/pipeline/run/pipes/ci.pipeline.json')
+    assert response.status_code == 400
+    assert response.get_json()['message'] == "Steps depend on each other in a cycle: build, deploy, test"
+
+def test_resume_skips_finished_steps(folder):
+    write_pipeline(folder, STEPS)
+    client = app.app.test_client()
+    response = client.get('/pipeline/run/pipes/ci.pipeline.json')
+    assert response.status_code == 200
+    failed = wait_for(response.get_json()['pipeline_id'])
+    assert failed['state'] == 'failed'
+    assert states(failed) == {'build': 'finished', 'test': 'failed', 'deploy': 'skipped'}
+    
+    open(os.path.join(failed['workspace'], 'fixed'), 'w').close()
+    response = client.post(f"/pipeline/{failed['id']}/resume")
+    assert response.status_code == 200
+    resumed = wait_for(response.get_json()['pipeline_id'])
+    assert resumed['state'] == 'finished'
+    assert resumed['resumed_from'] == failed['id']
+    assert states(resumed) == {'build': 'reused', 'test': 'finished', 'deploy': 'finished'}
+    # The reused step did not run again
+    assert resumed['steps'][0]['name'] == 'build' and resumed['steps'][0]['started'] is None
+    # Resumed runs share the workspace, which is removed once the pipeline finished
+    assert not os.path.exists(failed['workspace'])
+
+def test_finished_runs_cannot_be_resumed(folder):
+    write_pipeline(folder, {'deploy': 'deploy.sh'})
+    client = app.app.test_client()
+    run = wait_for(client.get('/pipeline/run/pipes/ci.pipeline.json').get_json()['pipeline_id'])
+    assert run['state'] == 'finished'
+    response = client.post(f"/pipeline/{run['id']}/resume")
+    assert response.status_code == 400
@@ -0,0 +1,51 @@
+import json
+import os
+
+import pytest
+
+import app
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    cache = app.ResultCache(str(tmp_path / 'result_cache.db'))
+    monkeypatch.setattr(app, 'result_cache', cache)
+    with open(app.CACHE_RULES, 'w') as f:
+        json.dump({'cached/*.sh': True}, f)
+    return cache
+
+def write_script(tmp_path, body):
+    os.makedirs(os.path.join(app.SCRIPT_DIR, 'cached'), exist_ok=True)
+    script_path = os.path.join(app.SCRIPT_DIR, 'cached', 'count.sh')
+    with open(script_path, 'w') as f:
+        f.write(f'#!/bin/bash\necho run >> "{tmp_path / "runs.log"}"\n{body}\n')
+    os.chmod(script_path, 0o755)
+    return script_path
+
+def runs(tmp_path):
+    with open(tmp_path / 'runs.log') as f:
+        return len(f.readlines())
+
+def test_hit_then_miss_on_content_change(cache, tmp_path):
+    script_path = write_script(tmp_path, 'echo one')
+    assert app.execute_script(script_path)[0]
+    assert app.execute_script(script_path)[0]
+    assert runs(tmp_path) == 1
+    assert (cache.stats()['hits'], cache.stats()['misses']) == (1, 1)
+    
+    write_script(tmp_path, 'echo two')
+    assert app.execute_script(script_path)[0]
+    assert runs(tmp_path) == 2
+    assert (cache.stats()['hits'], cache.stats()['misses']) == (1, 2)
+
+def test_least_recently_used_entry_is_evicted_at_max_bytes(cache, monkeypatch):
+    # Random output does not compress, each entry takes about 1 KB
+    lines = {key: [os.urandom(500).hex()] for key in ('a', 'b', 'c')}
+    cache.put('a', 'cached/a.sh', 0, lines['a'], 1, 0)
+    cache.put('b', 'cached/b.sh', 0, lines['b'], 1, 0)
+    monkeypatch.setattr(app, 'RESULT_CACHE_MAX_BYTES', cache.stats()['size'] + 100)
+    assert cache.get('a') is not None
+    cache.put('c', 'cached/c.sh', 0, lines['c'], 1, 0)
+    assert cache.get('b') is None
+    assert cache.get('a') == (0, lines['a'], 1)
+    assert cache.get('c') == (0, lines['c'], 1)
+    assert cache.stats()['evictions'] == 1
@@ -0,0 +1,95 @@
+import os
+
+import pytest
+
+import app
+
+class FakeJobs:
+    """Stands in for the job engine, jobs stay running until finish() is called"""
+    
+    def __init__(self):
+        self.states = {}
+        self.started = []
+        self.cancelled = []
+    
+    def submit(self, script_path, schedule_id=None):
+        job_id = f'job-{len(self.started)}'
+        self.states[job_id] = 'running'
+        self.started.append(job_id)
+        return {'id': job_id}
+    
+    def get(self, job_id):
+        return {'state': self.states[job_id]} if job_id in self.states else None
+    
+    def cancel(self, job_id):
+        self.states[job_id] = 'cancelled'
+        self.cancelled.append(job_id)
+        return True, "Job cancelled"
+    
+    def finish(self, job_id):
+        self.states[job_id] = 'finished'
+
+@pytest.fixture
+def jobs(monkeypatch):
+    fake = FakeJobs()
+    monkeypatch.setattr(app, 'submit_job', fake.submit)
+    monkeypatch.setattr(app, 'get_job', fake.get)
+    monkeypatch.setattr(app, 'cancel_job', fake.cancel)
+    return fake
+
+@pytest.fixture
+def scheduler(tmp_path):
+    script = os.path.join(app.SCRIPT_DIR, 'slow.sh')
+    with open(script, 'w') as f:
+        f.write('#!/bin/sh\nsleep 3\n')
+    return app.Scheduler(str(tmp_path / 'schedules.db'))
+
+def fire(scheduler, overlap):
+    """Make a schedule due and dispatch it, as tick() does"""
+    scheduler.schedules['s'] = {'id': 's', 'script': 'slow.sh', 'overlap': overlap}
+    if 's' not in scheduler.pending:
+        scheduler.pending.append('s')
+    scheduler.dispatch()
+
+def test_skip_drops_overlapping_runs(scheduler, jobs):
+    fire(scheduler, 'skip')
+    fire(scheduler, 'skip')
+    assert jobs.started == ['job-0']
+    assert not scheduler.pending
+    jobs.finish('job-0')
+    fire(scheduler, 'skip')
+    assert jobs.started == ['job-0', 'job-1']
+
+def test_queue_waits_for_the_previous_run(scheduler, jobs):
+    fire(scheduler, 'queue')
+    fire(scheduler, 'queue')
+    fire(scheduler, 'queue')
+    # Only one run at a time, the later firings wait as one queued run
+    assert jobs.started == ['job-0']
+    assert list(scheduler.pending) == ['s']
+    scheduler.dispatch()
+    assert jobs.started == ['job-0']
+    
+    jobs.finish('job-0')
+    scheduler.dispatch()
+    assert jobs.started == ['job-0', 'job-1']
+    assert not scheduler.pending
+
+def test_kill_replaces_the_previous_run(scheduler, jobs):
+    fire(scheduler, 'kill')
+    fire(scheduler, 'kill')
+    assert jobs.cancelled == ['job-0']
+    assert jobs.started == ['job-0', 'job-1']
+    assert scheduler.active_jobs == {'job-1'}
+    assert not scheduler.pending
+
+def test_only_shell_scripts_can_be_scheduled(scheduler, jobs):
+    with open(os.path.join(app.SCRIPT_DIR, 'notes.txt'), 'w') as f:
+        f.write('not a script\n')
+    assert scheduler.validate({'script': 'notes.txt', 'interval': 60}) == "Only .sh files can be executed"
+    assert scheduler.validate({'script': 'slow.sh', 'interval': 60}) is None
+    
+    # A row stored before validation is still not run
+    scheduler.start_run({'id': 'n', 'script': 'notes.txt'})
+    assert jobs.started == []
+    assert not os.access(os.path.join(app.SCRIPT_DIR, 'notes.txt'), os.X_OK)
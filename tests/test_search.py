@@ -0,0 +1,37 @@
+import pytest
+
+import app
+
+@pytest.fixture
+def index(tmp_path):
+    root = tmp_path / 'scripts'
+    root.mkdir()
+    (root / 'start.sh').write_text('#!/bin/bash\necho start service\n')
+    (root / 'stop.sh').write_text('#!/bin/bash\necho stop service\n')
+    (root / 'other.sh').write_text('#!/bin/bash\nprintf restart\n')
+    index = app.SearchIndex(str(tmp_path / 'search.db'), str(root))
+    index.apply(['start.sh', 'stop.sh', 'other.sh'])
+    return index
+
+@pytest.mark.parametrize('pattern, literals', [
+    ('foo(bar|baz)qux', ['foo', 'qux']),
+    ('(alpha|beta)', []),
+    ('echo (start|stop)', ['echo ']),
+    (r'^deploy_\d+', ['deploy_']),
+    ('(?:prefix)+x', ['prefix']),
+    ('x*hello', ['hello']),
+    ('ab.cd', []),
+    ('a|b', [])
+])
+def test_required_literals(index, pattern, literals):
+    assert index.required_literals(pattern) == literals
+
+def test_regex_with_alternation_matches_each_branch(index):
+    results, more = index.search('echo (start|stop)', regex=True)
+    assert sorted(result['path'] for result in results) == ['start.sh', 'stop.sh']
+    assert not more
+
+@pytest.mark.parametrize('query, regex', [('ab', False), ('a|b', True), ('(alpha|beta)', True)])
+def test_patterns_without_a_long_literal_are_rejected(index, query, regex):
+    with pytest.raises(ValueError):
+        index.search(query, regex=regex)
@@ -0,0 +1,52 @@
+import os
+import shutil
+
+import pytest
+
+import app
+
+@pytest.fixture
+def folder():
+    path = os.path.join(app.SCRIPT_DIR, 'tree')
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(os.path.join(path, 'sub'), exist_ok=True)
+    for i in range(1, 8):
+        with open(os.path.join(path, f'f{i}0.sh'), 'w') as f:
+            f.write('#!/bin/bash\n')
+    app.file_index.invalidate()
+    return path
+
+def page(client, cursor=None):
+    params = {'path': 'tree', 'limit': 3}
+    if cursor:
+        params['cursor'] = cursor
+    response = client.get('/api/tree', query_string=params)
+    assert response.status_code == 200
+    data = response.get_json()
+    return [entry['name'] for entry in data['entries']], data['next_cursor']
+
+def test_pages_cover_the_folder_once(folder):
+    client = app.app.test_client()
+    names, cursor = page(client)
+    while cursor:
+        more, cursor = page(client, cursor)
+        names += more
+    # Folders first, then files by name
+    assert names == ['sub'] + [f'f{i}0.sh' for i in range(1, 8)]
+
+def test_cursor_continues_after_an_insert(folder):
+    client = app.app.test_client()
+    first, cursor = page(client)
+    assert first == ['sub', 'f10.sh', 'f20.sh']
+    # One file before the cursor and one after it
+    for name in ('f15.sh', 'f25.sh'):
+        with open(os.path.join(folder, name), 'w') as f:
+            f.write('#!/bin/bash\n')
+        app.file_index.invalidate(os.path.join(folder, name))
+    second, _ = page(client, cursor)
+    assert second == ['f25.sh', 'f30.sh', 'f40.sh']
+
+def test_invalid_cursor_is_rejected(folder):
+    response = app.app.test_client().get('/api/tree', query_string={'path': 'tree', 'cursor': 'nope'})
+    assert response.status_code == 400
+    assert response.get_json()['message'] == "Invalid cursor"
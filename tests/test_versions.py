@@ -0,0 +1,41 @@
+import os
+
+import pytest
+
+import app
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    store = app.VersionStore(str(tmp_path / 'versions.db'))
+    monkeypatch.setattr(app, 'version_store', store)
+    monkeypatch.setattr(app, 'VERSIONS_PER_FILE', 2)
+    return store
+
+def test_restore_after_gc(store):
+    ids = [store.record('restore.txt', data, 'save') for data in (b'one\n', b'two\n', b'three\n', b'one\n')]
+    assert store.gc() == 2
+    assert store.read('restore.txt', ids[0]) == (None, None)
+    # The latest revision still holds the blob it shared with the first one
+    assert store.usage()['blobs'] == 2
+    
+    response = app.app.test_client().post(f'/api/file/restore.txt/versions/{ids[3]}/restore')
+    assert response.status_code == 200
+    with open(os.path.join(app.SCRIPT_DIR, 'restore.txt'), 'rb') as f:
+        assert f.read() == b'one\n'
+
+def test_gc_keeps_the_latest_revision_over_the_size_limit(store, monkeypatch):
+    monkeypatch.setattr(app, 'VERSIONS_MAX_BYTES', 0)
+    first = store.record('big.txt', b'a' * 1000, 'save')
+    latest = store.record('big.txt', b'b' * 1000, 'save')
+    assert store.gc() == 1
+    assert store.read('big.txt', first) == (None, None)
+    assert store.read('big.txt', latest)[1] == b'b' * 1000
+
+def test_save_records_the_previous_content_first(store):
+    file_path = os.path.join(app.SCRIPT_DIR, 'edited.txt')
+    with open(file_path, 'wb') as f:
+        f.write(b'before\n')
+    assert app.replace_file(file_path, [b'after\n'])[0] == 'saved'
+    revisions, _ = store.revisions('edited.txt')
+    assert [revision['source'] for revision in revisions] == ['save', 'original']
+    assert store.read('edited.txt', revisions[1]['id'])[1] == b'before\n'